@@ -15,6 +15,20 @@ if os.environ.get('TRAVIS') != 'true':
     import pos_itk_transforms
 
 import pos_parameters
+import pos_executors
+import pos_scheduler
+import pos_result_cache
+import pos_journal
+import pos_trace
+import pos_memory
+import pos_cost
+import pos_tool_pool
+import pos_broker
+import pos_plan
+import pos_slice_index
+import pos_similarity
+import pos_slice_graph
+import pos_affine
 import pos_wrapper_skel
 
 import pos_wrappers
@@ -2,13 +2,15 @@
 
 import sys
 import copy
-import numpy as np
 
+import pos_common
 import pos_wrappers
 from pos_wrapper_skel import generic_workflow
 import pos_parameters
 from pos_deformable_wrappers import blank_slice_deformation_wrapper
 
+np = pos_common.lazy_module('numpy')
+
 """
 * Assigning weights for the images by reading them from files or
     applying weighting functions.
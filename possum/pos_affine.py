@@ -0,0 +1,384 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Reading, writing and processing of the itk affine transformation files.
+
+The workflows produce thousands of two dimensional affine transformations
+(one or more per slice) stored in the itk text transformation files of the
+`MatrixOffsetTransformBase` family (`AffineTransform`,
+`MatrixOffsetTransformBase`, `Euler2DTransform`, etc., as long as their
+parameters are the matrix followed by the translation). This module reads a
+series of such files at once into an :py:class:`affine_stack` -- an (N, D+1,
+D+1) numpy array of the transformations in the homogeneous coordinates --
+composes, inverts, interpolates and smooths all the transformations at once
+and writes them back in the itk format.
+
+The transformations map the points of the fixed image onto the moving image,
+just as the itk (and ANTS) transformations do.
+"""
+
+import pos_common
+
+np = pos_common.lazy_module('numpy')
+filters =pos_common.lazy_module('scipy.ndimage.filters')
+
+# The header of the itk transformation files.
+_HEADER = "#Insight Transform File V1.0\n#Transform 0\n"
+
+# The class of the transformations written by default.
+DEFAULT_CLASS = 'MatrixOffsetTransformBase_double_%d_%d'
+
+
+def parse_transformation(text, filename=None):
+    """
+    Parse the contents of the itk transformation file.
+
+    :param text: The contents of the file.
+    :type text: str
+
+    :param filename: Name of the file, used in the error messages.
+    :type filename: str
+
+    :return: The transformation class, the parameters and the fixed
+        parameters of the (first) transformation stored in the file.
+    :rtype: tuple
+
+    >>> parse_transformation(_HEADER + "Transform: AffineTransform_double_2_2"
+    ...     "\\nParameters: 1 0 0 1 2.5 -3\\nFixedParameters: 0 0\\n")
+    ('AffineTransform_double_2_2', [1.0, 0.0, 0.0, 1.0, 2.5, -3.0], [0.0, 0.0])
+
+    >>> parse_transformation("Transform: A\\nParameters: 1 x", 'a.txt')
+    Traceback (most recent call last):
+    ...
+    ValueError: Not a valid itk transformation file: a.txt
+    """
+    fields = {}
+    try:
+        for line in text.splitlines():
+            key, separator, value = line.partition(':')
+            key = key.strip()
+            if separator and key in ('Transform', 'Parameters',
+                                     'FixedParameters') and key not in fields:
+                fields[key] = value.strip()
+
+        return fields['Transform'], \
+            map(float, fields['Parameters'].split()), \
+            map(float, fields.get('FixedParameters', '').split())
+    except (KeyError, ValueError):
+        raise ValueError("Not a valid itk transformation file: %s" %
+                         (filename or text))
+
+
+def read_transformation_parameters(filename):
+    """
+    Read the parameters of the transformation stored in the itk
+    transformation file.
+
+    :param filename: The transformation file.
+    :type filename: str
+
+    :return: The `transformation_class`, the `parameters` and the
+        `fixed_parameters` of the transformation.
+    :rtype: dict
+    """
+    transformation_class, parameters, fixed_parameters = \
+        parse_transformation(open(filename).read(), filename)
+    return {'transformation_class': transformation_class,
+            'parameters': parameters,
+            'fixed_parameters': fixed_parameters}
+
+
+def format_parameter(value):
+    """
+    The shortest representation of the value which is read back exactly.
+
+    >>> map(format_parameter, [1.0, -0.0, 0.1, 1e-20, 2.5])
+    ['1', '0', '0.1', '1e-20', '2.5']
+    """
+    value = repr(float(value) + 0.0)
+    return value.endswith('.0') and value[:-2] or value
+
+
+class affine_stack(object):
+    """
+    A series of affine transformations.
+
+    :param matrices: The transformations in the homogeneous coordinates.
+    :type matrices: (N, D+1, D+1) array
+
+    :param centers: The centers of the transformations (the fixed parameters
+        of the itk transformations). They do not change the transformations,
+        only their itk parameters. Zero by default.
+    :type centers: (N, D) array
+
+    :param classes: The itk classes of the transformations. The
+        `MatrixOffsetTransformBase` by default.
+    :type classes: list of strings
+
+    >>> t = affine_stack.from_parameters([[0, -1, 1, 0, 2, 3]], [[1, 1]])
+    >>> t.matrices[0].tolist()
+    [[0.0, -1.0, 4.0], [1.0, 0.0, 3.0], [0.0, 0.0, 1.0]]
+    >>> t.parameters.tolist(), t.dimension, len(t)
+    ([[0.0, -1.0, 1.0, 0.0, 2.0, 3.0]], 2, 1)
+    >>> t.transform_points([[1, 1], [2, 1]]).tolist()
+    [[[3.0, 4.0], [3.0, 5.0]]]
+
+    Composing, inverting and interpolating the transformations (the
+    transformations of length one are combined with every transformation of
+    the other stack):
+
+    >>> shift = affine_stack.from_parameters([[1, 0, 0, 1, 1, 0],
+    ...                                       [1, 0, 0, 1, 0, 2]])
+    >>> shift.compose(t).parameters.tolist()
+    [[0.0, -1.0, 1.0, 0.0, 5.0, 3.0], [0.0, -1.0, 1.0, 0.0, 4.0, 5.0]]
+    >>> t.compose(shift).transform_points([[0, 0]]).tolist()
+    [[[4.0, 4.0]], [[2.0, 3.0]]]
+    >>> t.compose(t.inverse()).parameters.tolist()
+    [[1.0, 0.0, 0.0, 1.0, 0.0, 0.0]]
+    >>> shift.interpolate(affine_stack.identity(2, 2), 0.5).parameters.tolist()
+    [[1.0, 0.0, 0.0, 1.0, 0.5, 0.0], [1.0, 0.0, 0.0, 1.0, 0.0, 1.0]]
+    """
+
+    def __init__(self, matrices, centers=None, classes=None):
+        self.matrices = np.asarray(matrices, dtype=np.float64)
+        if self.matrices.ndim == 2:
+            self.matrices = self.matrices[np.newaxis]
+
+        if centers is None:
+            centers = np.zeros((len(self.matrices), self.dimension))
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(
+            len(self.matrices), self.dimension)
+        self.classes = classes or \
+            [DEFAULT_CLASS % (self.dimension, self.dimension)] * len(self)
+
+        # The itk parameters the transformations were created from. They are
+        # written back as they are, without the rounding errors.
+        self._parameters = None
+
+    def __len__(self):
+        return self.matrices.shape[0]
+
+    @property
+    def dimension(self):
+        return self.matrices.shape[-1] - 1
+
+    @classmethod
+    def identity(cls, dimension=2, length=1):
+        """
+        A stack of `length` identity transformations.
+        """
+        return cls(np.tile(np.identity(dimension + 1), (length, 1, 1)))
+
+    @classmethod
+    def from_parameters(cls, parameters, fixed_parameters=None, classes=None):
+        """
+        Create the transformations from their itk parameters: the matrix (in
+        the row major order) followed by the translation and the center
+        (the fixed parameters).
+
+        :param parameters: The parameters of the transformations.
+        :type parameters: (N, D * D + D) array
+
+        :param fixed_parameters: The centers of the transformations. Zero by
+            default.
+        :type fixed_parameters: (N, D) array
+
+        :rtype: :py:class:`affine_stack`
+        """
+        parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+        length, parameters_no = parameters.shape
+        dimension = int(np.sqrt(parameters_no + 0.25) - 0.5)
+        if dimension * (dimension + 1) != parameters_no:
+            raise ValueError("Invalid number of the affine transformation "
+                             "parameters: %d" % parameters_no)
+
+        if fixed_parameters is None:
+            fixed_parameters = np.zeros((length, dimension))
+        centers = np.asarray(fixed_parameters, dtype=np.float64).reshape(
+            length, dimension)
+
+        linear = parameters[:, :dimension ** 2].reshape(length, dimension,
+                                                        dimension)
+        translation = parameters[:, dimension ** 2:]
+        matrices = np.tile(np.identity(dimension + 1), (length, 1, 1))
+        matrices[:, :-1, :-1] = linear
+        matrices[:, :-1, -1] = translation + centers - \
+            np.einsum('nij,nj->ni', linear, centers)
+
+        stack = cls(matrices, centers, classes)
+        stack._parameters = parameters
+        return stack
+
+    @property
+    def parameters(self):
+        """
+        The itk parameters of the transformations (with respect to their
+        centers): the matrix followed by the translation.
+
+        :rtype: (N, D * D + D) array
+        """
+        if self._parameters is not None:
+            return self._parameters.copy()
+
+        linear = self.matrices[:, :-1, :-1]
+        translation = self.matrices[:, :-1, -1] - self.centers + \
+            np.einsum('nij,nj->ni', linear, self.centers)
+        return np.hstack([linear.reshape(len(self), -1), translation]) + 0.0
+
+    def transform_points(self, points):
+        """
+        Map the points with every transformation.
+
+        :param points: The points.
+        :type points: (M, D) array
+
+        :return: The transformed points.
+        :rtype: (N, M, D) array
+        """
+        points = np.asarray(points, dtype=np.float64)
+        return np.einsum('nij,mj->nmi', self.matrices[:, :-1, :-1], points) + \
+            self.matrices[:, np.newaxis, :-1, -1]
+
+    def compose(self, other):
+        """
+        Compose the transformations with the `other` transformations: the
+        points are mapped with the `other` transformations first (as the
+        affine transformations given to the ANTS `ComposeMultiTransform` in
+        the order `self`, `other`).
+
+        :rtype: :py:class:`affine_stack`
+        """
+        first, second = np.broadcast_arrays(self.matrices, other.matrices)
+        centers = other.centers
+        if len(other) < len(self):
+            centers = self.centers
+        return affine_stack(np.einsum('nij,njk->nik', first, second), centers)
+
+    def inverse(self):
+        """
+        The inverse transformations (the centers are preserved).
+
+        :rtype: :py:class:`affine_stack`
+        """
+        return affine_stack(np.linalg.inv(self.matrices), self.centers,
+                            list(self.classes))
+
+    def interpolate(self, other, weight):
+        """
+        Interpolate linearly the matrices of the transformations and the
+        `other` transformations (`weight` 0 gives these transformations, 1 --
+        the other ones).
+
+        :rtype: :py:class:`affine_stack`
+        """
+        weight = np.reshape(weight, (-1, 1, 1))
+        return affine_stack((1.0 - weight) * self.matrices +
+                            weight * other.matrices, self.centers)
+
+    def smooth(self, sigma):
+        """
+        Smooth the itk parameters (the parameters followed by the fixed
+        parameters) of the consecutive transformations with the gaussian
+        kernel.
+
+        :param sigma: The standard deviation of the kernel (in
+            transformations). Either a single value or a value for every
+            parameter (`None` leaves the parameter unchanged).
+        :type sigma: float or list of floats
+
+        :rtype: :py:class:`affine_stack`
+
+        >>> t = affine_stack.from_parameters([[1, 0, 0, 1, x, 0]
+        ...                                   for x in [0, 0, 3, 0, 0]])
+        >>> s = t.smooth([None, None, None, None, 1.0, None, None, None])
+        >>> s.parameters[:, 4].round(2).tolist(), s.parameters[:, 0].tolist()
+        ([0.18, 0.73, 1.2, 0.73, 0.18], [1.0, 1.0, 1.0, 1.0, 1.0])
+        """
+        values = np.hstack([self.parameters, self.centers])
+        if np.isscalar(sigma):
+            sigma = [sigma] * values.shape[1]
+
+        smoothed = values.copy()
+        for index, parameter_sigma in enumerate(sigma):
+            if parameter_sigma:
+                smoothed[:, index] = filters.gaussian_filter1d(
+                    values[:, index], parameter_sigma)
+
+        parameters_no = self.dimension * (self.dimension + 1)
+        return affine_stack.from_parameters(smoothed[:, :parameters_no],
+            smoothed[:, parameters_no:], list(self.classes))
+
+    def write(self, filenames):
+        """
+        Write every transformation into its itk transformation file.
+
+        :param filenames: The files, one for every transformation.
+        :type filenames: list of strings
+        """
+        if len(filenames) != len(self):
+            raise ValueError("%d filenames given for %d transformations." %
+                             (len(filenames), len(self)))
+
+        for filename, transformation_class, parameters, center in \
+                zip(filenames, self.classes, self.parameters, self.centers):
+            transformation_file = open(filename, 'w')
+            transformation_file.write(_HEADER +
+                "Transform: %s\nParameters: %s\nFixedParameters: %s\n" % (
+                transformation_class,
+                " ".join(map(format_parameter, parameters)),
+                " ".join(map(format_parameter, center))))
+            transformation_file.close()
+
+
+def read_transformations(filenames):
+    """
+    Read the series of the itk affine transformation files.
+
+    :param filenames: The transformation files.
+    :type filenames: list of strings
+
+    :rtype: :py:class:`affine_stack`
+
+    >>> open('/tmp/pos_affine_test_0.txt', 'w').write(_HEADER +
+    ...     "Transform: AffineTransform_double_2_2\\n"
+    ...     "Parameters: 0.9 -0.1 0.1 0.9 12.5 -3\\n"
+    ...     "FixedParameters: 100.25 50\\n")
+    >>> t = read_transformations(['/tmp/pos_affine_test_0.txt'])
+    >>> t.classes, t.centers.tolist()
+    (['AffineTransform_double_2_2'], [[100.25, 50.0]])
+
+    The transformations are written back exactly:
+
+    >>> t.write(['/tmp/pos_affine_test_1.txt'])
+    >>> print open('/tmp/pos_affine_test_1.txt').read(),
+    #Insight Transform File V1.0
+    #Transform 0
+    Transform: AffineTransform_double_2_2
+    Parameters: 0.9 -0.1 0.1 0.9 12.5 -3
+    FixedParameters: 100.25 50
+
+    >>> t.inverse().write(['/tmp/pos_affine_test_1.txt'])
+    >>> u = read_transformations(['/tmp/pos_affine_test_1.txt']).compose(t)
+    >>> np.allclose(u.matrices, np.identity(3))
+    True
+    """
+    parameters, fixed_parameters, classes = [], [], []
+    for filename in filenames:
+        transformation_class, transformation_parameters, fixed = \
+            parse_transformation(open(filename).read(), filename)
+        classes.append(transformation_class)
+        parameters.append(transformation_parameters)
+        fixed_parameters.append(fixed)
+
+    try:
+        return affine_stack.from_parameters(parameters, fixed_parameters,
+                                            classes)
+    except ValueError:
+        raise ValueError("Not a series of affine transformations of the same "
+                         "dimension: %s" % ", ".join(filenames))
+
+
+if __name__ == 'possum.pos_affine':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,600 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A work queue distributing the commands of the workflows among any number of
+worker processes.
+
+GNU parallel (see :py:class:`possum.pos_executors.parallel_executor`)
+distributes the commands over a static list of hosts reached through ssh. The
+work queue turns it around: the workflow puts the commands into a queue and
+the workers (the `pos_worker` script, see :py:class:`worker`), started on the
+same machine or on other nodes, pull the commands from the queue, execute
+them and report the results back. Workers may join and leave at any time, so
+the computations scale out elastically.
+
+The queue is an SQLite database (by default in the working directory of the
+workflow), so it requires no server at all. While a worker executes a command,
+it regularly updates the heartbeat of the command. Commands which stopped
+heartbeating (e.g. the worker crashed or its node was lost) are put back
+into the queue and executed by another worker.
+
+The workers on other nodes need access to the queue file and to the files
+processed by the commands through a shared filesystem. The filesystem has to
+support the POSIX file locks (which is not the case with some NFS setups)
+and the clocks of the nodes have to be synchronized. The commands should use
+absolute paths as the workers execute them in their own working directories.
+"""
+
+import os
+import time
+import json
+import socket
+import logging
+import sqlite3
+import threading
+
+import pos_executors
+
+# Name of the queue file created in the working directory of the workflow.
+QUEUE_FILENAME = '.pos_queue.sqlite'
+
+# Commands which have not heartbeaten for so many seconds are put back into
+# the queue. The workers have to heartbeat at least twice as often, so a
+# single late heartbeat does not hand their commands out again.
+HEARTBEAT_TIMEOUT = 60.0
+
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch TEXT NOT NULL,
+    command TEXT NOT NULL,
+    threads INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    returncode INTEGER,
+    stdout TEXT,
+    stderr TEXT,
+    start_time REAL,
+    end_time REAL,
+    resources TEXT);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_by_batch ON jobs (batch, state);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL);
+COMMIT;
+"""
+
+
+class work_queue(object):
+    """
+    The queue of the commands stored in the `filename` SQLite database. Every
+    process (and every thread) accessing the queue uses its own instance of
+    the class.
+
+    :param filename: The queue file. Created if it does not exist.
+    :type filename: str
+
+    :param timeout: How long (in seconds) to wait for the other processes to
+        release the queue.
+    :type timeout: float
+
+    >>> if os.path.exists('/tmp/pos_broker_test.sqlite'):
+    ...     os.remove('/tmp/pos_broker_test.sqlite')
+    >>> queue = work_queue('/tmp/pos_broker_test.sqlite')
+    >>> queue.submit('batch', ["echo 1", "echo 2"], threads=2)
+    [1, 2]
+
+    The commands are handed out in the order of submission:
+
+    >>> queue.claim('worker-1')
+    (1, 'echo 1', 2)
+    >>> queue.claim('worker-2')
+    (2, 'echo 2', 2)
+    >>> print queue.claim('worker-3')
+    None
+
+    >>> queue.complete(1, 'worker-1',
+    ...                pos_executors.command_result("echo 1", 0, "1\\n"))
+    True
+    >>> results = queue.collect('batch')
+    >>> results.keys(), results[1].stdout
+    ([1], '1\\n')
+
+    The commands of the workers which stopped heartbeating are executed
+    again by other workers:
+
+    >>> queue.requeue_stale(timeout=-1)
+    1
+    >>> queue.claim('worker-3')
+    (2, 'echo 2', 2)
+
+    The result of the stale worker is not accepted any more:
+
+    >>> queue.complete(2, 'worker-2', pos_executors.command_result("echo 2", 0))
+    False
+
+    >>> queue.cancel('batch')
+    >>> queue.heartbeat('worker-3', 2)
+    False
+    """
+
+    def __init__(self, filename, timeout=60.0):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, timeout=timeout,
+            isolation_level=None, check_same_thread=False)
+        self._connection.text_factory = str
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    def _execute(self, query, parameters=()):
+        with self._lock:
+            return self._connection.execute(query, parameters)
+
+    def _transaction(self, function):
+        """
+        Execute the `function` (taking the database cursor) within a single
+        transaction which locks out the other processes.
+        """
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                value = function(cursor)
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return value
+
+    def submit(self, batch, commands, threads=None, delay=0):
+        """
+        Put the commands into the queue.
+
+        :param batch: Identifier of the batch the commands belong to.
+        :type batch: str
+
+        :param commands: The commands in the order of execution.
+        :type commands: list of strings
+
+        :param threads: Number of threads of each command.
+        :type threads: int
+
+        :param delay: The commands are not handed out earlier than `delay`
+            seconds from now.
+        :type delay: float
+
+        :return: Identifiers of the submitted jobs.
+        :rtype: list of ints
+        """
+        not_before = time.time() + delay
+
+        def insert(cursor):
+            job_ids = []
+            for command_str in commands:
+                cursor.execute("INSERT INTO jobs (batch, command, threads, "
+                    "not_before) VALUES (?, ?, ?, ?)",
+                    (batch, command_str, threads, not_before))
+                job_ids.append(cursor.lastrowid)
+            return job_ids
+        return self._transaction(insert)
+
+    def claim(self, worker_name):
+        """
+        Take the next command from the queue.
+
+        :return: The (job identifier, command, threads) tuple or `None` if
+            there are no commands waiting.
+        :rtype: tuple
+        """
+        def take(cursor):
+            now = time.time()
+            job = cursor.execute("SELECT id, command, threads FROM jobs "
+                "WHERE state = 'pending' AND not_before <= ? "
+                "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if job is not None:
+                cursor.execute("UPDATE jobs SET state = 'running', "
+                    "worker = ?, heartbeat = ? WHERE id = ?",
+                    (worker_name, now, job[0]))
+            return job
+        return self._transaction(take)
+
+    def release(self, job_id, worker_name):
+        """
+        Put the command claimed by the worker back into the queue.
+        """
+        self._execute("UPDATE jobs SET state = 'pending', worker = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (job_id, worker_name))
+
+    def heartbeat(self, worker_name, job_id=None):
+        """
+        Report that the worker (and the command it executes) is alive.
+
+        :return: `False` if the command is not expected any more (it was
+            cancelled or handed out to another worker).
+        :rtype: bool
+        """
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO workers (name, heartbeat) "
+                      "VALUES (?, ?)", (worker_name, now))
+        if job_id is None:
+            return True
+        return self._execute("UPDATE jobs SET heartbeat = ? WHERE id = ? "
+            "AND worker = ? AND state = 'running'",
+            (now, job_id, worker_name)).rowcount > 0
+
+    def complete(self, job_id, worker_name, result):
+        """
+        Record the result of the command claimed by the worker.
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+
+        :return: `False` if the command is not expected any more (it was
+            cancelled or handed out to another worker).
+        :rtype: bool
+        """
+        return self._execute("UPDATE jobs SET state = 'done', "
+            "returncode = ?, stdout = ?, stderr = ?, start_time = ?, "
+            "end_time = ?, resources = ? WHERE id = ? AND worker = ? "
+            "AND state = 'running'",
+            (result.returncode, result.stdout, result.stderr,
+             result.start_time, result.end_time,
+             json.dumps(result.resources), job_id, worker_name)).rowcount > 0
+
+    def collect(self, batch):
+        """
+        Take the results of the finished commands of the batch out of the
+        queue.
+
+        :return: The results by the job identifiers.
+        :rtype: dict
+        """
+        def take(cursor):
+            rows = cursor.execute("SELECT id, command, returncode, stdout, "
+                "stderr, start_time, end_time, resources FROM jobs "
+                "WHERE batch = ? AND state = 'done'", (batch,)).fetchall()
+            cursor.executemany("DELETE FROM jobs WHERE id = ?",
+                               [(row[0],) for row in rows])
+            return rows
+
+        results = {}
+        for row in self._transaction(take):
+            results[row[0]] = pos_executors.command_result(*row[1:7],
+                resources=json.loads(row[7] or 'null'))
+        return results
+
+    def cancel(self, batch):
+        """
+        Remove all the commands of the batch from the queue. The workers
+        executing the commands terminate them.
+        """
+        self._execute("DELETE FROM jobs WHERE batch = ?", (batch,))
+
+    def requeue_stale(self, timeout):
+        """
+        Put the commands which have not heartbeaten for `timeout` seconds
+        back into the queue.
+
+        :return: Number of the commands put back into the queue.
+        :rtype: int
+        """
+        return self._execute("UPDATE jobs SET state = 'pending', "
+            "worker = NULL WHERE state = 'running' AND heartbeat < ?",
+            (time.time() - timeout,)).rowcount
+
+    def count_workers(self, timeout):
+        """
+        :return: Number of the workers which heartbeaten within the last
+            `timeout` seconds.
+        :rtype: int
+        """
+        return self._execute("SELECT COUNT(*) FROM workers "
+            "WHERE heartbeat >= ?", (time.time() - timeout,)).fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+class worker(object):
+    """
+    Executes the commands from the queue, one after another.
+
+    :param queue_filename: The queue file.
+    :type queue_filename: str
+
+    :param name: Name of the worker. Defaults to the hostname and the process
+        identifier.
+    :type name: str
+
+    :param threads: Number of threads of the executed commands. By default,
+        the number requested by the workflow is used.
+    :type threads: int
+
+    :param heartbeat_interval: Interval (in seconds) of the heartbeats. Has
+        to be shorter than half of the :py:data:`HEARTBEAT_TIMEOUT`.
+    :type heartbeat_interval: float
+
+    >>> queue = work_queue('/tmp/pos_broker_test.sqlite')
+    >>> queue.submit('worker_test', ["echo 1", "exit 3"])
+    [3, 4]
+    >>> worker('/tmp/pos_broker_test.sqlite', 'test').run(idle_timeout=0)
+    2
+    >>> results = queue.collect('worker_test')
+    >>> [(r.command, r.returncode, r.stdout) for r in results.values()]
+    [('echo 1', 0, '1\\n'), ('exit 3', 3, '')]
+
+    The commands cancelled by the workflow are terminated:
+
+    >>> queue.submit('worker_test', ["sleep 10"])
+    [5]
+    >>> timer = threading.Timer(0.5, queue.cancel, ['worker_test'])
+    >>> timer.start()
+    >>> start_time = time.time()
+    >>> worker('/tmp/pos_broker_test.sqlite', 'test',
+    ...        heartbeat_interval=0.1).run(max_jobs=1)
+    1
+    >>> time.time() - start_time < 5
+    True
+
+    >>> worker('/tmp/pos_broker_test.sqlite', heartbeat_interval=60)
+    Traceback (most recent call last):
+    ...
+    ValueError: The heartbeat interval has to be shorter than 30 s.
+    """
+
+    # Interval (in seconds) of checking the queue for new commands.
+    _POLL_INTERVAL = 1.0
+
+    def __init__(self, queue_filename, name=None, threads=None,
+                 heartbeat_interval=10.0):
+        if heartbeat_interval >= HEARTBEAT_TIMEOUT / 2:
+            raise ValueError("The heartbeat interval has to be shorter than "
+                             "%g s." % (HEARTBEAT_TIMEOUT / 2))
+
+        self.queue_filename = queue_filename
+        self.name = name or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.threads = threads
+        self.heartbeat_interval = heartbeat_interval
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def run(self, max_jobs=None, idle_timeout=None):
+        """
+        Execute the commands from the queue.
+
+        :param max_jobs: Stop after executing that many commands.
+        :type max_jobs: int
+
+        :param idle_timeout: Stop when there are no commands for that many
+            seconds. By default, the worker waits for the commands forever.
+        :type idle_timeout: float
+
+        :return: Number of the executed commands.
+        :rtype: int
+        """
+        queue = work_queue(self.queue_filename)
+        self._logger.info("Worker %s waiting for commands: %s",
+                          self.name, self.queue_filename)
+        executed = 0
+        idle_since = time.time()
+        try:
+            while max_jobs is None or executed < max_jobs:
+                queue.heartbeat(self.name)
+                job = queue.claim(self.name)
+                if job is None:
+                    if idle_timeout is not None and \
+                       time.time() - idle_since >= idle_timeout:
+                        break
+                    time.sleep(self._POLL_INTERVAL)
+                    continue
+
+                self._execute(queue, *job)
+                executed += 1
+                idle_since = time.time()
+        finally:
+            queue.close()
+
+        self._logger.info("Worker %s finished after executing %d commands.",
+                          self.name, executed)
+        return executed
+
+    def _execute(self, queue, job_id, command_str, threads):
+        """
+        Execute the command while heartbeating. The command is terminated
+        when the workflow does not expect its result any more.
+        """
+        self._logger.debug("Executing command %d: %s", job_id, command_str)
+        control = pos_executors.command_control()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.heartbeat_interval):
+                if not queue.heartbeat(self.name, job_id):
+                    self._logger.warning("Command %d cancelled.", job_id)
+                    control.cancel()
+                    return
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        try:
+            result = pos_executors.run_command(command_str,
+                threads=self.threads or threads, control=control)
+        except:
+            queue.release(job_id, self.name)
+            raise
+        finally:
+            stop.set()
+            thread.join()
+
+        self._logger.debug("Command %d finished with exit code %s.",
+                           job_id, result.returncode)
+        if not queue.complete(job_id, self.name, result):
+            self._logger.warning("Result of command %d discarded, the "
+                                 "command is not expected any more.", job_id)
+
+
+class queue_executor(pos_executors.generic_executor):
+    """
+    Puts the commands into the work queue and waits for the workers to
+    execute them. The workers are started independently of the workflow with
+    the `pos_worker` script pointed to the queue file. Commands failing
+    transiently are put back into the queue (and may be executed by another
+    worker) after the retry delay.
+
+    The memory limit and the pool of the tool workers are not supported by
+    this executor. The number of threads of the commands is based on the
+    number of the CPUs of the workflow's machine, unless overridden by the
+    workers. The output capture policy is applied when the results are
+    collected from the queue.
+
+    :param queue_filename: The queue file. By default, the file is created in
+        the working directory of the workflow.
+    :type queue_filename: str
+
+    >>> import multiprocessing
+    >>> workers = [multiprocessing.Process(target=run_worker,
+    ...     args=('/tmp/pos_broker_test.sqlite',), kwargs={'idle_timeout': 2})
+    ...     for i in range(3)]
+    >>> map(lambda process: process.start(), workers) and None
+
+    >>> e = queue_executor(cpu_no=3,
+    ...                    queue_filename='/tmp/pos_broker_test.sqlite')
+    >>> results = e.run(["echo a", "sleep 0.5; echo b", "echo c 1>&2; exit 2"])
+    >>> [(r.returncode, r.stdout, r.stderr) for r in results]
+    [(0, 'a\\n', ''), (0, 'b\\n', ''), (2, '', 'c\\n')]
+
+    >>> open('/tmp/pos_broker_retry_test', 'w').write('')
+    >>> e.retries, e.retry_delay = 1, 0.1
+    >>> r = e.run(["test -s /tmp/pos_broker_retry_test || "
+    ...            "(echo 1 > /tmp/pos_broker_retry_test; kill -SEGV $$)"])[0]
+    >>> r.returncode, r.attempts
+    (0, 2)
+
+    >>> map(lambda process: process.join(), workers) and None
+    """
+
+    # Interval (in seconds) of checking the queue for the results.
+    _POLL_INTERVAL = 0.2
+
+    # Interval (in seconds) of the warnings about the lack of the workers.
+    _NO_WORKERS_WARNING_INTERVAL = 60.0
+
+    def __init__(self, queue_filename=None, **kwargs):
+        super(queue_executor, self).__init__(**kwargs)
+        self.queue_filename = queue_filename
+
+    def _get_queue_filename(self):
+        return self.queue_filename or \
+            os.path.join(self.workdir, QUEUE_FILENAME)
+
+    def _capture_output(self, result):
+        """
+        Apply the output capture policy to the result of the command.
+        """
+        if self.capture is not None:
+            output = self.capture.open(result.command)
+            output.write('stdout', result.stdout)
+            output.write('stderr', result.stderr)
+            result.stdout, result.stderr = output.close()
+        return result
+
+    def imap(self, commands):
+        commands = list(commands)
+        command_strings = map(str, commands)
+        threads = self._get_threads(len(commands))
+
+        queue_filename = self._get_queue_filename()
+        queue = work_queue(queue_filename)
+        batch = "%s:%d:%f" % (socket.gethostname(), os.getpid(), time.time())
+
+        # The most expensive commands are queued first.
+        order = self._get_order(commands)
+        job_ids = queue.submit(batch,
+            [command_strings[index] for index in order], threads)
+        indexes = dict(zip(job_ids, order))
+        attempts = [1] * len(commands)
+        self._logger.info("%d commands queued: %s",
+                          len(commands), queue_filename)
+
+        results = {}
+        next_index = 0
+        warned = time.time()
+        try:
+            while next_index < len(commands):
+                collected = queue.collect(batch)
+                if not collected:
+                    warned = self._check_workers(queue, warned)
+                    time.sleep(self._POLL_INTERVAL)
+                    continue
+
+                for job_id, result in sorted(collected.iteritems()):
+                    index = indexes.pop(job_id)
+                    if attempts[index] <= self.retries and \
+                       pos_executors.is_transient_failure(result):
+                        delay = self.retry_delay * 2 ** (attempts[index] - 1)
+                        self._logger.warning("Command failed with exit code "
+                            "%s, retrying in %.1f s (attempt %d of %d): %s",
+                            result.returncode, delay, attempts[index] + 1,
+                            self.retries + 1, result.command)
+                        job_id, = queue.submit(batch, [result.command],
+                                               threads, delay)
+                        indexes[job_id] = index
+                        attempts[index] += 1
+                        continue
+
+                    result.attempts = attempts[index]
+                    results[index] = self._capture_output(result)
+
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        finally:
+            queue.cancel(batch)
+            queue.close()
+
+    def _check_workers(self, queue, warned):
+        """
+        Put the commands of the lost workers back into the queue and warn
+        when there are no workers at all, unless warned recently.
+
+        :return: The time of the last warning.
+        :rtype: float
+        """
+        requeued = queue.requeue_stale(HEARTBEAT_TIMEOUT)
+        if requeued:
+            self._logger.warning("%d commands of the lost workers queued "
+                                 "again.", requeued)
+
+        if time.time() - warned > self._NO_WORKERS_WARNING_INTERVAL and \
+           not queue.count_workers(HEARTBEAT_TIMEOUT):
+            self._logger.warning("No workers are alive. Start the workers "
+                "with: pos_worker --queueFile %s", queue.filename)
+            return time.time()
+        return warned
+
+
+def run_worker(queue_filename, max_jobs=None, idle_timeout=None, **kwargs):
+    """
+    Run the :py:class:`worker` of the queue. The arguments of the worker are
+    passed as the keyword arguments.
+
+    :return: Number of the executed commands.
+    :rtype: int
+    """
+    return worker(queue_filename, **kwargs).run(max_jobs, idle_timeout)
+
+
+# The work queue is one of the execution backends of the workflows.
+pos_executors.executors['queue'] = queue_executor
+
+
+if __name__ == 'possum.pos_broker':
+    import doctest
+    doctest.testmod()
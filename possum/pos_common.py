@@ -1,5 +1,82 @@
 import logging
 import os
+import hashlib
+import importlib
+import collections
+
+
+class lazy_module(object):
+    """
+    A module which is imported on the first access to any of its attributes.
+    Heavy modules (the itk, numpy, scipy, networkx) are imported this way, so
+    that e.g. `--help` or `--dryRun` does not pay for importing them.
+
+    :param name: Name of the module, e.g. 'scipy.ndimage.filters'.
+    :type name: str
+
+    >>> json = lazy_module('json')
+    >>> json #doctest: +ELLIPSIS
+    <possum.pos_common.lazy_module object at 0x...>
+    >>> json.dumps([1, 2])
+    '[1, 2]'
+
+    >>> lazy_module('nonexistent_module').x
+    Traceback (most recent call last):
+    ImportError: No module named nonexistent_module
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+
+class lazy_mapping(collections.Mapping):
+    """
+    A read-only dictionary which contents are created by the `factory`
+    function on the first access. Used for the lookup tables which cannot be
+    created without importing a heavy module.
+
+    :param factory: A function returning the dictionary.
+    :type factory: callable
+
+    >>> calls = []
+    >>> d = lazy_mapping(lambda: calls.append(1) or {'a': 1})
+    >>> calls
+    []
+    >>> d['a'], 'a' in d, len(d), d.get('b')
+    (1, True, 1, None)
+    >>> calls
+    [1]
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = dict(self._factory())
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
 
 
 def get_basename(path, with_extension=False):
@@ -126,6 +203,49 @@ def flatten(lst):
         else:
                 yield x
 
+
+# Size of the chunks in which the files are read while hashing.
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# The hashes already computed. The hash of a file is reused as long as the
+# file's size and modification time do not change. At most
+# `_FILE_HASHES_LIMIT` hashes are remembered, the oldest ones are forgotten
+# first.
+_file_hashes = collections.OrderedDict()
+_FILE_HASHES_LIMIT = 100000
+
+
+def hash_file(filename):
+    """
+    Compute the hash (SHA1) of the contents of the file.
+
+    :param filename: File to hash.
+    :type filename: str
+
+    :rtype: str
+
+    >>> open('/tmp/pos_common_hash_test', 'w').write('test')
+    >>> hash_file('/tmp/pos_common_hash_test')
+    'a94a8fe5ccb19ba61c4c0873d391e987982fbbd3'
+    """
+    stat = os.stat(filename)
+    signature = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if signature in _file_hashes:
+        return _file_hashes[signature]
+
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as file_handle:
+        while True:
+            chunk = file_handle.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+
+    _file_hashes[signature] = file_hash.hexdigest()
+    while len(_file_hashes) > _FILE_HASHES_LIMIT:
+        _file_hashes.popitem(last=False)
+    return _file_hashes[signature]
+
 if __name__ == 'possum.pos_common':
     import doctest
     doctest.testmod()
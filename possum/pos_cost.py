@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Prediction of the execution time of the commands.
+
+The commands of a batch are far from equally expensive: large or heavily
+textured sections take much longer to register than the small ones. When
+such commands happen to be at the end of the batch, they run alone while the
+other CPUs are idle. Starting the most expensive commands first (the longest
+processing time first rule) keeps all the CPUs busy until the end of the
+batch. This module predicts the execution time of the commands so the
+executors (see :py:mod:`possum.pos_executors`) can order them.
+
+The execution time of a command is modelled as the amount of work the command
+does, multiplied by a rate learned per command type (the wrapper class or the
+name of the executable) from the commands executed previously. The amount of
+work is the size of the command's input images (as determined from the
+images' headers, see :py:func:`possum.pos_memory.get_image_size`) multiplied,
+for the ANTS registrations, by the number of iterations of the registration.
+"""
+
+import os
+import json
+import logging
+import threading
+
+import pos_memory
+
+# The cost of an iteration of the affine registration relative to the cost of
+# an iteration of the deformable one (the affine registration uses only a
+# sample of the image's voxels).
+_AFFINE_ITERATION_COST = 0.1
+
+# The assumed number of seconds per unit of work, used for the command types
+# which have not been observed yet. Only the relative order of the commands
+# matters, so the value is not critical.
+_DEFAULT_RATE = 1e-8
+
+# The weight of the most recent observation in the learned rates.
+_LEARNING_RATE = 0.3
+
+
+def _get_iterations(command, parameter_name):
+    """
+    Get the number of iterations of each resolution level of an ANTS
+    registration. An iteration of every coarser level costs a quarter of the
+    iteration of the next level (the levels are downsampled twice along both
+    dimensions of the slices).
+    """
+    parameters = getattr(command, 'p', None)
+    if parameters is None or parameter_name not in parameters:
+        return 0.0
+
+    iterations = parameters.peek(parameter_name).value or []
+    if not isinstance(iterations, (list, tuple)):
+        iterations = [iterations]
+
+    try:
+        levels = map(float, iterations)
+    except (TypeError, ValueError):
+        return 0.0
+    return sum(level / 4 ** (len(levels) - i - 1)
+               for i, level in enumerate(levels))
+
+
+def get_command_work(command):
+    """
+    Estimate the amount of work done by the command: the size of its input
+    images times the (weighted) number of iterations of the registration.
+
+    :param command: The command.
+    :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+    :rtype: float
+
+    >>> import pos_wrappers
+    >>> open('/tmp/pos_cost_test.txt', 'w').write('x' * 100)
+    >>> command = pos_wrappers.ants_registration(outputNaming='/tmp/out_',
+    ...     iterations=[100, 100], affineIterations=[1000],
+    ...     imageMetrics=[pos_wrappers.ants_intensity_meric(
+    ...         fixed_image='/tmp/pos_cost_test.txt',
+    ...         moving_image='/tmp/pos_cost_test.txt')])
+    >>> get_command_work(command)
+    45000.0
+
+    Commands which do not declare their inputs do a single unit of work:
+
+    >>> get_command_work("echo 1")
+    1.0
+    """
+    get_input_files = getattr(command, 'get_input_files', None)
+    input_files = get_input_files and get_input_files() or []
+    work = float(sum(map(pos_memory.get_image_size, input_files)) or 1)
+
+    iterations = _get_iterations(command, 'iterations') + \
+        _AFFINE_ITERATION_COST * _get_iterations(command, 'affineIterations')
+    return work * max(iterations, 1.0)
+
+
+class cost_model(object):
+    """
+    Predicts the execution time (in seconds) of the commands. The rates
+    (seconds per unit of work, see :py:func:`get_command_work`) are learned
+    per command type from the wall times of the executed commands and kept in
+    the `filename` JSON file (if provided), so the predictions improve from
+    run to run.
+
+    :param filename: File holding the learned model. Created on
+        :py:meth:`save`.
+    :type filename: str
+
+    >>> import pos_executors
+    >>> model = cost_model()
+    >>> model.estimate("sleep 10") == _DEFAULT_RATE
+    True
+
+    >>> model.record("sleep 10", pos_executors.command_result("sleep 10", 0,
+    ...     start_time=0.0, end_time=10.0))
+    >>> model.estimate("sleep 10")
+    10.0
+
+    Subsequent observations are averaged:
+
+    >>> model.record("sleep 20", pos_executors.command_result("sleep 20", 0,
+    ...     start_time=0.0, end_time=20.0))
+    >>> model.estimate("sleep 30")
+    13.0
+
+    >>> model.filename = '/tmp/pos_cost_test_model.json'
+    >>> model.save()
+    >>> cost_model('/tmp/pos_cost_test_model.json').estimate("sleep 1")
+    13.0
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+
+        # The learned rates (seconds per unit of work) per command type.
+        self._rates = {}
+        self._load()
+
+    def _load(self):
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+
+        try:
+            model = json.load(open(self.filename))
+        except ValueError:
+            self._logger.warning("Ignoring invalid cost model: %s",
+                                 self.filename)
+            return
+
+        self._rates = model.get('rates', {})
+        self._logger.info("Cost model of %d command types loaded: %s",
+                          len(self._rates), self.filename)
+
+    def save(self):
+        """
+        Write the learned model into the model file.
+        """
+        if not self.filename:
+            return
+
+        with self._lock:
+            model = {'rates': self._rates}
+            temp_filename = self.filename + '.%d.tmp' % os.getpid()
+            json.dump(model, open(temp_filename, 'w'), indent=1, sort_keys=True)
+            os.rename(temp_filename, self.filename)
+
+    def estimate(self, command):
+        """
+        Predict the execution time of the command.
+
+        :param command: The command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The predicted execution time in seconds.
+        :rtype: float
+        """
+        command_type = pos_memory.get_command_type(command)
+        with self._lock:
+            rate = self._rates.get(command_type, _DEFAULT_RATE)
+        return rate * get_command_work(command)
+
+    def record(self, command, result):
+        """
+        Update the model with the execution time of the command.
+
+        :param command: The executed command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+        """
+        if result.cached or result.wall_time is None:
+            return
+
+        command_type = pos_memory.get_command_type(command)
+        rate = result.wall_time / get_command_work(command)
+
+        with self._lock:
+            previous = self._rates.get(command_type)
+            if previous is not None:
+                rate = previous + _LEARNING_RATE * (rate - previous)
+            self._rates[command_type] = rate
+
+    def order(self, commands):
+        """
+        Order the commands from the most to the least expensive one. Commands
+        of equal cost keep their order.
+
+        :return: Indexes of the commands in the order of execution.
+        :rtype: list of ints
+
+        >>> cost_model().order(["echo 1", "ls x.txt", "echo 2"])
+        [0, 1, 2]
+        """
+        estimates = map(self.estimate, commands)
+        return sorted(range(len(estimates)), key=lambda i: -estimates[i])
+
+
+if __name__ == 'possum.pos_cost':
+    import doctest
+    doctest.testmod()
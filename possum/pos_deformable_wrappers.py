@@ -33,6 +33,9 @@ class blank_slice_deformation_wrapper(pos_wrappers.generic_wrapper):
         'output_image'  : filename_parameter('output_image', None),
             }
 
+    _input_files = ['input_image']
+    _output_files = ['output_image']
+
 
 class convert_slice_image(pos_wrappers.generic_wrapper):
     _template = """c{dimension}d -mcs {input_image}\
@@ -47,6 +50,9 @@ class convert_slice_image(pos_wrappers.generic_wrapper):
             'spacing' : vector_parameter('spacing', None, '-spacing {_list}mm')
             }
 
+    _input_files = ['input_image']
+    _output_files = ['output_image']
+
 
 class convert_slice_image_grayscale(pos_wrappers.generic_wrapper):
     _template = """c{dimension}d {input_image}\
@@ -60,3 +66,6 @@ class convert_slice_image_grayscale(pos_wrappers.generic_wrapper):
             'scaling'       : value_parameter('scaling', None, "-scale {_value}"),
             'spacing' : vector_parameter('spacing', None, '-spacing {_list}mm')
             }
+
+    _input_files = ['input_image']
+    _output_files = ['output_image']
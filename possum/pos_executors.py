@@ -0,0 +1,1530 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Execution backends for the batches of commands issued by the workflows.
+
+An executor takes a batch of commands (usually command line wrappers, but
+plain strings are fine as well), runs them and reports the outcome of each
+command separately -- its exit code, stdout, stderr and the wall time. The
+results are always returned in the same order as the commands were provided,
+even when the commands are executed in parallel.
+"""
+
+import os
+import sys
+import time
+import Queue
+import errno
+import select
+import shutil
+import signal
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+import multiprocessing
+import subprocess as sub
+from multiprocessing.pool import ThreadPool
+
+import pos_common
+import pos_memory
+
+
+class command_result(object):
+    """
+    The outcome of a single command executed by one of the executors.
+
+    >>> r = command_result("echo test", 0, "test\\n", "", 10.0, 10.5)
+    >>> r #doctest: +ELLIPSIS
+    <possum.pos_executors.command_result object at 0x...>
+
+    >>> r.command
+    'echo test'
+
+    >>> r.returncode, r.stdout, r.stderr
+    (0, 'test\\n', '')
+
+    >>> r.wall_time
+    0.5
+
+    >>> r.success
+    True
+
+    >>> command_result("false", 1).success
+    False
+
+    >>> command_result("sleep 1").wall_time
+
+    >>> r.cached
+    False
+
+    >>> r.resources
+
+    >>> r.attempts
+    1
+    """
+
+    def __init__(self, command, returncode=None, stdout='', stderr='',
+                 start_time=None, end_time=None, cached=False,
+                 resources=None, attempts=1):
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.start_time = start_time
+        self.end_time = end_time
+
+        # Set when the result was restored from the cache instead of actually
+        # executing the command.
+        self.cached = cached
+
+        # Resources consumed by the command (see :py:func:`run_command`) or
+        # `None` when the information is not available.
+        self.resources = resources
+
+        # Number of times the command was executed (see
+        # :py:func:`run_with_retries`).
+        self.attempts = attempts
+
+    def _get_wall_time(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def _get_success(self):
+        return self.returncode == 0
+
+    wall_time = property(_get_wall_time)
+    """ Time elapsed between starting and finishing the command (in seconds). """
+
+    success = property(_get_success)
+    """ `True` if the command exited with zero exit code. """
+
+
+class _accounted_popen(sub.Popen):
+    """
+    A :py:class:`subprocess.Popen` which reaps the child process with
+    `os.wait4` in order to collect the resources used by the process. The
+    resource usage of the command's own children (e.g. the processes started
+    by the shell) is included as well.
+    """
+
+    rusage = None
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Somebody else has already reaped the process.
+                self.returncode = 0
+                break
+            if pid == self.pid:
+                self.rusage = rusage
+                self._handle_exitstatus(status)
+        return self.returncode
+
+
+def _get_resources(rusage):
+    """
+    Extract the resources used by a process from its resource usage
+    structure. The I/O is reported in blocks of 512 bytes.
+    """
+    if rusage is None:
+        return None
+
+    return {'user_time': rusage.ru_utime,
+            'system_time': rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss,
+            'read_bytes': rusage.ru_inblock * 512,
+            'write_bytes': rusage.ru_oublock * 512}
+
+
+# Size of the chunks of the commands' output read at once.
+_CHUNK_SIZE = 64 * 1024
+
+# The environment variable setting the number of threads used by ITK based
+# programs (ANTS, WarpImageMultiTransform, c2d, as well as the python tools
+# using the itk).
+THREADS_VARIABLE = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
+
+
+def get_threads_per_job(cpu_no, jobs_no):
+    """
+    Split the CPUs between the jobs executed concurrently. A batch with at
+    least as many jobs as there are CPUs is executed with single-threaded
+    jobs, while the CPUs are distributed over the jobs of a smaller batch.
+
+    :param cpu_no: Number of CPUs available.
+    :type cpu_no: int
+
+    :param jobs_no: Number of jobs in the batch.
+    :type jobs_no: int
+
+    :return: Number of threads for each job.
+    :rtype: int
+
+    >>> get_threads_per_job(8, 200), get_threads_per_job(8, 8)
+    (1, 1)
+    >>> get_threads_per_job(8, 3), get_threads_per_job(8, 1)
+    (2, 8)
+    >>> get_threads_per_job(1, 0)
+    1
+    """
+    jobs_no = max(1, min(cpu_no, jobs_no))
+    return max(1, cpu_no // jobs_no)
+
+
+class _tail_buffer(object):
+    """
+    Keeps the last `size` bytes of the data written into it (or all the data
+    when the `size` is `None`).
+
+    >>> b = _tail_buffer(5)
+    >>> b.write('abc'); b.write('defg'); b.write('h')
+    >>> b.getvalue()
+    'defgh'
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self._chunks = []
+        self._length = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        if self.size is None:
+            return
+        while len(self._chunks) > 1 and \
+              self._length - len(self._chunks[0]) >= self.size:
+            self._length -= len(self._chunks.pop(0))
+
+    def getvalue(self):
+        value = "".join(self._chunks)
+        if self.size is not None:
+            value = value[max(0, len(value) - self.size):]
+        return value
+
+
+class _command_output(object):
+    """
+    The output of a single command, captured according to the
+    :py:class:`output_capture` policy.
+    """
+
+    def __init__(self, capture, command_str):
+        self._capture = capture
+        self._stdout = _tail_buffer(capture.tail_size)
+        self._stderr = _tail_buffer(capture.tail_size)
+        self._log = None
+        self.log_filename = capture.get_log_filename(command_str)
+        if self.log_filename:
+            self._log = open(self.log_filename, 'wb')
+            self._log.write("# %s\n" % command_str)
+
+    def write(self, stream, data):
+        """
+        Process a chunk of the command's `stream` ('stdout' or 'stderr').
+        """
+        if stream == 'stdout':
+            self._stdout.write(data)
+        else:
+            self._stderr.write(data)
+
+        if self._log is not None:
+            self._log.write(data)
+            if self._log.tell() > self._capture.max_log_size:
+                self._rotate_log()
+
+    def _rotate_log(self):
+        self._log.close()
+        os.rename(self.log_filename, self.log_filename + '.1')
+        self._log = open(self.log_filename, 'wb')
+
+    def close(self):
+        """
+        Finish capturing the output.
+
+        :return: The captured (stdout, stderr) tuple.
+        :rtype: tuple of strings
+        """
+        if self._log is not None:
+            self._log.close()
+        return self._stdout.getvalue(), self._stderr.getvalue()
+
+
+class output_capture(object):
+    """
+    The policy of capturing the output of the executed commands. Instead of
+    keeping the whole output of every command in memory, the output is
+    processed while the command runs: only the last `tail_size` bytes of the
+    stdout and of the stderr are kept (enough for reporting the errors and for
+    parsing the results of the commands which print them), while the complete
+    output is either streamed into the log files in the `log_dir` directory or
+    discarded.
+
+    Every command gets its own log file, named after the checksum of the
+    command. Once a log file grows beyond `max_log_size` bytes, it is rotated:
+    the current file is renamed with the '.1' suffix (replacing the previous
+    backup) and a new log file is started.
+
+    :param tail_size: Number of bytes of each of the output streams of a
+        command to keep in memory. All the output is kept if `None`.
+    :type tail_size: int
+
+    :param log_dir: Directory of the log files. The output is not logged if
+        `None`.
+    :type log_dir: str
+
+    :param max_log_size: Size (in bytes) above which the logs are rotated.
+    :type max_log_size: int
+
+    >>> import shutil
+    >>> shutil.rmtree('/tmp/pos_output_capture_test', True)
+    >>> capture = output_capture(tail_size=6,
+    ...                          log_dir='/tmp/pos_output_capture_test')
+    >>> r = run_command("seq 1 1000; echo error >&2", capture=capture)
+    >>> r.stdout, r.stderr
+    ('\\n1000\\n', 'error\\n')
+
+    >>> log_filename = capture.get_log_filename(r.command)
+    >>> lines = open(log_filename).read().splitlines()
+    >>> lines[0], lines[1], lines[1000], lines[-1]
+    ('# seq 1 1000; echo error >&2', '1', '1000', 'error')
+
+    >>> capture.max_log_size = 100
+    >>> r = run_command("seq 1 1000", capture=capture)
+    >>> log_filename = capture.get_log_filename(r.command)
+    >>> os.path.getsize(log_filename) < 4000
+    True
+    >>> os.path.isfile(log_filename + '.1')
+    True
+    """
+
+    def __init__(self, tail_size=None, log_dir=None,
+                 max_log_size=100 * 1024 ** 2):
+        self.tail_size = tail_size
+        self.log_dir = log_dir
+        self.max_log_size = max_log_size
+
+    def get_log_filename(self, command_str):
+        """
+        Get the name of the log file of the command. `None` when the output
+        is not logged.
+        """
+        if not self.log_dir:
+            return None
+        if not os.path.isdir(self.log_dir):
+            try:
+                os.makedirs(self.log_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        name = hashlib.sha1(command_str).hexdigest()[:16]
+        return os.path.join(self.log_dir, name + '.log')
+
+    def open(self, command_str):
+        """
+        Start capturing the output of a command.
+
+        :rtype: :py:class:`_command_output`
+        """
+        return _command_output(self, command_str)
+
+
+def _stream_output(process, output):
+    """
+    Pass the stdout and stderr of the `process` to the `output`, chunk by
+    chunk, until the process closes both of them.
+    """
+    streams = {process.stdout.fileno(): 'stdout',
+               process.stderr.fileno(): 'stderr'}
+    poller = select.poll()
+    for fd in streams:
+        poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+
+    while streams:
+        try:
+            events = poller.poll()
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, event in events:
+            data = os.read(fd, _CHUNK_SIZE)
+            if data:
+                output.write(streams[fd], data)
+            else:
+                poller.unregister(fd)
+                del streams[fd]
+
+    process.stdout.close()
+    process.stderr.close()
+
+
+class command_control(object):
+    """
+    Allows to terminate a command executed by :py:func:`run_command` from
+    another thread. The command is executed in its own process group, so all
+    the processes started by the command are terminated.
+
+    >>> control = command_control()
+    >>> thread = threading.Thread(target=lambda:
+    ...     results.append(run_command("sleep 10", control=control)))
+    >>> results = []
+    >>> thread.start()
+    >>> while control.start_time is None: time.sleep(0.01)
+    >>> control.cancel()
+    >>> thread.join()
+    >>> results[0].returncode, results[0].wall_time < 10
+    (-15, True)
+
+    Commands cancelled before they are started are not executed at all:
+
+    >>> run_command("echo 1", control=control).stderr
+    'Cancelled.\\n'
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.start_time = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def attach(self, process):
+        """
+        Take control over the process executing the command.
+        """
+        with self._lock:
+            self._process = process
+            self.start_time = time.time()
+            if self.cancelled:
+                self._terminate()
+
+    def cancel(self):
+        """
+        Terminate the command (or prevent it from being started).
+        """
+        with self._lock:
+            self.cancelled = True
+            if self._process is not None:
+                self._terminate()
+
+    def _terminate(self):
+        try:
+            os.killpg(self._process.pid, signal.SIGTERM)
+        except OSError:
+            # The command has already finished.
+            pass
+
+
+def run_command(command_str, shell_trace=False, threads=None, capture=None,
+                control=None):
+    """
+    Execute a single command in a shell and collect its outcome.
+
+    :param command_str: Command to execute.
+    :type command_str: str
+
+    :param shell_trace: When set, the command is executed by `bash -x` so
+        that the stderr contains the execution trace (just like when executing
+        a batch file by `bash -x`).
+    :type shell_trace: bool
+
+    :param threads: Number of threads the ITK based programs executed by the
+        command are allowed to use. By default, ITK uses all the CPUs.
+    :type threads: int
+
+    :param capture: The policy of capturing the output of the command. By
+        default, the whole output is kept in memory.
+    :type capture: :py:class:`output_capture`
+
+    :param control: Allows to terminate the command from another thread.
+    :type control: :py:class:`command_control`
+
+    :return: The outcome of the command, including the resources used by
+        the command: CPU user and system time (in seconds), peak resident set
+        size (in kilobytes) and the number of bytes read from and written to
+        the disk.
+    :rtype: :py:class:`command_result`
+
+    >>> r = run_command("echo Hello")
+    >>> r.returncode, r.stdout, r.stderr
+    (0, 'Hello\\n', '')
+
+    >>> r.wall_time >= 0
+    True
+
+    >>> sorted(r.resources.keys())
+    ['max_rss', 'read_bytes', 'system_time', 'user_time', 'write_bytes']
+
+    >>> r = run_command("python -c 'x = sum(range(10 ** 6))'")
+    >>> r.resources['max_rss'] > 0 and r.resources['user_time'] > 0
+    True
+
+    >>> run_command("echo error 1>&2; exit 3").returncode
+    3
+
+    >>> run_command("echo error 1>&2; exit 3").stderr
+    'error\\n'
+
+    >>> run_command("sleep 0", shell_trace=True).stderr
+    '+ sleep 0\\n'
+
+    >>> run_command("echo $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", threads=2).stdout
+    '2\\n'
+    """
+
+    start_time = time.time()
+    if control is not None and control.cancelled:
+        return command_result(command_str, stderr="Cancelled.\n",
+                              start_time=start_time, end_time=start_time)
+
+    env = None
+    if threads:
+        env = dict(os.environ)
+        env[THREADS_VARIABLE] = str(threads)
+
+    # A controlled command gets its own process group, so it can be
+    # terminated together with its children.
+    preexec_fn = control is not None and os.setsid or None
+    if shell_trace:
+        process = _accounted_popen(['bash', '-x', '-c', command_str],
+                            stdout=sub.PIPE, stderr=sub.PIPE, close_fds=True,
+                            env=env, preexec_fn=preexec_fn)
+    else:
+        process = _accounted_popen(command_str, stdout=sub.PIPE,
+                            stderr=sub.PIPE, shell=True, close_fds=True,
+                            env=env, preexec_fn=preexec_fn)
+    if control is not None:
+        control.attach(process)
+
+    if capture is None:
+        stdout, stderr = process.communicate()
+    else:
+        output = capture.open(command_str)
+        try:
+            _stream_output(process, output)
+        finally:
+            stdout, stderr = output.close()
+        process.wait()
+
+    return command_result(command_str, process.returncode, stdout, stderr,
+                          start_time, time.time(),
+                          resources=_get_resources(process.rusage))
+
+
+def is_transient_failure(result):
+    """
+    Check if the command failed in a way which does not have to repeat when
+    the command is executed again: the command was killed by a signal (e.g.
+    it crashed with a segmentation fault or was killed by the out-of-memory
+    killer). The shell reports such commands with exit codes above 128.
+
+    :param result: The outcome of the command.
+    :type result: :py:class:`command_result`
+
+    :rtype: bool
+
+    >>> is_transient_failure(command_result("ANTS", -11))
+    True
+    >>> is_transient_failure(command_result("c2d; echo", 139))
+    True
+    >>> is_transient_failure(command_result("c2d", 1))
+    False
+    >>> is_transient_failure(command_result("c2d", 0))
+    False
+
+    Commands which were not executed at all are not retried either:
+
+    >>> is_transient_failure(command_result("c2d"))
+    False
+    """
+    return result.returncode is not None and \
+        (result.returncode < 0 or result.returncode > 128)
+
+
+def run_with_retries(run, retries=0, retry_delay=1.0, control=None):
+    """
+    Execute a command with the `run` function and execute it again, up to
+    `retries` times, as long as it fails transiently (see
+    :py:func:`is_transient_failure`). The delay between the attempts starts
+    at `retry_delay` seconds and doubles with every attempt.
+
+    :param run: Executes the command and returns its result.
+    :type run: callable returning :py:class:`command_result`
+
+    :param retries: The maximum number of additional attempts.
+    :type retries: int
+
+    :param retry_delay: Delay (in seconds) before the first retry.
+    :type retry_delay: float
+
+    :param control: The control of the command. Terminated commands are not
+        retried.
+    :type control: :py:class:`command_control`
+
+    >>> open('/tmp/pos_retry_test', 'w').write('')
+    >>> crash_once = "test -s /tmp/pos_retry_test || " \\
+    ...     "(echo 1 > /tmp/pos_retry_test; kill -SEGV $$)"
+    >>> r = run_with_retries(lambda: run_command(crash_once), 2, 0.01)
+    >>> r.returncode, r.attempts
+    (0, 2)
+
+    >>> r = run_with_retries(lambda: run_command("kill -KILL $$"), 2, 0.01)
+    >>> r.returncode, r.attempts
+    (-9, 3)
+
+    >>> r = run_with_retries(lambda: run_command("exit 1"), 2, 0.01)
+    >>> r.returncode, r.attempts
+    (1, 1)
+    """
+    result = run()
+    attempt = 1
+    while attempt <= retries and is_transient_failure(result) and \
+            not (control is not None and control.cancelled):
+        delay = retry_delay * 2 ** (attempt - 1)
+        logging.getLogger('run_with_retries').warning(
+            "Command failed with exit code %s, retrying in %.1f s "
+            "(attempt %d of %d): %s", result.returncode, delay, attempt + 1,
+            retries + 1, result.command)
+        time.sleep(delay)
+        result = run()
+        attempt += 1
+
+    result.attempts = attempt
+    return result
+
+
+def run_within_budget(command_str, memory, budget=None, threads=None,
+                      tool_pool=None, capture=None, control=None, retries=0,
+                      retry_delay=1.0):
+    """
+    Execute a single command (see :py:func:`run_command`) once the `memory`
+    it is expected to use is reserved in the memory `budget`.
+
+    :param memory: The predicted memory usage of the command in bytes.
+    :type memory: int
+
+    :param budget: The budget of the memory or `None` to execute the command
+        immediately.
+    :type budget: :py:class:`possum.pos_memory.memory_budget`
+
+    :param threads: Number of threads of the command (see
+        :py:func:`run_command`).
+    :type threads: int
+
+    :param tool_pool: The pool of workers executing possum's python tools
+        in-process. Other commands are executed in a separate process anyway.
+    :type tool_pool: :py:class:`possum.pos_tool_pool.tool_pool`
+
+    :param capture: The policy of capturing the output of the command.
+    :type capture: :py:class:`output_capture`
+
+    :param control: Allows to terminate the command (see
+        :py:class:`command_control`). The commands executed by the
+        `tool_pool` cannot be terminated.
+    :type control: :py:class:`command_control`
+
+    :param retries: The maximum number of additional attempts of the command
+        failing transiently (see :py:func:`run_with_retries`). The memory is
+        released while waiting for the next attempt.
+    :type retries: int
+
+    :param retry_delay: Delay (in seconds) before the first retry.
+    :type retry_delay: float
+
+    >>> budget = pos_memory.memory_budget(1024)
+    >>> run_within_budget("echo 1", 4096, budget).stdout
+    '1\\n'
+    >>> budget.used
+    0
+    """
+    run = tool_pool and tool_pool.run or run_command
+
+    def run_once():
+        if budget is None:
+            return run(command_str, threads=threads, capture=capture,
+                       control=control)
+
+        reserved = budget.acquire(memory)
+        try:
+            return run(command_str, threads=threads, capture=capture,
+                       control=control)
+        finally:
+            budget.release(reserved)
+
+    return run_with_retries(run_once, retries, retry_delay, control)
+
+
+# The types of the commands short enough to be bundled into chunks (see
+# :py:func:`is_short_command`).
+_SHORT_COMMAND_TYPES = frozenset(['image_voxel_count_wrapper',
+    'image_similarity_wrapper', 'chain_affine_transforms',
+    'ants_compose_multi_transform', 'blank_slice_deformation_wrapper'])
+
+
+def is_short_command(command):
+    """
+    Check if the command is one of the short commands which may be bundled
+    into chunks (see :py:func:`run_chunk`): counting the voxels, measuring
+    the similarity, composing the affine transformations or generating the
+    blank deformation fields. Composing the deformation fields is not short.
+
+    :param command: The command.
+    :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+    :rtype: bool
+
+    >>> import pos_wrappers
+    >>> is_short_command(pos_wrappers.ants_compose_multi_transform(
+    ...     output_image='out.txt', affine_list=['a.txt', 'b.txt']))
+    True
+    >>> is_short_command(pos_wrappers.ants_compose_multi_transform(
+    ...     output_image='out.nii.gz', deformable_list=['warp.nii.gz']))
+    False
+    >>> is_short_command(pos_wrappers.touch_wrapper(files=['x']))
+    False
+    >>> is_short_command("c2d a.nii.gz -voxel-sum")
+    False
+    """
+    command_type = pos_memory.get_command_type(command)
+    if command_type not in _SHORT_COMMAND_TYPES:
+        return False
+    if command_type == 'ants_compose_multi_transform':
+        return not command.p.peek('deformable_list').value
+    return True
+
+
+def run_chunk(command_strs, threads=None, capture=None):
+    """
+    Execute several commands, one after another, with a single shell (the
+    same one :py:func:`run_command` uses). Every command runs in a subshell
+    of its own, so it cannot affect the other commands, but no new shell is
+    started for every command. The outputs, the exit codes and the timings
+    are still recorded for every command separately. The resources used by
+    the chunk are split evenly between the commands, except for the maximum
+    resident set size, which is the one of the largest command of the chunk.
+
+    :param command_strs: Commands to execute.
+    :type command_strs: list of strings
+
+    :param threads: Number of threads of the commands (see
+        :py:func:`run_command`).
+    :type threads: int
+
+    :param capture: The policy of capturing the output of the commands.
+    :type capture: :py:class:`output_capture`
+
+    :return: The outcomes of the commands.
+    :rtype: list of :py:class:`command_result`
+
+    >>> results = run_chunk(["echo 1", "echo 2 1>&2; exit 3", "echo 3"])
+    >>> [(r.command, r.returncode, r.stdout, r.stderr) for r in results]
+    [('echo 1', 0, '1\\n', ''), ('echo 2 1>&2; exit 3', 3, '', '2\\n'), ('echo 3', 0, '3\\n', '')]
+    >>> results[0].end_time <= results[1].start_time
+    True
+    >>> sorted(results[0].resources)
+    ['max_rss', 'read_bytes', 'system_time', 'user_time', 'write_bytes']
+
+    The exit codes are reported as they are, just as by
+    :py:func:`run_command`:
+
+    >>> [r.returncode for r in run_chunk(["exit 200", "exit 130"])]
+    [200, 130]
+
+    >>> results = run_chunk(["echo $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"], 3)
+    >>> results[0].stdout
+    '3\\n'
+
+    >>> capture = output_capture(tail_size=6)
+    >>> [r.stdout for r in run_chunk(["seq 1 1000", "echo 1"], capture=capture)]
+    ['\\n1000\\n', '1\\n']
+    """
+    directory = tempfile.mkdtemp(prefix='pos_chunk_')
+    try:
+        script = []
+        for i, command_str in enumerate(command_strs):
+            prefix = os.path.join(directory, str(i))
+            script.append('printf "%%s\\n" "${EPOCHREALTIME:-}" > %s.start\n'
+                          '(\n%s\n) > %s.out 2> %s.err < /dev/null\n'
+                          'printf "%%s %%s\\n" "$?" "${EPOCHREALTIME:-}" '
+                          '> %s.status\n' % (prefix, command_str, prefix,
+                                              prefix, prefix))
+        script_filename = os.path.join(directory, 'chunk.sh')
+        open(script_filename, 'w').write("".join(script))
+
+        chunk_result = run_command("/bin/sh %s" % script_filename,
+                                   threads=threads)
+        return [_read_chunk_result(command_str,
+                                   os.path.join(directory, str(i)),
+                                   chunk_result, i, len(command_strs),
+                                   capture)
+                for i, command_str in enumerate(command_strs)]
+    finally:
+        shutil.rmtree(directory, True)
+
+
+def _read_chunk_result(command_str, prefix, chunk_result, position,
+                       chunk_size, capture=None):
+    """
+    Read the outcome of the command at the `position` within the chunk (see
+    :py:func:`run_chunk`). Without the high resolution timestamps (shells
+    other than bash 5), the commands are assumed to have taken equal parts
+    of the time of the whole chunk, one after another. The outputs of the
+    command are streamed through the `capture` policy, so they are never
+    read into memory as a whole.
+    """
+    try:
+        start = open(prefix + '.start').read().strip()
+        returncode, end = (open(prefix + '.status').read().split() + [''])[:2]
+        if capture is None:
+            stdout = open(prefix + '.out').read()
+            stderr = open(prefix + '.err').read()
+        else:
+            output = capture.open(command_str)
+            for stream, extension in [('stdout', '.out'), ('stderr', '.err')]:
+                with open(prefix + extension, 'rb') as output_file:
+                    for chunk in iter(lambda: output_file.read(_CHUNK_SIZE),
+                                      ''):
+                        output.write(stream, chunk)
+            stdout, stderr = output.close()
+    except IOError:
+        return command_result(command_str, stderr="Not executed: the chunk "
+            "of commands failed.\n" + chunk_result.stderr)
+
+    if start and end:
+        start_time, end_time = float(start), float(end)
+    else:
+        duration = chunk_result.wall_time / chunk_size
+        start_time = chunk_result.start_time + position * duration
+        end_time = start_time + duration
+
+    resources = None
+    if chunk_result.resources:
+        resources = dict((name, value / float(chunk_size))
+                         for name, value in chunk_result.resources.items()
+                         if value is not None)
+        resources['max_rss'] = chunk_result.resources.get('max_rss')
+
+    return command_result(command_str, int(returncode), stdout, stderr,
+                          start_time, end_time, resources=resources)
+
+
+class generic_executor(object):
+    """
+    A generic executor. Not really usefull by itself, subclass it in order
+    to provide an actual execution backend. Subclasses have to implement the
+    :py:meth:`imap` method.
+
+    :param cpu_no: Number of commands executed concurrently.
+    :type cpu_no: int
+
+    :param workdir: Working directory of the workflow. The executors may use
+        it to store some temporary files.
+    :type workdir: str
+
+    :param memory_limit: Maximum amount of memory (in bytes) the commands
+        executed concurrently are expected to use. Executors which support
+        the limit do not start a command until enough memory is available.
+    :type memory_limit: int
+
+    :param memory_model: Predicts the memory usage of the commands. Required
+        when the `memory_limit` is set.
+    :type memory_model: :py:class:`possum.pos_memory.memory_model`
+
+    :param threads_per_job: Number of threads each command is allowed to
+        use. By default, the CPUs are split between the commands of the batch
+        (see :py:func:`get_threads_per_job`).
+    :type threads_per_job: int
+
+    :param tool_pool: The pool of workers executing possum's python tools
+        in-process. Executors which support the pool use it for the commands
+        the pool accepts.
+    :type tool_pool: :py:class:`possum.pos_tool_pool.tool_pool`
+
+    :param capture: The policy of capturing the output of the commands. By
+        default, the whole output is kept in memory.
+    :type capture: :py:class:`output_capture`
+
+    :param cost_model: Predicts the execution time of the commands. Parallel
+        executors start the most expensive commands first, so the long
+        commands do not end up running alone at the end of the batch. By
+        default, the commands are started in the order they were provided.
+    :type cost_model: :py:class:`possum.pos_cost.cost_model`
+
+    :param retries: The maximum number of additional attempts of the
+        commands failing transiently, e.g. crashing with a segmentation fault
+        (see :py:func:`run_with_retries`).
+    :type retries: int
+
+    :param retry_delay: Delay (in seconds) before the first retry of a
+        command. The delay doubles with every subsequent attempt.
+    :type retry_delay: float
+
+    :param chunk_duration: Executors which support the chunks bundle the
+        short commands into chunks executed by a single shell (see
+        :py:func:`run_chunk`), as long as the expected duration of the chunk,
+        based on the durations of the commands executed so far, does not
+        exceed `chunk_duration` seconds. Disabled by default.
+    :type chunk_duration: float
+
+    :param speculation: Executors which support the speculative execution
+        start a differently configured copy of a command (see
+        :py:meth:`possum.pos_wrappers.generic_wrapper.get_speculative_variant`)
+        running more than `speculation` times longer than the median of the
+        commands of the same type, once there are free CPUs. The copy which
+        finishes first wins, the other one is terminated. Disabled by
+        default.
+    :type speculation: float
+
+    >>> generic_executor().run(["echo 1"])
+    Traceback (most recent call last):
+    NotImplementedError: Virtual method executed.
+    """
+
+    def __init__(self, cpu_no=1, workdir=None, memory_limit=None,
+                 memory_model=None, threads_per_job=None, tool_pool=None,
+                 capture=None, cost_model=None, retries=0, retry_delay=1.0,
+                 chunk_duration=None, speculation=None):
+        self.cpu_no = cpu_no
+        self.workdir = workdir
+        self.memory_limit = memory_limit
+        self.memory_model = memory_model
+        self.threads_per_job = threads_per_job
+        self.tool_pool = tool_pool
+        self.capture = capture
+        self.cost_model = cost_model
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.chunk_duration = chunk_duration
+        self.speculation = speculation
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _get_order(self, commands):
+        """
+        Get the order in which the commands are started: the most expensive
+        ones first when the cost model is provided.
+
+        :return: Indexes of the commands.
+        :rtype: list of ints
+        """
+        if self.cost_model is None:
+            return range(len(commands))
+        return self.cost_model.order(commands)
+
+    def _get_threads(self, jobs_no):
+        """
+        Get the number of threads of each of the `jobs_no` commands executed
+        concurrently.
+        """
+        threads = self.threads_per_job or \
+            get_threads_per_job(self.cpu_no, jobs_no)
+        self._logger.debug("Executing %d commands with %d threads each.",
+                           jobs_no, threads)
+        return threads
+
+    def _get_memory_budget(self, commands):
+        """
+        Predict the memory usage of the commands and set up the budget
+        limiting their concurrent execution. Returns the (predictions, budget)
+        tuple. The budget is `None` when the memory limit is not set.
+        """
+        if not self.memory_limit or self.memory_model is None:
+            return [0] * len(commands), None
+
+        estimates = map(self.memory_model.estimate, commands)
+        self._logger.debug("Predicted memory usage: %d MB total, %d MB max.",
+            sum(estimates) / 1024 ** 2, max(estimates or [0]) / 1024 ** 2)
+        return estimates, pos_memory.memory_budget(self.memory_limit)
+
+    def imap(self, commands):
+        """
+        Execute the commands and yield their results, one by one, as soon as
+        they become available. The results are yielded in the order of the
+        commands.
+
+        :param commands: Commands to be executed
+        :type commands: iterable of strings or command wrappers
+        """
+        raise NotImplementedError, "Virtual method executed."
+
+    def run(self, commands):
+        """
+        Execute the commands and return all the results at once.
+
+        :param commands: Commands to be executed
+        :type commands: iterable of strings or command wrappers
+
+        :rtype: list of :py:class:`command_result`
+        """
+        return list(self.imap(commands))
+
+
+class serial_executor(generic_executor):
+    """
+    Executes the commands one after another, each one with `bash -x`. As only
+    a single command runs at a time, the command may use all the `cpu_no`
+    CPUs.
+
+    >>> results = serial_executor().run(["echo 1", "echo 2; exit 1"])
+    >>> [(r.returncode, r.stdout) for r in results]
+    [(0, '1\\n'), (1, '2\\n')]
+
+    >>> results[0].stderr
+    '+ echo 1\\n'
+    """
+
+    def imap(self, commands):
+        threads = self.threads_per_job or self.cpu_no
+        for command_str in map(str, commands):
+            yield run_with_retries(lambda: run_command(command_str,
+                shell_trace=True, threads=threads, capture=self.capture),
+                self.retries, self.retry_delay)
+
+
+class pool_executor(generic_executor):
+    """
+    Executes the commands using a pool of `cpu_no` workers. The workers are
+    threads as every command is spawned as a separate process anyway. The
+    results are streamed back in the order of the commands as soon as
+    consecutive commands finish.
+
+    >>> e = pool_executor(cpu_no=3)
+    >>> results = e.run(["echo a", "sleep 0.5; echo b", "echo c 1>&2; exit 2"])
+    >>> [r.returncode for r in results]
+    [0, 0, 2]
+
+    >>> [r.stdout for r in results]
+    ['a\\n', 'b\\n', '']
+
+    >>> results[2].stderr
+    'c\\n'
+
+    >>> results[1].wall_time >= 0.5
+    True
+
+    >>> e.run([])
+    []
+
+    With the cost model provided, the most expensive commands are started
+    first. The results are still reported in the order of the commands:
+
+    >>> class sleep_cost_model(object):
+    ...     def order(self, commands):
+    ...         return sorted(range(len(commands)),
+    ...                       key=lambda i: -float(commands[i].split()[1]))
+    >>> e = pool_executor(cpu_no=1, cost_model=sleep_cost_model())
+    >>> results = e.run(["sleep 0.1", "sleep 0.3", "sleep 0.2"])
+    >>> [r.command for r in results]
+    ['sleep 0.1', 'sleep 0.3', 'sleep 0.2']
+    >>> results[1].end_time <= results[2].start_time <= results[0].start_time
+    True
+
+    The CPUs are split between the commands of the batch, so a single
+    command gets all of them:
+
+    >>> e = pool_executor(cpu_no=3)
+
+    >>> threads = "echo $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+    >>> [r.stdout for r in e.run([threads])]
+    ['3\\n']
+    >>> [r.stdout for r in e.run([threads] * 3)]
+    ['1\\n', '1\\n', '1\\n']
+
+    With the memory limit set, the commands run concurrently only as long as
+    their predicted memory usage fits the limit:
+
+    >>> e = pool_executor(cpu_no=2, memory_limit=48 * 1024 ** 2,
+    ...                   memory_model=pos_memory.memory_model())
+    >>> a, b = e.run(["sleep 0.2; echo a", "sleep 0.2; echo b"])
+    >>> a.end_time <= b.start_time
+    True
+
+    With the speculative execution enabled, a copy of the command running
+    much longer than the other commands of its type is started as soon as a
+    CPU is free. The copy writes its own outputs which replace the outputs
+    of the original command when the copy wins:
+
+    >>> class slow_touch(object):
+    ...     def __init__(self, seconds, output):
+    ...         self.seconds, self.output = seconds, output
+    ...     def __str__(self):
+    ...         return "sleep %s; touch %s" % (self.seconds, self.output)
+    ...     def get_output_files(self):
+    ...         return [self.output]
+    ...     def get_speculative_variant(self):
+    ...         return slow_touch(0.1, self.output + '.speculative')
+    >>> commands = [slow_touch(0.1, '/tmp/pos_speculation_%d' % i)
+    ...             for i in range(3)]
+    >>> commands.append(slow_touch(30, '/tmp/pos_speculation_3'))
+    >>> e = pool_executor(cpu_no=2, speculation=3)
+    >>> results = e.run(commands)
+    >>> [r.success for r in results]
+    [True, True, True, True]
+    >>> results[3].command
+    'sleep 30; touch /tmp/pos_speculation_3'
+    >>> results[3].wall_time < 1
+    True
+    >>> os.path.exists('/tmp/pos_speculation_3'), \\
+    ...     os.path.exists('/tmp/pos_speculation_3.speculative')
+    (True, False)
+
+    With the chunks enabled, once a few commands of a given type are
+    finished, the short commands (see :py:func:`is_short_command`) of the
+    type are bundled into chunks. The results are reported for every command
+    anyway:
+
+    >>> class image_voxel_count_wrapper(object):
+    ...     def __init__(self, value):
+    ...         self.value = value
+    ...     def __str__(self):
+    ...         return 'echo %d; echo "$0"' % self.value
+    >>> e = pool_executor(cpu_no=2, chunk_duration=1.0)
+    >>> results = e.run([image_voxel_count_wrapper(i) for i in range(40)])
+    >>> [r.stdout.split()[0] for r in results] == map(str, range(40))
+    True
+    >>> sorted(set(r.stdout.split()[1].endswith('chunk.sh') for r in results))
+    [False, True]
+    """
+
+    # Interval (in seconds) of waiting for the next result. Waiting without a
+    # timeout makes the pool deaf to keyboard interrupts.
+    _POLL_INTERVAL = 1.0
+
+    # Number of the finished commands of a given type required before the
+    # commands of the type are considered for the speculative execution.
+    _SPECULATION_MIN_SAMPLES = 3
+
+    # Number of the finished commands of a given type required before the
+    # commands of the type are bundled into chunks, and the maximum number of
+    # the commands in a chunk.
+    _CHUNK_MIN_SAMPLES = 3
+    _MAX_CHUNK_SIZE = 100
+
+    def imap(self, commands):
+        # Commands are rendered in the calling thread so that the (not
+        # necessarily thread-safe) wrappers are never touched by the workers.
+        commands = list(commands)
+        command_strings = map(str, commands)
+        estimates, budget = self._get_memory_budget(commands)
+        threads = self._get_threads(len(commands))
+        workers_no = max(1, self.cpu_no)
+        finished = Queue.Queue()
+
+        def run(indexes, speculative, command_strs, control):
+            try:
+                if len(indexes) == 1:
+                    task_results = [run_within_budget(command_strs[0],
+                        estimates[indexes[0]], budget, threads,
+                        self.tool_pool, self.capture, control, self.retries,
+                        self.retry_delay)]
+                else:
+                    task_results = self._run_chunk(command_strs,
+                        max(estimates[i] for i in indexes), budget, threads)
+            except Exception:
+                task_results = sys.exc_info()
+            finished.put((indexes, speculative, task_results))
+
+        # The copies of the commands (or the chunks of commands) being
+        # executed, by the (index of the first command, speculative) key. The
+        # controls allow to terminate the single commands when the
+        # speculative execution is enabled.
+        running = {}
+
+        def start(indexes, speculative, command_strs):
+            control = None
+            if self.speculation and len(indexes) == 1:
+                control = command_control()
+            running[indexes[0], speculative] = control
+            pool.apply_async(run, (indexes, speculative, command_strs,
+                                   control))
+
+        # Speculative copies of the commands and the results of the commands
+        # which were executed speculatively, by the index of the command.
+        variants = {}
+        outcomes = {}
+        # Wall times of the commands of every type.
+        durations = collections.defaultdict(list)
+        # The types of the commands.
+        types = map(pos_memory.get_command_type, commands)
+
+        # The commands are handed out to the workers one by one, in the order
+        # of their predicted cost. The results which arrive ahead of their
+        # turn wait until all the preceding results are yielded.
+        pending = collections.deque(self._get_order(commands))
+        results = {}
+        next_index = 0
+        pool = ThreadPool(workers_no)
+        try:
+            while next_index < len(commands):
+                while pending and len(running) < workers_no:
+                    indexes = self._take_chunk(pending, commands, types,
+                                               durations, workers_no)
+                    start(indexes, False,
+                          [command_strings[i] for i in indexes])
+
+                if self.speculation and not pending and \
+                        len(running) < workers_no:
+                    for index in self._find_stragglers(commands, running,
+                            variants, durations)[:workers_no - len(running)]:
+                        variants[index] = \
+                            commands[index].get_speculative_variant()
+                        if variants[index] is not None:
+                            start([index], True, [str(variants[index])])
+
+                try:
+                    indexes, speculative, task_results = \
+                        finished.get(True, self._POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                del running[indexes[0], speculative]
+                if not isinstance(task_results, list):
+                    raise task_results[0], task_results[1], task_results[2]
+
+                for index, result in zip(indexes, task_results):
+                    if variants.get(index) is None:
+                        results[index] = result
+                        if result.success:
+                            durations[types[index]].append(result.wall_time)
+                        continue
+
+                    # The first successful copy wins, the other one is
+                    # terminated. The result is reported once both copies
+                    # are done, so they do not write the same files.
+                    outcomes.setdefault(index, {})[speculative] = result
+                    other = running.get((index, not speculative))
+                    if other is not None and result.success:
+                        other.cancel()
+                    if len(outcomes[index]) == 2:
+                        results[index] = self._resolve_speculation(index,
+                            commands[index], variants[index],
+                            outcomes.pop(index))
+
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        finally:
+            for control in running.values():
+                if control is not None:
+                    control.cancel()
+            pool.close()
+            pool.join()
+
+    def _take_chunk(self, pending, commands, types, durations, workers_no):
+        """
+        Take the next command or, if the commands are short, the next chunk
+        of commands, from the `pending` commands. The commands are expected
+        to take as long as the average of the finished commands of the same
+        type. The chunks are kept small enough for the remaining commands to
+        be spread over all the workers.
+
+        :return: Indexes of the commands.
+        :rtype: list of ints
+        """
+        chunk = [pending.popleft()]
+        if not self.chunk_duration:
+            return chunk
+
+        max_size = min(self._MAX_CHUNK_SIZE, (len(pending) + 1) // workers_no)
+        total = 0.0
+        while True:
+            index = chunk[-1]
+            command_durations = durations[types[index]]
+            if len(command_durations) < self._CHUNK_MIN_SAMPLES or \
+               not is_short_command(commands[index]) or \
+               (self.tool_pool and self.tool_pool.accepts(commands[index])):
+                break
+
+            # The durations of the commands of the type hardly change, so
+            # only the recent ones are averaged.
+            recent = command_durations[-self._CHUNK_MIN_SAMPLES:]
+            total += sum(recent) / len(recent)
+            if total > self.chunk_duration:
+                break
+            if not pending or len(chunk) >= max_size:
+                return chunk
+            chunk.append(pending.popleft())
+
+        # The last command does not fit the chunk.
+        if len(chunk) > 1:
+            pending.appendleft(chunk.pop())
+        return chunk
+
+    def _run_chunk(self, command_strs, memory, budget, threads):
+        """
+        Execute the chunk of commands (see :py:func:`run_chunk`) within the
+        memory budget. The commands failing transiently are executed again,
+        one by one.
+        """
+        reserved = budget and budget.acquire(memory)
+        try:
+            chunk_results = run_chunk(command_strs, threads, self.capture)
+        finally:
+            if budget is not None:
+                budget.release(reserved)
+
+        for i, result in enumerate(chunk_results):
+            if self.retries and is_transient_failure(result):
+                time.sleep(self.retry_delay)
+                chunk_results[i] = run_within_budget(result.command, memory,
+                    budget, threads, self.tool_pool, self.capture, None,
+                    self.retries - 1, self.retry_delay * 2)
+                chunk_results[i].attempts += 1
+        return chunk_results
+
+    def _find_stragglers(self, commands, running, variants, durations):
+        """
+        Find the running commands which take more than `speculation` times
+        longer than the median of the finished commands of the same type and
+        have not been executed speculatively yet. The longest running
+        commands come first.
+        """
+        now = time.time()
+        stragglers = []
+        for (index, speculative), control in running.items():
+            if speculative or index in variants or control is None or \
+                    control.start_time is None or \
+                    not hasattr(commands[index], 'get_speculative_variant'):
+                continue
+
+            command_durations = \
+                durations[pos_memory.get_command_type(commands[index])]
+            if len(command_durations) < self._SPECULATION_MIN_SAMPLES:
+                continue
+
+            median = sorted(command_durations)[len(command_durations) // 2]
+            elapsed = now - control.start_time
+            if elapsed > self.speculation * median:
+                self._logger.warning("Command %d has been running for %.1f s "
+                    "(median: %.1f s), starting a speculative copy.",
+                    index, elapsed, median)
+                stragglers.append((elapsed, index))
+        return [index for elapsed, index in sorted(stragglers, reverse=True)]
+
+    def _resolve_speculation(self, index, command, variant, outcomes):
+        """
+        Pick the winner of the speculatively executed command: the copy which
+        succeeded first. The outputs of the speculative copy replace the
+        outputs of the original command when the copy wins, otherwise they
+        are removed.
+
+        :return: The result of the winner, reported as the result of the
+            original command.
+        :rtype: :py:class:`command_result`
+        """
+        original, speculative = outcomes[False], outcomes[True]
+        original_files = command.get_output_files() or []
+        variant_files = variant.get_output_files() or []
+
+        if not speculative.success or (original.success and
+                original.end_time <= speculative.end_time):
+            self._logger.warning("Command %d: the original command wins "
+                "(exit code: %s).", index, original.returncode)
+            for filename in variant_files:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return original
+
+        self._logger.warning("Command %d: the speculative copy wins "
+            "(%.1f s): %s", index, speculative.wall_time, str(variant))
+        for i, filename in enumerate(original_files):
+            if i < len(variant_files) and os.path.exists(variant_files[i]):
+                os.rename(variant_files[i], filename)
+            elif os.path.exists(filename):
+                os.remove(filename)
+
+        return command_result(original.command, speculative.returncode,
+            speculative.stdout, speculative.stderr, speculative.start_time,
+            speculative.end_time, resources=speculative.resources,
+            attempts=speculative.attempts)
+
+
+class parallel_executor(generic_executor):
+    """
+    Executes the commands with GNU parallel. The commands are dumped into a
+    file which is then passed to GNU parallel. If the `~/.pos_cluster` file
+    exists, the commands are distributed over the hosts listed in the file.
+
+    The exit codes and the timings are read from the GNU parallel's job log,
+    while the outputs of the individual commands are separated by tagging
+    each line of the output with the sequential number of the job.
+
+    The memory limit is not supported by this executor as the commands may
+    be distributed over several hosts. The number of threads of the commands
+    is based on the number of the local CPUs. The output capture policy is
+    applied only after the whole batch is finished. Just as with the other
+    executors, only the commands failing transiently (see
+    :py:func:`is_transient_failure`) are retried: once the batch is finished,
+    they are executed with GNU parallel again, after the retry delay.
+    """
+
+    # Define the name for GNU parallel executeble name.
+    PARALLEL_EXECUTABLE_NAME = "parallel"
+
+    def _get_cluster_file(self):
+        return os.path.join(os.getenv("HOME", ""), '.pos_cluster')
+
+    def imap(self, commands):
+        commands = list(commands)
+        command_strings = map(str, commands)
+
+        # The most expensive commands are put at the beginning of the
+        # command file.
+        order = self._get_order(commands)
+        results = self._run_parallel(command_strings, order)
+
+        attempt = 1
+        while attempt <= self.retries:
+            transient = [index for index in order
+                         if is_transient_failure(results[index])]
+            if not transient:
+                break
+
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            self._logger.warning("%d commands failed transiently, retrying "
+                "in %.1f s (attempt %d of %d).", len(transient), delay,
+                attempt + 1, self.retries + 1)
+            time.sleep(delay)
+            attempt += 1
+            for index, result in \
+                    self._run_parallel(command_strings, transient).iteritems():
+                result.attempts = attempt
+                results[index] = result
+
+        for index, command_str in enumerate(command_strings):
+            result = results[index]
+            if self.capture is not None:
+                output = self.capture.open(command_str)
+                output.write('stdout', result.stdout)
+                output.write('stderr', result.stderr)
+                result.stdout, result.stderr = output.close()
+            yield result
+
+    def _run_parallel(self, command_strings, order):
+        """
+        Execute the commands with the `order` indexes with a single run of
+        GNU parallel, in the given order.
+
+        :return: The results of the commands by their indexes.
+        :rtype: dict
+        """
+        command_filename = \
+            os.path.join(self.workdir, str(time.time()))
+        joblog_filename = command_filename + "_joblog"
+        open(command_filename, 'w').write(
+            "\n".join([command_strings[index] for index in order]))
+        self._logger.info("Saving command file: %s", command_filename)
+
+        cluster_file = self._get_cluster_file()
+        if os.path.isfile(cluster_file):
+            command_str = 'parallel --sshloginfile %s -a %s -k -j %d --env PATH --env PYTHONPATH --env LD_LIBRARY_PATH --workdir %s' %\
+                (cluster_file, command_filename, self.cpu_no, os.getcwd())
+        else:
+            command_str = 'parallel -a %s -k -j %d' %\
+                (command_filename, self.cpu_no)
+        command_str += ' --joblog %s --tagstring {#}' % joblog_filename
+
+        # The number of threads is passed to the remote hosts as well.
+        command_str += ' --env %s' % THREADS_VARIABLE
+        env = dict(os.environ)
+        env[THREADS_VARIABLE] = str(self._get_threads(len(order)))
+
+        self._logger.debug("Executing: %s", command_str)
+        stdout, stderr = sub.Popen(command_str,
+                            stdout=sub.PIPE, stderr=sub.PIPE,
+                            shell=True, close_fds=True, env=env).communicate()
+
+        outputs = self._split_tagged_output(stdout, len(order))
+        errors = self._split_tagged_output(stderr, len(order))
+        joblog = self._read_joblog(joblog_filename)
+
+        # The job sequence numbers refer to the positions in the file.
+        results = {}
+        for seq, index in enumerate(order, start=1):
+            returncode, start_time, runtime = joblog.get(seq, (None, None, None))
+            end_time = None
+            if start_time is not None:
+                end_time = start_time + runtime
+            results[index] = command_result(command_strings[index],
+                returncode, outputs.pop(seq), errors.pop(seq),
+                start_time, end_time)
+        return results
+
+    @staticmethod
+    def _split_tagged_output(output, commands_no):
+        """
+        Split the output tagged with the job sequence numbers into outputs of
+        the individual jobs.
+
+        >>> out = parallel_executor._split_tagged_output("1\\ta\\n2\\tb\\n1\\tc\\n", 3)
+        >>> out[1], out[2], out[3]
+        ('a\\nc\\n', 'b\\n', '')
+        """
+        split_output = dict((seq, []) for seq in range(1, commands_no + 1))
+        for line in output.splitlines(True):
+            seq, _, content = line.partition("\t")
+            try:
+                split_output[int(seq)].append(content)
+            except (ValueError, KeyError):
+                continue
+
+        return dict((seq, "".join(lines))
+                    for seq, lines in split_output.iteritems())
+
+    @staticmethod
+    def _read_joblog(joblog_filename):
+        """
+        Read GNU parallel's job log. Returns a dictionary mapping the job
+        sequence number to the (exit code, start time, run time) tuple. The
+        jobs killed by a signal get the negated number of the signal as the
+        exit code.
+
+        >>> open('/tmp/pos_joblog_test', 'w').write(
+        ...     "Seq\\tHost\\tStarttime\\tJobRuntime\\tSend\\tReceive\\t"
+        ...     "Exitval\\tSignal\\tCommand\\n"
+        ...     "1\\t:\\t10.0\\t0.5\\t0\\t0\\t0\\t0\\techo 1\\n"
+        ...     "2\\t:\\t10.5\\t2.0\\t0\\t0\\t0\\t11\\tANTS\\n")
+        >>> joblog = parallel_executor._read_joblog('/tmp/pos_joblog_test')
+        >>> joblog[1], joblog[2]
+        ((0, 10.0, 0.5), (-11, 10.5, 2.0))
+        """
+        joblog = {}
+        if not os.path.isfile(joblog_filename):
+            return joblog
+
+        for line in open(joblog_filename).readlines()[1:]:
+            fields = line.split("\t")
+            try:
+                returncode = -int(fields[7]) or int(fields[6])
+                joblog[int(fields[0])] = \
+                    (returncode, float(fields[2]), float(fields[3]))
+            except (ValueError, IndexError):
+                continue
+        return joblog
+
+    @classmethod
+    def is_available(cls):
+        """
+        Checks if GNU parallel is installed.
+        """
+        return pos_common.which(cls.PARALLEL_EXECUTABLE_NAME) is not None
+
+
+# A registry of available execution backends.
+executors = {
+    'serial': serial_executor,
+    'pool': pool_executor,
+    'parallel': parallel_executor}
+
+
+if __name__ == 'possum.pos_executors':
+    import doctest
+    doctest.testmod()
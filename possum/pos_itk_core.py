@@ -1,14 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*
 
-import itk
 import logging
 
+import pos_common
+
+# The itk is imported only when it is actually used. Importing it takes a
+# few seconds, not to mention the wrapping of the templated types.
+itk = pos_common.lazy_module('itk')
+
 # http://sphinx-doc.org/domains.html#the-python-domain
 
 # Dictionary below copied from (Sun Apr  7 14:04:28 CEST 2013)
 # http://code.google.com/p/medipy/source/browse/lib/medipy/itk/types.py?name=default&r=0da35e1099e5947151dee239f7a09f405f4e105c
-io_component_type_to_type = {
+io_component_type_to_type = pos_common.lazy_mapping(lambda: {
         itk.ImageIOBase.UCHAR : itk.UC,
         itk.ImageIOBase.CHAR : itk.SC,
         itk.ImageIOBase.USHORT : itk.US,
@@ -19,12 +24,12 @@ io_component_type_to_type = {
         itk.ImageIOBase.LONG : itk.SL,
         itk.ImageIOBase.FLOAT : itk.F,
         itk.ImageIOBase.DOUBLE : itk.D,
-        }
+        })
 
 # And this is my own invention: a dictionary that converts tuple of specific
 # image parameters into itk image type. We all love ITK heavy templated code
 # style!
-io_component_string_name_to_image_type = {
+io_component_string_name_to_image_type = pos_common.lazy_mapping(lambda: {
         ('scalar', 'short', 3) : itk.Image.SS3,
         ('scalar', 'unsigned_short', 3) : itk.Image.US3,
         ('scalar', 'unsigned_char', 3) : itk.Image.UC3,
@@ -39,23 +44,41 @@ io_component_string_name_to_image_type = {
         ('scalar', 'double', 3) : itk.Image.D3,
         ('rgb', 'unsigned_char', 2) : itk.Image.RGBUC2,
         ('rgb', 'unsigned_char', 3) : itk.Image.RGBUC3,
-        }
+        })
 
 # Another quite clever dictionary. This one converts given image type to the
 # same type but with number of dimensions reduced by one (e.g. 3->2).
-types_reduced_dimensions = {
+types_reduced_dimensions = pos_common.lazy_mapping(lambda: {
         itk.Image.SS3 : itk.Image.SS2,
         itk.Image.US3 : itk.Image.US2,
         itk.Image.UC3 : itk.Image.UC2,
         itk.Image.RGBUC3 : itk.Image.RGBUC2,
         itk.Image.F3 : itk.Image.F2,
         itk.Image.D3 : itk.Image.D2
-    }
+    })
 
 # This time a dictionary for stacking slices (a reverse of
 # types_reduced_dimensions dict):
-types_increased_dimensions = dict((types_reduced_dimensions[k], k)
-                               for k in types_reduced_dimensions)
+types_increased_dimensions = pos_common.lazy_mapping(
+    lambda: dict((types_reduced_dimensions[k], k)
+                 for k in types_reduced_dimensions))
+
+
+class lazy_image_type(object):
+    """
+    An itk image type (e.g. `itk.Image.UC2`) used as a class attribute. The
+    type is looked up only when the attribute is accessed, so defining the
+    class does not require importing the itk.
+
+    :param name: Name of the image type, e.g. 'RGBUC2'.
+    :type name: str
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return getattr(itk.Image, self.name)
 
 
 def get_image_region(image_dim, crop_index, crop_size):
@@ -92,6 +115,51 @@ def get_image_region(image_dim, crop_index, crop_size):
     return bounding_box
 
 
+def read_image_information(image_path):
+    """
+    Reads the header of the image without loading the image itself.
+
+    :param image_path: filename to be investigated
+    :type image_path: str
+
+    :returns: The itk ImageIO object holding the header information or
+              `None` if the file is not an image supported by the itk.
+    """
+    # Initialize itk imageIO factory which allows to do some strange things
+    # (this function a pythonized code of an itk example from
+    # http://www.itk.org/Wiki/ITK/Examples/IO/ReadUnknownImageType
+    # Cheers!
+    image_io = itk.ImageIOFactory.CreateImageIO(image_path,\
+                                itk.ImageIOFactory.ReadMode)
+    if not image_io:
+        return None
+    image_io.SetFileName(image_path)
+    image_io.ReadImageInformation()
+    return image_io
+
+
+def get_image_memory_size(image_path):
+    """
+    Determines the amount of memory (in bytes) the image occupies when loaded.
+    Only the header of the image is read.
+
+    :param image_path: filename to be investigated
+    :type image_path: str
+
+    :returns: The size of the image buffer in bytes or `None` if the file is
+              not an image supported by the itk.
+    :rtype: int
+    """
+    image_io = read_image_information(image_path)
+    if image_io is None:
+        return None
+
+    number_of_voxels = reduce(lambda x, y: x * y,
+        map(image_io.GetDimensions, range(image_io.GetNumberOfDimensions())), 1)
+    return number_of_voxels * image_io.GetNumberOfComponents() * \
+        image_io.GetComponentSize()
+
+
 def autodetect_file_type(image_path, ret_itk=True):
     """
     Autodetects image dimensions and size as well as pixel type and component
@@ -112,14 +180,7 @@ def autodetect_file_type(image_path, ret_itk=True):
     logger = logging.getLogger('autodetect_file_type')
     logger.info("Autodetecting file type: %s",  image_path)
 
-    # Initialize itk imageIO factory which allows to do some strange things
-    # (this function a pythonized code of an itk example from
-    # http://www.itk.org/Wiki/ITK/Examples/IO/ReadUnknownImageType
-    # Cheers!
-    image_io = itk.ImageIOFactory.CreateImageIO(image_path,\
-                                itk.ImageIOFactory.ReadMode)
-    image_io.SetFileName(image_path)
-    image_io.ReadImageInformation()
+    image_io = read_image_information(image_path)
 
     # Extracting information for determining image type
     image_size = map(image_io.GetDimensions,
@@ -1,5 +1,8 @@
-import itk
+import possum.pos_common
 import possum.pos_itk_core
+import possum.pos_affine
+
+itk = possum.pos_common.lazy_module('itk')
 
 """
 http://www.vtk.org/doc/nightly/html/classvtkShepardMethod.html
@@ -12,36 +15,17 @@ http://www.itk.org/Doxygen/html/classitk_1_1CompositeTransform.html
 def read_transformation_txt_file(transformation_file):
     """
     Extracts transformation parameters from the transformation file
-    and packs them into an returns them as a dictionary.
+    and packs them into an returns them as a dictionary (see
+    :py:func:`possum.pos_affine.read_transformation_parameters`).
 
-    :param transformation_string: the contents of the transformation file.
-    :type: transformation_string: string
+    :param transformation_file: the transformation file.
+    :type: transformation_file: str
 
-    :return: An array of the parameters results.
-    :rtype: list
+    :return: The transformation class, parameters and fixed parameters.
+    :rtype: dict
     """
-
-    # Well - open the file and read its contents:
-    transformation_string = open(transformation_file).readlines()
-
-    # Then extract the transformation class name (it is very important which
-    # type of transformation given file carries :)
-    transformation_class = transformation_string[2].strip().split(':')[1].strip()
-
-    # Extract the actual parametres from the parameters string.
-    parameters = \
-        transformation_string[3].strip().split(':')[1].strip().split(' ')
-    parameters = map(float, parameters)
-
-    # And then the same for the fixed parameters. Make them floats afterwards,
-    fixed_parameters = \
-        transformation_string[4].strip().split(':')[1].strip().split(' ')
-    fixed_parameters =  map(float, fixed_parameters)
-
-    result = {'transformation_class': transformation_class,
-              'parameters': parameters,
-              'fixed_parameters': fixed_parameters}
-    return result
+    return possum.pos_affine.read_transformation_parameters(
+        transformation_file)
 
 
 def load_itk_matrix_transform_from_file(filename):
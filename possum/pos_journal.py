@@ -0,0 +1,353 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A crash-safe journal of the commands executed by a workflow.
+
+Every finished command is appended to the journal file (located in the
+workflow's working directory) as a single line holding the command, its exit
+code, stdout and stderr, as well as the sizes and the modification times of
+the input and output files the command declares. The files are not hashed,
+so recording a command costs a few `stat` calls only. The line is flushed to
+the disk before the next command is recorded, so the journal survives the
+workflow being killed at any moment. A line which was only partially written
+is discarded when the journal is loaded. Only the commands declaring their
+files are journaled, as nothing tells whether the other ones have finished.
+
+When a workflow is restarted with the same job identifier (and thus the same
+working directory), the commands found in the journal are not executed again,
+as long as they finished successfully, all their outputs exist and both their
+input and output files are unchanged (have the same sizes and modification
+times). Commands with missing or half-written outputs are executed again.
+
+Within a single run, the commands completed successfully are remembered (see
+:py:class:`completed_commands`) so the same command requested by several
+stages of the workflow is executed only once.
+"""
+
+import os
+import json
+import time
+import logging
+
+import pos_executors
+
+
+def _get_stamp(filename):
+    """
+    Get the size and the modification time of the file, `None` if the file
+    does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime]
+    except OSError:
+        return None
+
+
+def _get_stamps(command, method_name):
+    """
+    Get the sizes and the modification times of the files read or written by
+    the command (`None` for the files which do not exist). Returns `None` if
+    the command does not declare its files.
+    """
+    method = getattr(command, method_name, None)
+    files = method and method()
+    if files is None:
+        return None
+
+    stamps = {}
+    for filename in files:
+        stamps[filename] = _get_stamp(filename)
+    return stamps
+
+
+class command_journal(object):
+    """
+    The journal of the commands stored in the `filename` file.
+
+    :param filename: Journal file. Created if it does not exist.
+    :type filename: str
+
+    >>> import shutil
+    >>> import pos_wrappers
+    >>> shutil.rmtree('/tmp/pos_journal_test', True)
+    >>> os.makedirs('/tmp/pos_journal_test')
+    >>> open('/tmp/pos_journal_test/input.txt', 'w').write('1')
+
+    >>> command = pos_wrappers.chain_affine_transforms(
+    ...     input_transforms=['/tmp/pos_journal_test/input.txt'],
+    ...     output_transform='/tmp/pos_journal_test/output.txt')
+    >>> j = command_journal('/tmp/pos_journal_test/journal')
+    >>> j.fetch(command)
+
+    >>> open('/tmp/pos_journal_test/output.txt', 'w').write('x')
+    >>> j.store(command, pos_executors.command_result(str(command), 0, '\\xff'))
+    True
+    >>> j.store(command, pos_executors.command_result(str(command), 1))
+    True
+    >>> j.store(command, pos_executors.command_result(str(command), 0, '\\xff'))
+    True
+
+    The commands which do not declare their files are not journaled:
+
+    >>> j.store("echo 1", pos_executors.command_result("echo 1", 0, '1\\n'))
+    False
+
+    The journal is loaded again when the workflow is restarted. Successfully
+    finished commands are not executed again:
+
+    >>> j = command_journal('/tmp/pos_journal_test/journal')
+    >>> result = j.fetch(command)
+    >>> result.returncode, result.stdout, result.cached
+    (0, '\\xff', True)
+
+    >>> j.fetch("echo 1")
+
+    Unless the outputs are missing or have been changed (e.g. the command was
+    interrupted while rewriting the output):
+
+    >>> open('/tmp/pos_journal_test/output.txt', 'w').write('xy')
+    >>> j.fetch(command)
+
+    The outputs which were missing when the command finished are never
+    accepted:
+
+    >>> missing = pos_wrappers.chain_affine_transforms(
+    ...     input_transforms=['/tmp/pos_journal_test/input.txt'],
+    ...     output_transform='/tmp/pos_journal_test/missing.txt')
+    >>> j.store(missing, pos_executors.command_result(str(missing), 0))
+    True
+    >>> command_journal('/tmp/pos_journal_test/journal').fetch(missing)
+
+    Incomplete records are discarded:
+
+    >>> open('/tmp/pos_journal_test/journal', 'a').write('{"command": "echo 2", ')
+    >>> j = command_journal('/tmp/pos_journal_test/journal')
+    >>> j.fetch(command)
+    >>> j.store(command, pos_executors.command_result(str(command), 0, '2\\n'))
+    True
+    >>> command_journal('/tmp/pos_journal_test/journal').fetch(command).stdout
+    '2\\n'
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        # The most recent record of each command executed by the previous runs
+        # of the workflow. The commands recorded during the current run are
+        # not taken into account, so executing the same command twice within
+        # a single run executes it twice.
+        self._records = {}
+        self._load()
+
+    def _load(self):
+        """
+        Read the records from the journal file. A partially written record
+        (which may only be the last one) is removed from the file.
+        """
+        if not os.path.isfile(self.filename):
+            return
+
+        valid_length = 0
+        with open(self.filename, 'rb') as journal_file:
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._records[record['command'].encode('utf-8')] = record
+                valid_length += len(line)
+
+        if valid_length < os.path.getsize(self.filename):
+            self._logger.warning("Discarding incomplete journal record.")
+            with open(self.filename, 'r+b') as journal_file:
+                journal_file.truncate(valid_length)
+
+        self._logger.info("%d commands loaded from the journal: %s",
+                          len(self._records), self.filename)
+
+    def fetch(self, command):
+        """
+        Look up the command in the journal.
+
+        :param command: The command to look up.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The recorded result if the command has finished
+            successfully, its outputs exist and its input and output files
+            are unchanged, `None` otherwise.
+        :rtype: :py:class:`possum.pos_executors.command_result`
+        """
+        command_str = str(command)
+        record = self._records.get(command_str)
+        if record is None or record['returncode'] != 0:
+            return None
+
+        inputs = _get_stamps(command, 'get_input_files')
+        outputs = _get_stamps(command, 'get_output_files')
+        if inputs is None or outputs is None:
+            return None
+
+        if None in outputs.values() or inputs != record['inputs'] or \
+           outputs != record['outputs']:
+            self._logger.info("Files of the journaled command have changed: %s",
+                              command_str)
+            return None
+
+        self._logger.debug("Result restored from the journal: %s", command_str)
+        # The outputs are stored as latin-1 strings which makes the
+        # conversion of arbitrary bytes to unicode (and back) lossless.
+        return pos_executors.command_result(command_str, 0,
+            record['stdout'].encode('latin-1'),
+            record['stderr'].encode('latin-1'),
+            record['start_time'], record['end_time'], cached=True)
+
+    def store(self, command, result):
+        """
+        Append the result of the command to the journal.
+
+        :param command: The executed command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+
+        :return: `True` if a new record was written.
+        :rtype: bool
+        """
+        # Whether the commands which do not declare their files have
+        # finished cannot be verified, so they are not journaled at all.
+        inputs = _get_stamps(command, 'get_input_files')
+        outputs = _get_stamps(command, 'get_output_files')
+        if inputs is None or outputs is None:
+            return False
+
+        command_str = str(command)
+        record = {'command': command_str,
+                  'returncode': result.returncode,
+                  'stdout': result.stdout.decode('latin-1'),
+                  'stderr': result.stderr.decode('latin-1'),
+                  'start_time': result.start_time or time.time(),
+                  'end_time': result.end_time or time.time(),
+                  'inputs': inputs,
+                  'outputs': outputs}
+
+        # Results restored from the journal itself do not need to be
+        # recorded once again.
+        previous = self._records.get(command_str)
+        if result.cached and previous is not None and \
+           previous['returncode'] == record['returncode'] and \
+           previous['outputs'] == record['outputs']:
+            return False
+
+        # The record is written with a single call and flushed to the disk
+        # immediately.
+        with open(self.filename, 'ab') as journal_file:
+            journal_file.write(json.dumps(record) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        return True
+
+
+class completed_commands(object):
+    """
+    The commands completed successfully during the current run of the
+    workflow. Several stages of a workflow may request exactly the same
+    command (e.g. preprocessing of a reference slice shared by many moving
+    slices). The command is executed only once as long as neither its input
+    nor its output files change afterwards. Only the commands declaring their
+    files are remembered.
+
+    >>> import pos_wrappers
+    >>> open('/tmp/pos_journal_test/input.txt', 'w').write('1')
+    >>> command = pos_wrappers.chain_affine_transforms(
+    ...     input_transforms=['/tmp/pos_journal_test/input.txt'],
+    ...     output_transform='/tmp/pos_journal_test/output.txt')
+    >>> completed = completed_commands()
+    >>> completed.fetch(command)
+
+    >>> open('/tmp/pos_journal_test/output.txt', 'w').write('x')
+    >>> completed.store(command, pos_executors.command_result(str(command), 0, 'x'))
+    True
+    >>> result = completed.fetch(command)
+    >>> result.returncode, result.stdout, result.cached
+    (0, 'x', True)
+
+    Failed and undeclared commands are not remembered:
+
+    >>> completed.store("echo 1", pos_executors.command_result("echo 1", 0))
+    False
+    >>> completed.store(command, pos_executors.command_result(str(command), 1))
+    False
+    >>> completed.fetch(command)
+
+    Neither are the commands which files have changed since:
+
+    >>> completed.store(command, pos_executors.command_result(str(command), 0))
+    True
+    >>> os.remove('/tmp/pos_journal_test/output.txt')
+    >>> completed.fetch(command)
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._records = {}
+
+    def fetch(self, command):
+        """
+        Look up the command among the completed ones.
+
+        :param command: The command to look up.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The result of the command if it has finished successfully
+            and its files are unchanged, `None` otherwise.
+        :rtype: :py:class:`possum.pos_executors.command_result`
+        """
+        command_str = str(command)
+        record = self._records.get(command_str)
+        if record is None:
+            return None
+
+        result, inputs, outputs = record
+        if _get_stamps(command, 'get_input_files') != inputs or \
+           _get_stamps(command, 'get_output_files') != outputs:
+            del self._records[command_str]
+            return None
+
+        self._logger.debug("Command already completed: %s", command_str)
+        return pos_executors.command_result(command_str, 0,
+            result.stdout, result.stderr, result.start_time, result.end_time,
+            cached=True)
+
+    def store(self, command, result):
+        """
+        Remember the result of the command.
+
+        :param command: The executed command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+
+        :return: `True` if the command is remembered.
+        :rtype: bool
+        """
+        command_str = str(command)
+        inputs = _get_stamps(command, 'get_input_files')
+        outputs = _get_stamps(command, 'get_output_files')
+        if result.returncode != 0 or inputs is None or outputs is None:
+            self._records.pop(command_str, None)
+            return False
+
+        self._records[command_str] = (result, inputs, outputs)
+        return True
+
+
+if __name__ == 'possum.pos_journal':
+    import doctest
+    doctest.testmod()
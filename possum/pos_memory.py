@@ -0,0 +1,381 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Memory-aware admission of the commands executed in parallel.
+
+Executing as many commands as there are CPUs is fine for cheap commands (e.g.
+`c2d` calls) but a handful of deformable registrations running at once may
+easily exhaust the memory of the machine. This module predicts the peak
+memory usage (the maximum resident set size) of every command and limits the
+number of commands running concurrently so that the sum of the predicted
+memory usages of the running commands stays within a memory budget.
+
+The predictions are made per command type (the wrapper class or the name of
+the executable) and are learned from the resources used by the commands
+executed previously (see :py:func:`possum.pos_executors.run_command`). Until
+a command type has been observed, its memory usage is derived from the sizes
+of the images the command reads, as determined from the images' headers (see
+:py:func:`possum.pos_itk_core.get_image_memory_size`).
+"""
+
+import os
+import json
+import logging
+import threading
+import collections
+
+# A rough size of a process before it allocates any images (the executable,
+# the libraries, etc.), in bytes.
+_BASE_MEMORY = 32 * 1024 ** 2
+
+# How many times the memory used by a command exceeds the size of its input
+# images. Used only for the command types which have not been observed yet.
+_DEFAULT_FACTOR = 4
+_DEFAULT_FACTORS = {
+    'ants_registration': 40,
+    'ants_reslice': 8,
+    'command_warp_grayscale_image': 8,
+    'command_warp_rgb_slice': 8,
+    'blank_slice_deformation_wrapper': 8,
+    }
+
+# The expected ratio of the size of a gzipped image to the size of the image
+# in memory. Used when the image header cannot be read.
+_COMPRESSION_RATIO = 4
+
+# The in-memory sizes of the images, memoized with the (path, size,
+# modification time) keys.
+_image_sizes = {}
+
+# The itk is slow to import and may not be installed at all, so it is
+# imported only when the first image header is read.
+_itk_core = []
+
+
+def _get_itk_core():
+    """
+    Import the :py:mod:`possum.pos_itk_core` module. Returns `None` if the itk
+    is not available.
+    """
+    if not _itk_core:
+        try:
+            import itk
+            import pos_itk_core
+            _itk_core.append(pos_itk_core)
+        except ImportError:
+            _itk_core.append(None)
+    return _itk_core[0]
+
+
+def get_command_type(command):
+    """
+    Get the type of the command: the name of the wrapper class or the name of
+    the executable for plain string commands.
+
+    :param command: The command.
+    :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+    :rtype: str
+
+    >>> import pos_wrappers
+    >>> get_command_type(pos_wrappers.touch_wrapper(files=['x']))
+    'touch_wrapper'
+    >>> get_command_type("/usr/bin/c2d a.nii.gz -o b.nii.gz")
+    'c2d'
+    """
+    if isinstance(command, basestring):
+        return os.path.basename(command.split(" ", 1)[0])
+    return command.__class__.__name__
+
+
+def get_image_size(filename):
+    """
+    Estimate the amount of memory (in bytes) the image occupies when loaded.
+    The header of the image is read with the itk when it is available.
+    Otherwise (or when the file is not an image) the size of the file is
+    used, adjusted for compression.
+
+    :param filename: The image file.
+    :type filename: str
+
+    :return: The estimated size or 0 if the file does not exist.
+    :rtype: int
+
+    >>> open('/tmp/pos_memory_test.txt', 'w').write('x' * 100)
+    >>> get_image_size('/tmp/pos_memory_test.txt')
+    100
+    >>> get_image_size('/tmp/pos_memory_test_missing.nii.gz')
+    0
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return 0
+
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if memo_key not in _image_sizes:
+        size = None
+        itk_core = _get_itk_core()
+        if itk_core is not None:
+            try:
+                size = itk_core.get_image_memory_size(filename)
+            except RuntimeError:
+                # Not an image.
+                pass
+
+        if size is None:
+            size = stat.st_size
+            if filename.endswith('.gz'):
+                size *= _COMPRESSION_RATIO
+        _image_sizes[memo_key] = size
+    return _image_sizes[memo_key]
+
+
+class memory_model(object):
+    """
+    Predicts the peak memory usage of the commands.
+
+    The usage of a command is modelled as a fixed base size plus a multiple
+    of the size of the command's input images. The multiple is learned, per
+    command type, from the observed memory usage of the executed commands.
+    The learned multiples are kept in the `filename` JSON file (if provided)
+    so the predictions improve from run to run.
+
+    :param filename: File holding the learned model. Created on
+        :py:meth:`save`.
+    :type filename: str
+
+    >>> import pos_wrappers, pos_executors
+    >>> open('/tmp/pos_memory_test.nii.gz', 'w').write('x' * 1024 ** 2)
+    >>> command = pos_wrappers.ants_registration(dimension=2,
+    ...     outputNaming='/tmp/pos_memory_test_', iterations=[10],
+    ...     imageMetrics=[pos_wrappers.ants_intensity_meric(
+    ...         fixed_image='/tmp/pos_memory_test.nii.gz',
+    ...         moving_image='/tmp/pos_memory_test.nii.gz')])
+
+    Until a command type is observed, the default multiple is used:
+
+    >>> model = memory_model()
+    >>> model.estimate(command) / 1024 ** 2
+    352
+    >>> model.estimate("echo 1") / 1024 ** 2
+    32
+
+    The model learns from the results of the executed commands:
+
+    >>> result = pos_executors.command_result(str(command), 0,
+    ...     resources={'max_rss': 128 * 1024})
+    >>> model.record(command, result)
+    >>> model.estimate(command) / 1024 ** 2
+    128
+
+    >>> model.record("echo 1", pos_executors.command_result("echo 1", 0,
+    ...     resources={'max_rss': 2 * 1024}))
+    >>> model.estimate("echo 1") / 1024 ** 2
+    32
+
+    The results without the peak memory usage (e.g. of the commands executed
+    by the :py:mod:`possum.pos_tool_pool`) are skipped:
+
+    >>> model.record(command, pos_executors.command_result(str(command), 0,
+    ...     resources={'user_time': 1.0}))
+    >>> model.estimate(command) / 1024 ** 2
+    128
+
+    And remembers what it has learned:
+
+    >>> model.filename = '/tmp/pos_memory_test_model.json'
+    >>> model.save()
+    >>> memory_model('/tmp/pos_memory_test_model.json').estimate(command) / 1024 ** 2
+    128
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+
+        # The learned multiples of the size of the input images and the
+        # maximum observed memory usages (in bytes), per command type.
+        self._factors = {}
+        self._peaks = {}
+        self._load()
+
+    def _load(self):
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+
+        try:
+            model = json.load(open(self.filename))
+        except ValueError:
+            self._logger.warning("Ignoring invalid memory model: %s",
+                                 self.filename)
+            return
+
+        self._factors = model.get('factors', {})
+        self._peaks = model.get('peaks', {})
+        self._logger.info("Memory model of %d command types loaded: %s",
+                          len(self._peaks), self.filename)
+
+    def save(self):
+        """
+        Write the learned model into the model file.
+        """
+        if not self.filename:
+            return
+
+        with self._lock:
+            model = {'factors': self._factors, 'peaks': self._peaks}
+            temp_filename = self.filename + '.%d.tmp' % os.getpid()
+            json.dump(model, open(temp_filename, 'w'), indent=1, sort_keys=True)
+            os.rename(temp_filename, self.filename)
+
+    @staticmethod
+    def _get_input_size(command):
+        """
+        The total in-memory size of the files read by the command.
+        """
+        get_input_files = getattr(command, 'get_input_files', None)
+        input_files = get_input_files and get_input_files() or []
+        return sum(map(get_image_size, input_files))
+
+    def estimate(self, command):
+        """
+        Predict the peak memory usage of the command.
+
+        :param command: The command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The predicted memory usage in bytes.
+        :rtype: int
+        """
+        command_type = get_command_type(command)
+        input_size = self._get_input_size(command)
+
+        with self._lock:
+            factor = self._factors.get(command_type)
+            peak = self._peaks.get(command_type)
+
+        # Commands which do not read any images (or do not declare their
+        # inputs) are expected to behave just like the previous ones.
+        if peak is not None and (factor is None or input_size == 0):
+            return max(peak, _BASE_MEMORY)
+
+        if factor is None:
+            factor = _DEFAULT_FACTORS.get(command_type, _DEFAULT_FACTOR)
+        return int(_BASE_MEMORY + factor * input_size)
+
+    def record(self, command, result):
+        """
+        Update the model with the memory usage of the executed command.
+
+        :param command: The executed command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+        """
+        if result.cached or not result.resources or \
+                result.resources.get('max_rss') is None:
+            return
+
+        # The maximum resident set size is reported in kilobytes.
+        used = result.resources['max_rss'] * 1024
+        command_type = get_command_type(command)
+        input_size = self._get_input_size(command)
+
+        with self._lock:
+            self._peaks[command_type] = \
+                max(used, self._peaks.get(command_type, 0))
+            if input_size > 0:
+                factor = max(0.0, float(used - _BASE_MEMORY) / input_size)
+                self._factors[command_type] = \
+                    max(factor, self._factors.get(command_type, 0.0))
+
+
+class memory_budget(object):
+    """
+    Keeps the sum of the memory reserved by the running commands within the
+    `size` limit. The memory is reserved before a command is started and
+    released when the command finishes. The reservations are granted in the
+    order they were requested, so a large command is never starved by the
+    smaller ones. A command which alone exceeds the budget is run only when
+    nothing else is running.
+
+    :param size: Size of the budget in bytes.
+    :type size: int
+
+    >>> budget = memory_budget(100)
+    >>> budget.acquire(60), budget.acquire(40)
+    (60, 40)
+    >>> budget.used
+    100
+
+    >>> order = []
+    >>> def reserve(amount):
+    ...     budget.release(budget.acquire(amount))
+    ...     order.append(amount)
+    >>> thread = threading.Thread(target=reserve, args=(500,))
+    >>> thread.start()
+    >>> budget.release(60)
+    >>> order
+    []
+    >>> budget.release(40)
+    >>> thread.join()
+    >>> order, budget.used
+    ([500], 0)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._waiting = collections.deque()
+        self._condition = threading.Condition()
+
+    def acquire(self, amount):
+        """
+        Reserve the `amount` of memory, waiting until it becomes available.
+
+        :return: The reserved amount, to be passed to :py:meth:`release`.
+        :rtype: int
+        """
+        amount = min(amount, self.size)
+        ticket = object()
+
+        with self._condition:
+            self._waiting.append(ticket)
+            while self._waiting[0] is not ticket or \
+                  (self.used > 0 and self.used + amount > self.size):
+                self._condition.wait()
+            self._waiting.popleft()
+            self.used += amount
+            self._condition.notify_all()
+        return amount
+
+    def release(self, amount):
+        """
+        Release the memory reserved with :py:meth:`acquire`.
+        """
+        with self._condition:
+            self.used -= amount
+            self._condition.notify_all()
+
+
+def get_total_memory():
+    """
+    Get the amount of physical memory (in bytes) of the machine or `None`
+    when it cannot be determined.
+
+    >>> get_total_memory() > 0
+    True
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+if __name__ == 'possum.pos_memory':
+    import doctest
+    doctest.testmod()
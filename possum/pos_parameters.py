@@ -629,6 +629,86 @@ class filename(generic_parameter):
         self.updateParameters(parameters)
         return str(self)
 
+    def many(self, **parameters):
+        """
+        Generate the filenames for a series of parameters' values at once.
+        The parameters given as sequences (lists, tuples, ranges, etc.) vary
+        from filename to filename while the other parameters are the same for
+        all the filenames. Unlike calling the object, this method does not
+        change the object's state, so it can be used by many threads at once.
+
+        :return: The filenames, one for every element of the sequences.
+        :rtype: list of strings
+
+        >>> f = filename("test_name", job_dir="/a_dir", work_dir="a_workdir",
+        ...     str_template="{iter:02d}/{idx:04d}.nii.gz")
+        >>> f.many(idx=range(3), iter=1)
+        ['/a_dir/a_workdir/01/0000.nii.gz', '/a_dir/a_workdir/01/0001.nii.gz', '/a_dir/a_workdir/01/0002.nii.gz']
+        >>> f.many(idx=[5, 6], iter=(1, 2))
+        ['/a_dir/a_workdir/01/0005.nii.gz', '/a_dir/a_workdir/02/0006.nii.gz']
+        >>> f.many(idx=[])
+        []
+        >>> f.__dict__.has_key('idx')
+        False
+
+        The results are the same as the ones of calling the object:
+
+        >>> f.many(idx=[1, 2], iter=3, work_dir='other')
+        ['/a_dir/other/03/0001.nii.gz', '/a_dir/other/03/0002.nii.gz']
+        >>> f(idx=2, iter=3, work_dir='other')
+        '/a_dir/other/03/0002.nii.gz'
+        >>> f.override_fname = "fixed.txt"
+        >>> f.many(idx=[1, 2])
+        ['/a_dir/other/fixed.txt', '/a_dir/other/fixed.txt']
+
+        >>> f.override_fname = None
+        >>> f.override_dir, f.override_path = '/od', '/op.nii.gz'
+        >>> f(idx=1), f.many(idx=[1])
+        ('/od/03/0001.nii.gz', ['/od/03/0001.nii.gz'])
+
+        >>> f.many(idx=[1, 2], iter=[1])
+        Traceback (most recent call last):
+        ValueError: The sequences of the parameters' values differ in length.
+        """
+        fixed = {}
+        varying = {}
+        for name, value in parameters.iteritems():
+            if isinstance(value, basestring) or not hasattr(value, '__iter__'):
+                fixed[name] = value
+            else:
+                varying[name] = list(value)
+
+        lengths = set(map(len, varying.values()))
+        if len(lengths) > 1:
+            raise ValueError("The sequences of the parameters' values "
+                             "differ in length.")
+
+        # The object is copied, so its state is never modified.
+        clone = object.__new__(self.__class__)
+        clone.__dict__ = self.__dict__.copy()
+        clone.updateParameters(fixed)
+
+        if not varying:
+            return [str(clone)]
+        names = varying.keys()
+        series = zip(*[varying[name] for name in names])
+
+        # The parameters which are properties (e.g. `work_dir`) need the
+        # object to be updated. The other ones (the usual case) are just
+        # substituted into the template. The filenames are serialized exactly
+        # as when calling the object.
+        if any(isinstance(getattr(self.__class__, name, None), property)
+               for name in names):
+            return [str(clone.updateParameters(dict(zip(names, values))))
+                    for values in series]
+
+        fields = clone.__dict__
+        filenames = []
+        for values in series:
+            fields.update(zip(names, values))
+            filenames.append(str(clone))
+        return filenames
+
     job_dir = property(_get_job_dir, _set_job_dir)
     """ Returns / sets job_dir """
 
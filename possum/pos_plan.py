@@ -0,0 +1,377 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Serializable execution plans of the workflows.
+
+In the dry run mode, a workflow started with the `--planFile` option records
+the commands it would execute into an execution plan: the stages of the
+workflow, the commands of every stage along with their slice indexes, the
+input and output files they declare, their predicted cost and the
+dependencies between them. The plan is saved as a JSON file. The workflows
+computing some of their stages in-process (e.g. `pos_sequential_alignment`)
+cannot be replayed from the commands alone and refuse to record the plan.
+
+The plan is executed (or resumed, as the executed commands are recorded in a
+journal, see :py:mod:`possum.pos_journal`) later with the `pos_run_plan`
+script, without repeating the setup of the workflow (parsing the options,
+loading the slice assignments, etc.). Thus, the plans of many specimens can
+be prepared on one machine and executed on another one, or by the workers of
+the work queue on many machines (see :py:mod:`possum.pos_broker`).
+
+The plan file holds the following fields:
+
+    1. `workflow` -- the name of the workflow which created the plan,
+    2. `stages` -- the names of the stages in the order of execution,
+    3. `commands` -- the commands in the order of execution, each one with
+       the `command` string, the `stage` name, the slice index (`key`), the
+       `inputs` and the `outputs` (`null` when the command does not declare
+       them), the predicted `cost` (in seconds), the index of the `batch`
+       the command was executed with and the indexes of the commands it
+       depends on (`dependencies`).
+"""
+
+import os
+import json
+import logging
+import itertools
+
+import pos_journal
+import pos_executors
+import pos_scheduler
+
+# Version of the plan file format.
+PLAN_VERSION = 1
+
+
+class planned_command(object):
+    """
+    A command restored from the execution plan. It declares the same input
+    and output files as the original command did, so the commands are
+    scheduled, journaled and cached just like the original ones.
+
+    >>> c = planned_command("cp a.txt b.txt", ['a.txt'], ['b.txt'], 2.5, 7)
+    >>> str(c), c.get_input_files(), c.get_output_files(), c.key
+    ('cp a.txt b.txt', ['a.txt'], ['b.txt'], 7)
+
+    >>> print planned_command("echo 1").get_input_files()
+    None
+    """
+
+    def __init__(self, command, inputs=None, outputs=None, cost=None,
+                 key=None, stage=None):
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cost = cost
+        self.key = key
+        self.stage = stage
+
+    def __str__(self):
+        return self.command
+
+    def get_input_files(self):
+        return self.inputs and list(self.inputs) or self.inputs
+
+    def get_output_files(self):
+        return self.outputs and list(self.outputs) or self.outputs
+
+
+class planned_cost_model(object):
+    """
+    Orders the planned commands by the cost predicted when the plan was
+    created (see :py:class:`possum.pos_cost.cost_model`).
+
+    >>> planned_cost_model().order([planned_command("a", cost=1.0),
+    ...     planned_command("b", cost=3.0), planned_command("c")])
+    [1, 0, 2]
+    """
+
+    def order(self, commands):
+        costs = [getattr(command, 'cost', None) or 0.0
+                 for command in commands]
+        return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+
+class execution_plan(object):
+    """
+    The commands of a workflow grouped into stages, with the dependencies
+    between the commands derived from their input and output files (see
+    :py:class:`possum.pos_scheduler.task_graph`).
+
+    :param workflow: Name of the workflow.
+    :type workflow: str
+
+    >>> import pos_wrappers
+    >>> transform = pos_wrappers.align_by_center_of_gravity(
+    ...     fixed_image='/tmp/f.nii.gz', moving_image='/tmp/m.nii.gz',
+    ...     output_transformation='/tmp/pos_plan_test.txt')
+    >>> reslice = pos_wrappers.command_warp_grayscale_image(
+    ...     reference_image='/tmp/f.nii.gz', moving_image='/tmp/m.nii.gz',
+    ...     transformation='/tmp/pos_plan_test.txt',
+    ...     output_image='/tmp/pos_plan_test.nii.gz')
+
+    >>> plan = execution_plan('test_workflow')
+    >>> plan.add_batch([transform], 'transforms', keys=[3])
+    >>> plan.add_batch([reslice, "echo done"], 'reslice')
+    >>> plan.save('/tmp/pos_plan_test.json')
+
+    >>> plan = execution_plan.load('/tmp/pos_plan_test.json')
+    >>> plan.workflow, plan.stages
+    (u'test_workflow', [u'transforms', u'reslice'])
+    >>> [(c.stage, c.key) for c in plan.commands]
+    [(u'transforms', 3), (u'reslice', None), (u'reslice', None)]
+    >>> plan.commands[1].get_input_files()
+    [u'/tmp/f.nii.gz', u'/tmp/m.nii.gz', u'/tmp/pos_plan_test.txt']
+    >>> plan.to_dict()['commands'][1]['dependencies']
+    [0]
+
+    >>> g = plan.get_graph()
+    >>> g.batches, map(sorted, g.dependencies)
+    ([[0], [1, 2]], [[], [0], [0, 1]])
+
+    A subset of the stages may be selected:
+
+    >>> plan.get_graph(['reslice']).batches
+    [[0, 1]]
+    """
+
+    def __init__(self, workflow=None):
+        self.workflow = workflow
+        self.stages = []
+        self.commands = []
+        self._graph = pos_scheduler.task_graph()
+
+    def add_batch(self, commands, stage, keys=None, cost_model=None):
+        """
+        Add a batch of commands to the plan.
+
+        :param commands: The commands of the batch.
+        :type commands: iterable of strings or command wrappers
+
+        :param stage: Name of the stage the commands belong to.
+        :type stage: str
+
+        :param keys: Slice indexes of the commands.
+        :type keys: list of ints
+
+        :param cost_model: Predicts the execution time of the commands.
+        :type cost_model: :py:class:`possum.pos_cost.cost_model`
+        """
+        commands = list(commands)
+        keys = keys or [None] * len(commands)
+
+        planned = []
+        for command, key in zip(commands, keys):
+            cost = cost_model and cost_model.estimate(command)
+            planned.append(planned_command(str(command),
+                _get_files(command, 'get_input_files'),
+                _get_files(command, 'get_output_files'), cost, key, stage))
+
+        if stage not in self.stages:
+            self.stages.append(stage)
+        self.commands.extend(planned)
+        self._graph.add_batch(planned)
+
+    def get_graph(self, stages=None):
+        """
+        Build the graph of the commands to execute.
+
+        :param stages: Names of the stages to execute. All the stages by
+            default.
+        :type stages: list of strings
+
+        :rtype: :py:class:`possum.pos_scheduler.task_graph`
+        """
+        graph = pos_scheduler.task_graph()
+        for indexes in self._graph.batches:
+            batch = [self.commands[i] for i in indexes
+                     if stages is None or self.commands[i].stage in stages]
+            if batch:
+                graph.add_batch(batch)
+        return graph
+
+    def to_dict(self):
+        """
+        :return: The plan in the form of the plan file.
+        :rtype: dict
+        """
+        batches = {}
+        for batch, indexes in enumerate(self._graph.batches):
+            batches.update((index, batch) for index in indexes)
+
+        commands = []
+        for index, (command, dependencies) in \
+                enumerate(zip(self.commands, self._graph.dependencies)):
+            commands.append({
+                'command': command.command,
+                'stage': command.stage,
+                'key': command.key,
+                'inputs': command.inputs,
+                'outputs': command.outputs,
+                'cost': command.cost,
+                'batch': batches[index],
+                'dependencies': sorted(dependencies)})
+
+        return {'version': PLAN_VERSION,
+                'workflow': self.workflow,
+                'stages': self.stages,
+                'commands': commands}
+
+    def save(self, filename):
+        """
+        Write the plan into the plan file.
+        """
+        temp_filename = filename + '.%d.tmp' % os.getpid()
+        json.dump(self.to_dict(), open(temp_filename, 'w'), indent=1)
+        os.rename(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read the plan from the plan file.
+
+        :rtype: :py:class:`execution_plan`
+        """
+        data = json.load(open(filename))
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError("Unsupported version of the plan file: %s" %
+                             filename)
+
+        plan = cls(data.get('workflow'))
+        plan.stages = data['stages']
+
+        for batch, records in itertools.groupby(data['commands'],
+                                                lambda r: r['batch']):
+            batch = [planned_command(r['command'].encode('utf-8'),
+                                     r['inputs'], r['outputs'], r['cost'],
+                                     r['key'], r['stage']) for r in records]
+            plan.commands.extend(batch)
+            plan._graph.add_batch(batch)
+        return plan
+
+
+def _get_files(command, method_name):
+    """
+    Get the files declared by the command or `None` if the command does not
+    declare them.
+    """
+    method = getattr(command, method_name, None)
+    return method and method()
+
+
+class plan_runner(object):
+    """
+    Executes the execution plan. The finished commands are recorded in the
+    `journal_filename` journal, so when the execution is interrupted, running
+    the plan again executes only the remaining commands.
+
+    By default, the commands are executed by a pool of `cpu_no` workers,
+    each command as soon as the commands it depends on are finished (see
+    :py:class:`possum.pos_scheduler.dag_scheduler`). Alternatively, the
+    stages are executed one after another by the provided `executor` (e.g.
+    :py:class:`possum.pos_broker.queue_executor`).
+
+    :param plan: The plan to execute.
+    :type plan: :py:class:`execution_plan`
+
+    :param journal_filename: The journal of the executed commands.
+    :type journal_filename: str
+
+    >>> if os.path.exists('/tmp/pos_plan_journal_test'):
+    ...     os.remove('/tmp/pos_plan_journal_test')
+    >>> import pos_wrappers
+    >>> touch = pos_wrappers.touch_wrapper(files=['/tmp/pos_plan_runner_test'])
+    >>> plan = execution_plan()
+    >>> plan.add_batch([touch, "exit 2"], 'first', keys=[1, 2])
+    >>> plan.add_batch(["echo 3"], 'second')
+    >>> runner = plan_runner(plan, '/tmp/pos_plan_journal_test', cpu_no=2)
+    >>> [(c.key, r.returncode, r.stdout) for c, r in runner.run()]
+    [(1, 0, ''), (2, 2, ''), (None, None, '')]
+
+    When the plan is executed again, the commands which finished
+    successfully (and declare their files) are not executed:
+
+    >>> runner = plan_runner(plan, '/tmp/pos_plan_journal_test')
+    >>> [(r.returncode, r.cached) for c, r in runner.run(['first'])]
+    [(0, True), (2, False)]
+
+    >>> runner = plan_runner(plan, '/tmp/pos_plan_journal_test',
+    ...                      executor=pos_executors.pool_executor(cpu_no=2))
+    >>> [(r.returncode, r.cached) for c, r in runner.run()]
+    [(0, True), (2, False), (0, False)]
+    """
+
+    def __init__(self, plan, journal_filename=None, cpu_no=1, executor=None,
+                 retries=0, retry_delay=1.0):
+        self.plan = plan
+        self.cpu_no = cpu_no
+        self.executor = executor
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self._result_stores = [pos_journal.completed_commands()]
+        if journal_filename:
+            self._result_stores.append(
+                pos_journal.command_journal(journal_filename))
+
+    def run(self, stages=None):
+        """
+        Execute the plan.
+
+        :param stages: Names of the stages to execute. All the stages by
+            default.
+        :type stages: list of strings
+
+        :return: The (command, result) pairs in the order of the plan.
+        :rtype: list of tuples
+        """
+        graph = self.plan.get_graph(stages)
+        self._logger.info("Executing %d commands of %d stages.",
+                          len(graph), len(graph.batches))
+
+        if self.executor is None:
+            results = pos_scheduler.dag_scheduler(self.cpu_no,
+                self._result_stores, cost_model=planned_cost_model(),
+                retries=self.retries, retry_delay=self.retry_delay).run(graph)
+        else:
+            results = []
+            for batch in graph.batches:
+                results.extend(self._run_batch(
+                    [graph.commands[i] for i in batch]))
+
+        for command, result in zip(graph.commands, results):
+            if not result.success:
+                self._logger.error("Stage %s, slice %s: failed with exit "
+                    "code %s: %s", command.stage, command.key,
+                    result.returncode, command)
+        return zip(graph.commands, results)
+
+    def _run_batch(self, commands):
+        """
+        Execute the batch of commands with the executor, skipping the
+        commands found in the journal.
+        """
+        results = map(self._fetch_result, commands)
+        pending = [i for i, result in enumerate(results) if result is None]
+
+        self.executor.cost_model = planned_cost_model()
+        executed = self.executor.imap([commands[i] for i in pending])
+        for index, result in itertools.izip(pending, executed):
+            for store in self._result_stores:
+                store.store(commands[index], result)
+            results[index] = result
+        return results
+
+    def _fetch_result(self, command):
+        for store in self._result_stores:
+            result = store.fetch(command)
+            if result is not None:
+                return result
+        return None
+
+
+if __name__ == 'possum.pos_plan':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A content-addressed cache of the results of the command line wrappers.
+
+A command is identified by its rendered command string and by the contents of
+all the input files the command declares (see
+:py:meth:`possum.pos_wrappers.generic_wrapper.get_input_files`). When the
+same command is executed again on the same data, the declared output files as
+well as the command's stdout and stderr are restored from the cache instead of
+executing the command. This makes re-running a workflow with, e.g., only the
+reslicing or the output volume settings changed, almost instant.
+
+Only the commands which declare both their input and output files can be
+cached. The cache is bounded in size. When the limit is exceeded, the least
+recently used entries are removed until the cache shrinks well below the
+limit, so that the cache directory is not rescanned on every stored result.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+import pos_common
+import pos_executors
+
+class result_cache(object):
+    """
+    A cache of the command results stored in the `cache_dir` directory.
+
+    :param cache_dir: Directory holding the cached results. Created if it
+        does not exist.
+    :type cache_dir: str
+
+    :param max_size: Maximum size of the cache in bytes.
+    :type max_size: int
+
+    :param workdir: Working directory of the workflow. Every workflow uses
+        its own working directory, so the directory is not taken into account
+        when identifying the commands. Otherwise, the results could never be
+        reused by another run of the workflow.
+    :type workdir: str
+
+    >>> import pos_wrappers
+    >>> shutil.rmtree('/tmp/pos_result_cache_test', True)
+    >>> os.makedirs('/tmp/pos_result_cache_test/run_1')
+    >>> os.makedirs('/tmp/pos_result_cache_test/run_2')
+    >>> open('/tmp/pos_result_cache_test/input.txt', 'w').write('1')
+
+    >>> def copy_command(workdir):
+    ...     return pos_wrappers.chain_affine_transforms(
+    ...         input_transforms=['/tmp/pos_result_cache_test/input.txt'],
+    ...         output_transform=workdir + '/output.txt')
+
+    >>> c = result_cache('/tmp/pos_result_cache_test/cache',
+    ...                  workdir='/tmp/pos_result_cache_test/run_1')
+    >>> command = copy_command('/tmp/pos_result_cache_test/run_1')
+    >>> c.fetch(command)
+
+    >>> open('/tmp/pos_result_cache_test/run_1/output.txt', 'w').write('x')
+    >>> c.store(command, pos_executors.command_result(str(command), 0, 'out'))
+    True
+
+    The result can be reused by another run of the workflow:
+
+    >>> c = result_cache('/tmp/pos_result_cache_test/cache',
+    ...                  workdir='/tmp/pos_result_cache_test/run_2')
+    >>> result = c.fetch(copy_command('/tmp/pos_result_cache_test/run_2'))
+    >>> result.returncode, result.stdout, result.cached
+    (0, 'out', True)
+
+    >>> open('/tmp/pos_result_cache_test/run_2/output.txt').read()
+    'x'
+
+    But not when the contents of the input files have changed:
+
+    >>> open('/tmp/pos_result_cache_test/input.txt', 'w').write('2')
+    >>> c.fetch(copy_command('/tmp/pos_result_cache_test/run_2'))
+
+    Failed commands, plain strings and commands with missing inputs are
+    never cached:
+
+    >>> c.store(command, pos_executors.command_result(str(command), 1))
+    False
+    >>> c.store("echo 1", pos_executors.command_result("echo 1", 0))
+    False
+    >>> c.key(copy_command('/tmp/pos_result_cache_test/run_2').updateParameters(
+    ...     {'input_transforms': ['/tmp/pos_result_cache_test/missing.txt']}))
+
+    The wrappers use the cache when it is passed to them on execution:
+
+    >>> touch = pos_wrappers.touch_wrapper(
+    ...     files=['/tmp/pos_result_cache_test/touched'])
+    >>> execution = touch(cache=c)
+    Executing: touch /tmp/pos_result_cache_test/touched
+    <BLANKLINE>
+    <BLANKLINE>
+    >>> execution = touch(cache=c)
+    Restored from cache: touch /tmp/pos_result_cache_test/touched
+    <BLANKLINE>
+    <BLANKLINE>
+
+    An entry removed (e.g. evicted by another process) while it is being
+    restored is a miss:
+
+    >>> os.remove(os.path.join(c.cache_dir, c.key(touch), 'stdout'))
+    >>> print c.fetch(touch)
+    None
+
+    >>> c.size > 0
+    True
+    >>> result_cache('/tmp/pos_result_cache_test/cache', max_size=0).size
+    0
+    """
+
+    # Name of the file holding the description of the cache entry.
+    _ENTRY_METADATA = 'entry.json'
+
+    # Fraction of the size limit the cache is shrunk to when the limit is
+    # exceeded.
+    _EVICTION_TARGET = 0.9
+
+    def __init__(self, cache_dir, max_size=10 * 1024 ** 3, workdir=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.workdir = workdir
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Running total of the size of the cache. The entries stored by other
+        # processes are accounted for only when the cache is rescanned on
+        # eviction.
+        self._size = self._get_size()
+        if self._size > self.max_size:
+            self._evict()
+
+    def key(self, command):
+        """
+        Compute the key identifying the command.
+
+        :param command: The command to identify.
+        :type command: :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The key or `None` when the command cannot be cached.
+        :rtype: str
+        """
+        get_input_files = getattr(command, 'get_input_files', None)
+        get_output_files = getattr(command, 'get_output_files', None)
+        if get_input_files is None or get_output_files is None:
+            return None
+
+        input_files = get_input_files()
+        if input_files is None or get_output_files() is None:
+            return None
+
+        command_str = str(command)
+        if self.workdir:
+            command_str = command_str.replace(self.workdir, '{workdir}')
+
+        key = hashlib.sha1(command_str)
+        for filename in input_files:
+            if not os.path.isfile(filename):
+                return None
+            key.update(pos_common.hash_file(filename))
+        return key.hexdigest()
+
+    def fetch(self, command):
+        """
+        Restore the result of the command from the cache. The output files of
+        the command are copied to their destinations.
+
+        :param command: The command to look up.
+        :type command: :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: The cached result or `None` if the command is not cached.
+        :rtype: :py:class:`possum.pos_executors.command_result`
+        """
+        key = self.key(command)
+        if key is None:
+            return None
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        metadata_file = os.path.join(entry_dir, self._ENTRY_METADATA)
+        if not os.path.isfile(metadata_file):
+            return None
+
+        start_time = time.time()
+        try:
+            metadata = json.load(open(metadata_file))
+            for index, filename in enumerate(command.get_output_files()):
+                if index in metadata['missing_outputs']:
+                    continue
+                output_dir = os.path.dirname(filename)
+                if output_dir and not os.path.isdir(output_dir):
+                    os.makedirs(output_dir)
+                shutil.copyfile(os.path.join(entry_dir, str(index)), filename)
+
+            stdout = open(os.path.join(entry_dir, 'stdout'), 'rb').read()
+            stderr = open(os.path.join(entry_dir, 'stderr'), 'rb').read()
+
+            # Mark the entry as recently used.
+            os.utime(metadata_file, None)
+        except (IOError, OSError, ValueError):
+            # The entry was evicted by another process in the meantime. The
+            # command is executed again and overwrites the restored outputs.
+            self._logger.debug("Cache entry vanished while restoring: %s",
+                               entry_dir)
+            return None
+
+        self._logger.debug("Result restored from the cache: %s", str(command))
+        return pos_executors.command_result(str(command), 0, stdout, stderr,
+            start_time, time.time(), cached=True)
+
+    def store(self, command, result):
+        """
+        Put the result of the command into the cache. Only the successfully
+        executed commands are stored.
+
+        :param command: The executed command.
+        :type command: :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+
+        :return: `True` if the result was stored.
+        :rtype: bool
+        """
+        if not result.success:
+            return False
+
+        key = self.key(command)
+        if key is None:
+            return False
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return True
+
+        # The entry is prepared in a temporary directory and then moved into
+        # its place so the cache never contains incomplete entries.
+        temp_dir = entry_dir + '.%d.tmp' % os.getpid()
+        shutil.rmtree(temp_dir, True)
+        os.makedirs(temp_dir)
+
+        missing_outputs = []
+        for index, filename in enumerate(command.get_output_files()):
+            if os.path.isfile(filename):
+                shutil.copyfile(filename, os.path.join(temp_dir, str(index)))
+            else:
+                missing_outputs.append(index)
+
+        open(os.path.join(temp_dir, 'stdout'), 'wb').write(result.stdout)
+        open(os.path.join(temp_dir, 'stderr'), 'wb').write(result.stderr)
+
+        metadata = {'command': str(command),
+                    'missing_outputs': missing_outputs}
+        json.dump(metadata, open(os.path.join(temp_dir, self._ENTRY_METADATA), 'w'))
+
+        size = self._get_entry_size(temp_dir)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Somebody else has stored the very same result in the meantime.
+            shutil.rmtree(temp_dir, True)
+        else:
+            self._size += size
+
+        if self._size > self.max_size:
+            self._evict()
+        return True
+
+    def _get_entries(self):
+        """
+        Return the (last use time, size, directory) tuples of all the entries
+        in the cache.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            metadata_file = os.path.join(entry_dir, self._ENTRY_METADATA)
+            if not os.path.isfile(metadata_file):
+                continue
+
+            try:
+                entries.append((os.path.getmtime(metadata_file),
+                                self._get_entry_size(entry_dir), entry_dir))
+            except OSError:
+                # Evicted by another process in the meantime.
+                continue
+        return entries
+
+    def _get_entry_size(self, entry_dir):
+        return sum(os.path.getsize(os.path.join(entry_dir, filename))
+                   for filename in os.listdir(entry_dir))
+
+    def _get_size(self):
+        return sum(size for _, size, _ in self._get_entries())
+
+    size = property(_get_size)
+    """ Total size (in bytes) of the entries stored in the cache. """
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the size of the cache
+        drops to the `_EVICTION_TARGET` of the limit. The cache directory is
+        rescanned, so the running total of the size of the cache includes the
+        entries stored by other processes afterwards.
+        """
+        entries = sorted(self._get_entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        while entries and total_size > self.max_size * self._EVICTION_TARGET:
+            _, size, entry_dir = entries.pop(0)
+            self._logger.debug("Removing cache entry: %s", entry_dir)
+            shutil.rmtree(entry_dir, True)
+            total_size -= size
+        self._size = total_size
+
+
+if __name__ == 'possum.pos_result_cache':
+    import doctest
+    doctest.testmod()
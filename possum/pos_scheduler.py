@@ -0,0 +1,432 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Dependency-aware execution of several batches of commands.
+
+Workflows usually consist of a number of stages (e.g. calculating the
+transformations, then reslicing the images) and each stage is a batch of
+commands executed in parallel. Executing the stages one after another
+introduces a barrier between them: the whole stage has to finish before the
+first command of the next stage may start. This module removes the barriers.
+The commands of all the stages are put into a single task graph in which the
+dependencies are derived from the files read and written by the commands (see
+:py:meth:`possum.pos_wrappers.generic_wrapper.get_input_files` and
+:py:meth:`possum.pos_wrappers.generic_wrapper.get_output_files`). A command
+starts as soon as all the commands producing its inputs are done, so e.g. a
+given slice is resliced as soon as its transformation is available.
+"""
+
+import os
+import Queue
+import logging
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import pos_memory
+import pos_executors
+
+
+def _get_command_files(command, method_name):
+    """
+    Get the files read or written by the `command`. Returns `None` when the
+    files are not known, e.g. when the command is a plain string.
+    """
+    method = getattr(command, method_name, None)
+    if method is None:
+        return None
+
+    files = method()
+    if files is None:
+        return None
+    return [os.path.normpath(filename) for filename in files]
+
+
+class task_graph(object):
+    """
+    A graph of commands with the edges representing the dependencies between
+    the commands. A command depends on an earlier command when:
+
+        1. it reads a file written by the earlier command,
+        2. it writes a file written by the earlier command,
+        3. it writes a file read by the earlier command.
+
+    Commands which do not declare their input and output files (e.g. plain
+    strings) act as barriers: they depend on all the earlier commands and all
+    the later commands depend on them.
+
+    >>> import pos_wrappers
+    >>> transform = pos_wrappers.align_by_center_of_gravity(
+    ...     fixed_image='f.nii.gz', moving_image='m.nii.gz',
+    ...     output_transformation='t.txt')
+    >>> reslice = pos_wrappers.command_warp_grayscale_image(
+    ...     reference_image='f.nii.gz', moving_image='m.nii.gz',
+    ...     transformation='t.txt', output_image='r.nii.gz')
+    >>> other = pos_wrappers.command_warp_grayscale_image(
+    ...     reference_image='f.nii.gz', moving_image='m.nii.gz',
+    ...     transformation='other.txt', output_image='o.nii.gz')
+
+    >>> g = task_graph()
+    >>> g.add_batch([transform])
+    [0]
+    >>> g.add_batch([reslice, other])
+    [1, 2]
+    >>> g.add("echo barrier")
+    3
+    >>> g.add_batch([transform])
+    [4]
+
+    >>> len(g)
+    5
+
+    >>> map(sorted, g.dependencies)
+    [[], [0], [], [0, 1, 2], [3]]
+
+    >>> map(sorted, g.dependents)
+    [[1, 3], [3], [3], [4], []]
+
+    >>> g.batches
+    [[0], [1, 2], [4]]
+
+    The second command writing the same file has to wait for the first one
+    and for all the commands reading the file:
+
+    >>> g = task_graph()
+    >>> g.add_batch([transform, reslice, transform])
+    [0, 1, 2]
+    >>> map(sorted, g.dependencies)
+    [[], [0], [0, 1]]
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.dependencies = []
+        self.dependents = []
+
+        # Indexes of the commands added with the subsequent batches.
+        self.batches = []
+
+        # The most recent command writing given file and the commands which
+        # read the file since it was written.
+        self._writers = {}
+        self._readers = {}
+
+        # The last barrier and the commands added since then.
+        self._barrier = None
+        self._since_barrier = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command):
+        """
+        Add a single command to the graph.
+
+        :param command: Command to be added.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :return: Index of the command in the graph.
+        :rtype: int
+        """
+        index = len(self.commands)
+        inputs = _get_command_files(command, 'get_input_files')
+        outputs = _get_command_files(command, 'get_output_files')
+
+        dependencies = set()
+        if self._barrier is not None:
+            dependencies.add(self._barrier)
+
+        if inputs is None or outputs is None:
+            # Nothing is known about the command, it has to be executed after
+            # all the preceding commands and before all the subsequent ones.
+            dependencies.update(self._since_barrier)
+            self._barrier = index
+            self._since_barrier = []
+            self._writers = {}
+            self._readers = {}
+        else:
+            for filename in inputs:
+                if filename in self._writers:
+                    dependencies.add(self._writers[filename])
+
+            for filename in outputs:
+                if filename in self._writers:
+                    dependencies.add(self._writers[filename])
+                dependencies.update(self._readers.get(filename, []))
+
+            for filename in inputs:
+                self._readers.setdefault(filename, []).append(index)
+
+            for filename in outputs:
+                self._writers[filename] = index
+                self._readers[filename] = []
+
+            self._since_barrier.append(index)
+
+        dependencies.discard(index)
+
+        self.commands.append(command)
+        self.dependencies.append(dependencies)
+        self.dependents.append(set())
+        for dependency in dependencies:
+            self.dependents[dependency].add(index)
+
+        return index
+
+    def add_batch(self, commands):
+        """
+        Add a batch of commands to the graph.
+
+        :param commands: Commands to be added.
+        :type commands: iterable
+
+        :return: Indexes of the commands in the graph.
+        :rtype: list of ints
+        """
+        indexes = [self.add(command) for command in commands]
+        self.batches.append(indexes)
+        return indexes
+
+
+class dag_scheduler(object):
+    """
+    Executes the commands from a :py:class:`task_graph` using a pool of
+    `cpu_no` workers. A command is started as soon as all the commands it
+    depends on are finished. When a command fails, the commands depending on
+    it (directly or not) are not executed at all and are reported as failed.
+
+    When the `result_stores` (e.g.
+    :py:class:`possum.pos_journal.command_journal` or
+    :py:class:`possum.pos_result_cache.result_cache`) are provided, the
+    results of the commands are looked up in the stores right before the
+    commands are started (i.e. when their input files are available) and the
+    results of the commands are recorded in all the stores.
+
+    When the `memory_limit` (in bytes) is set, the commands which are ready
+    to run are started only while their memory usage, as predicted by the
+    `memory_model`, fits the limit (see :py:mod:`possum.pos_memory`).
+
+    The CPUs are split between the commands of each batch (see
+    :py:func:`possum.pos_executors.get_threads_per_job`) unless the
+    `threads_per_job` is given. Commands added to the graph one by one may
+    use all the CPUs.
+
+    Possum's python tools are executed by the `tool_pool` (see
+    :py:mod:`possum.pos_tool_pool`), if provided. The output of the commands
+    is captured according to the `capture` policy (see
+    :py:class:`possum.pos_executors.output_capture`).
+
+    When the `cost_model` (see :py:class:`possum.pos_cost.cost_model`) is
+    provided, the commands which become ready at the same time are started
+    from the most expensive one.
+
+    Commands failing transiently (e.g. crashing with a segmentation fault)
+    are executed again, up to `retries` times, after a delay starting at
+    `retry_delay` seconds and doubling with every attempt (see
+    :py:func:`possum.pos_executors.run_with_retries`).
+
+    >>> g = task_graph()
+    >>> g.add_batch(["echo a", "exit 3", "echo c"])
+    [0, 1, 2]
+    >>> results = dag_scheduler(cpu_no=2).run(g)
+    >>> [(r.returncode, r.stdout) for r in results]
+    [(0, 'a\\n'), (3, ''), (None, '')]
+
+    >>> results[2].stderr
+    'Skipped: a command this one depends on has failed.\\n'
+
+    >>> g = task_graph()
+    >>> g.add_batch(["kill -SEGV $$"])
+    [0]
+    >>> r = dag_scheduler(retries=1, retry_delay=0.01).run(g)[0]
+    >>> r.returncode, r.attempts
+    (-11, 2)
+
+    A command which cannot be executed at all fails with the traceback of
+    the error:
+
+    >>> class broken_tool_pool(object):
+    ...     def run(self, command_str, **kwargs):
+    ...         raise IOError("The worker is gone")
+    >>> g = task_graph()
+    >>> g.add_batch(["echo a"]) + g.add_batch(["echo b"])
+    [0, 1]
+    >>> a, b = dag_scheduler(tool_pool=broken_tool_pool()).run(g)
+    >>> a.success, a.stderr.splitlines()[-1]
+    (False, 'IOError: The worker is gone')
+    >>> b.stderr
+    'Skipped: a command this one depends on has failed.\\n'
+
+    >>> dag_scheduler().run(task_graph())
+    []
+
+    The order of execution respects the dependencies even when the
+    dependencies are finished in a different order than they were submitted:
+
+    >>> g = task_graph()
+    >>> g.add_batch(["sleep 0.3; echo a > /dev/null"]) + g.add_batch(["echo b"])
+    [0, 1]
+    >>> results = dag_scheduler(cpu_no=4).run(g)
+    >>> results[0].end_time <= results[1].start_time
+    True
+
+    Independent commands do not run concurrently when they would exceed the
+    memory limit:
+
+    >>> g = task_graph()
+    >>> g.add_batch(["sleep 0.2", "sleep 0.2"])
+    [0, 1]
+    >>> results = dag_scheduler(cpu_no=2, memory_limit=48 * 1024 ** 2,
+    ...     memory_model=pos_memory.memory_model()).run(g)
+    >>> results[0].end_time <= results[1].start_time
+    True
+
+    >>> g = task_graph()
+    >>> threads = "echo $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+    >>> g.add_batch([threads]) + g.add_batch([threads] * 2)
+    [0, 1, 2]
+    >>> [r.stdout for r in dag_scheduler(cpu_no=4).run(g)]
+    ['4\\n', '2\\n', '2\\n']
+    """
+
+    # Interval (in seconds) of waiting for the next finished command. Waiting
+    # without a timeout makes the scheduler deaf to keyboard interrupts.
+    _POLL_INTERVAL = 1.0
+
+    def __init__(self, cpu_no=1, result_stores=None, memory_limit=None,
+                 memory_model=None, threads_per_job=None, tool_pool=None,
+                 capture=None, cost_model=None, retries=0, retry_delay=1.0):
+        self.cpu_no = cpu_no
+        self.result_stores = result_stores or []
+        self.memory_limit = memory_limit
+        self.memory_model = memory_model
+        self.threads_per_job = threads_per_job
+        self.tool_pool = tool_pool
+        self.capture = capture
+        self.cost_model = cost_model
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _get_order(self, graph, indexes):
+        """
+        Order the commands which are ready to run, the most expensive first.
+        """
+        indexes = sorted(indexes)
+        if self.cost_model is None or len(indexes) < 2:
+            return indexes
+        order = self.cost_model.order([graph.commands[i] for i in indexes])
+        return [indexes[i] for i in order]
+
+    def run(self, graph):
+        """
+        Execute all the commands from the graph.
+
+        :param graph: The commands to execute.
+        :type graph: :py:class:`task_graph`
+
+        :return: The outcomes of the commands in the order in which the
+            commands were added to the graph.
+        :rtype: list of :py:class:`possum.pos_executors.command_result`
+        """
+        # Commands are rendered in the calling thread so that the (not
+        # necessarily thread-safe) wrappers are never touched by the workers.
+        command_strings = map(str, graph.commands)
+        results = [None] * len(graph)
+        waiting_for = [len(dependencies) for dependencies in graph.dependencies]
+        finished = Queue.Queue()
+
+        budget = None
+        if self.memory_limit and self.memory_model is not None:
+            budget = pos_memory.memory_budget(self.memory_limit)
+
+        threads = [self.threads_per_job or self.cpu_no] * len(graph)
+        if not self.threads_per_job:
+            for batch in graph.batches:
+                batch_threads = pos_executors.get_threads_per_job(
+                    self.cpu_no, len(batch))
+                for index in batch:
+                    threads[index] = batch_threads
+
+        pool = ThreadPool(max(1, self.cpu_no))
+
+        def submit(index):
+            for store in self.result_stores:
+                result = store.fetch(graph.commands[index])
+                if result is not None:
+                    finished.put((index, result))
+                    return
+
+            # The memory usage is predicted when the command's inputs are
+            # available, so the sizes of the input images are known.
+            memory = 0
+            if budget is not None:
+                memory = self.memory_model.estimate(graph.commands[index])
+
+            self._logger.debug("Starting command %d: %s",
+                               index, command_strings[index])
+            pool.apply_async(execute, (index, memory))
+
+        def execute(index, memory):
+            # Every outcome is reported, otherwise the scheduler would wait
+            # for the command forever.
+            try:
+                result = pos_executors.run_within_budget(
+                    command_strings[index], memory, budget, threads[index],
+                    self.tool_pool, self.capture, None, self.retries,
+                    self.retry_delay)
+            except Exception:
+                result = pos_executors.command_result(command_strings[index],
+                    stderr=traceback.format_exc())
+            finished.put((index, result))
+
+        def skip(index):
+            results[index] = pos_executors.command_result(
+                command_strings[index],
+                stderr="Skipped: a command this one depends on has failed.\n")
+            self._logger.error("Skipping command %d: %s",
+                               index, command_strings[index])
+
+        try:
+            ready = [i for i, count in enumerate(waiting_for) if count == 0]
+            map(submit, self._get_order(graph, ready))
+
+            done = 0
+            while done < len(graph):
+                try:
+                    index, result = finished.get(True, self._POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                results[index] = result
+                done += 1
+
+                for store in self.result_stores:
+                    store.store(graph.commands[index], result)
+
+                # Release the dependent commands or, if the command has
+                # failed, skip all the commands which depend on it.
+                if result.success:
+                    ready = []
+                    for dependent in graph.dependents[index]:
+                        waiting_for[dependent] -= 1
+                        if waiting_for[dependent] == 0:
+                            ready.append(dependent)
+                    map(submit, self._get_order(graph, ready))
+                else:
+                    to_skip = list(graph.dependents[index])
+                    while to_skip:
+                        dependent = to_skip.pop()
+                        if results[dependent] is None:
+                            skip(dependent)
+                            done += 1
+                            to_skip.extend(graph.dependents[dependent])
+        finally:
+            pool.close()
+            pool.join()
+
+        return results
+
+
+if __name__ == 'possum.pos_scheduler':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+An in-process engine measuring the similarity between pairs of slices.
+
+The sequential alignment workflow measures the similarity of every pair of
+slices connected by a partial transformation. Doing this with a `c2d` process
+per pair reads (and resamples) every slice as many times as there are pairs
+the slice belongs to. The :py:class:`similarity_engine` splits the pairs into
+batches of neighbouring pairs, so within a batch every slice is read only
+once, and processes the batches in a pool of worker processes. The moving
+slice of every pair is resampled into the space of the reference slice with
+the affine transformation of the pair (bilinear interpolation, the voxels
+mapped outside the moving slice are zero, just as `c2d -reslice-itk` does)
+and the similarity is computed with numpy.
+
+The following metrics are available (see :py:data:`METRICS`):
+
+    1. `ncor` -- the normalized correlation,
+    2. `mmi` -- the mutual information,
+    3. `msq` -- the mean squared difference.
+
+Following the itk metrics used by `c2d`, the lower the value, the more
+similar the images are: the normalized correlation and the mutual
+information are negated. The transformations act on the physical points, so
+the spacing, the origin and the direction matrix of the slices are taken
+into account, just as the itk does.
+"""
+
+import logging
+import itertools
+import multiprocessing
+
+import pos_common
+import pos_slice_index
+import pos_affine
+
+np = pos_common.lazy_module('numpy')
+ndimage = pos_common.lazy_module('scipy.ndimage')
+
+# Number of batches per worker. More batches balance the load better, but
+# the slices at the boundaries of the batches are read more than once.
+_BATCHES_PER_WORKER = 4
+
+
+def resample(moving, moving_header, reference_shape, reference_header,
+             matrix=None, offset=None):
+    """
+    Resample the moving image into the space of the reference image.
+
+    :param moving: The moving image, in the C order.
+    :type moving: `numpy.ndarray`
+
+    :param moving_header: The `spacing`, the `origin` and the `direction` of
+        the moving image (see :py:func:`possum.pos_slice_index.read_image`).
+    :type moving_header: dict
+
+    :param reference_shape: The shape of the reference image.
+    :type reference_shape: tuple
+
+    :param reference_header: The `spacing`, the `origin` and the
+        `direction` of the reference image.
+    :type reference_header: dict
+
+    :param matrix: The matrix of the transformation mapping the physical
+        points of the reference image onto the moving image. The identity by
+        default.
+    :type matrix: `numpy.ndarray`
+
+    :param offset: The offset of the transformation.
+    :type offset: `numpy.ndarray`
+
+    :rtype: `numpy.ndarray`
+
+    >>> moving = np.arange(12, dtype=float).reshape(3, 4)
+    >>> resample(moving, {}, (3, 4), {}).tolist() == moving.tolist()
+    True
+    >>> resample(moving, {}, (2, 2), {}, np.eye(2), np.array([1.5, 1])).tolist()
+    [[5.5, 6.5], [9.5, 10.5]]
+    >>> resample(moving, {}, (2, 2), {}, np.eye(2), np.array([2.5, 1.5])).tolist()
+    [[8.5, 0.0], [0.0, 0.0]]
+    >>> resample(moving, {'spacing': [2, 2]}, (2, 2), {}).tolist()
+    [[0.0, 0.5], [2.0, 2.5]]
+
+    The physical point of the voxel is `origin + direction * (spacing *
+    index)`. ITK often reads the NIfTI slices with the flipped axes:
+
+    >>> flipped = {'origin': [3, 2], 'direction': [[-1, 0], [0, -1]]}
+    >>> resample(moving, flipped, (3, 4), flipped).tolist() == moving.tolist()
+    True
+    >>> resample(moving, flipped, (2, 2), flipped, np.eye(2),
+    ...          np.array([-1.5, -1])).tolist()
+    [[5.5, 6.5], [9.5, 10.5]]
+    >>> resample(moving, flipped, (3, 4), {'origin': [0, 0]}).tolist()[0]
+    [11.0, 10.0, 9.0, 8.0]
+    """
+    dimension = len(reference_shape)
+    reference_spacing, reference_origin, reference_direction = \
+        _get_geometry(reference_header, dimension)
+    moving_spacing, moving_origin, moving_direction = \
+        _get_geometry(moving_header, dimension)
+    if matrix is None:
+        matrix, offset = np.eye(dimension), np.zeros(dimension)
+
+    # Physical coordinates of the reference voxels, in the image index order
+    # (x, y, ...), one row per axis.
+    grid = np.indices(reference_shape[::-1], dtype=np.float64)
+    grid = grid.reshape(dimension, -1)
+    points = reference_origin[:, None] + \
+        np.dot(reference_direction, reference_spacing[:, None] * grid)
+
+    points = np.dot(matrix, points) + offset[:, None]
+    indexes = np.dot(np.linalg.inv(moving_direction),
+                     points - moving_origin[:, None]) / moving_spacing[:, None]
+
+    # The arrays are indexed in the reverse order.
+    resampled = ndimage.map_coordinates(moving.astype(np.float64),
+        indexes[::-1], order=1, mode='constant', cval=0.0)
+    return resampled.reshape(reference_shape[::-1]).T
+
+
+def _get_geometry(header, dimension):
+    spacing = header.get('spacing') or [1.0] * dimension
+    origin = header.get('origin') or [0.0] * dimension
+    direction = header.get('direction') or np.eye(dimension)
+    return np.array(spacing, dtype=np.float64), \
+        np.array(origin, dtype=np.float64), \
+        np.array(direction, dtype=np.float64)
+
+
+def normalized_correlation(reference, moving):
+    """
+    The negated normalized correlation of the images.
+
+    >>> a = np.array([[1.0, 2.0], [0.0, 3.0]])
+    >>> normalized_correlation(a, a), normalized_correlation(a, 2 * a)
+    (-1.0, -1.0)
+    >>> round(normalized_correlation(a, a[::-1]), 4)
+    -0.8571
+    >>> normalized_correlation(a, np.zeros((2, 2)))
+    0.0
+    """
+    reference = reference.astype(np.float64).ravel()
+    moving = moving.astype(np.float64).ravel()
+    denominator = np.sqrt(np.dot(reference, reference) *
+                          np.dot(moving, moving))
+    if not denominator:
+        return 0.0
+    return float(-np.dot(reference, moving) / denominator) + 0.0
+
+
+def mutual_information(reference, moving, bins=32):
+    """
+    The negated mutual information of the images, estimated from their joint
+    histogram with `bins` bins along every axis.
+
+    >>> a = np.array([[0.0, 1.0], [2.0, 3.0]])
+    >>> round(mutual_information(a, a, bins=4), 4)
+    -1.3863
+    >>> mutual_information(a, np.ones((2, 2)), bins=4)
+    0.0
+    """
+    joint, edges_x, edges_y = np.histogram2d(reference.ravel(),
+                                             moving.ravel(), bins=bins)
+    joint = joint / joint.sum()
+    marginal_reference = joint.sum(axis=1)[:, None]
+    marginal_moving = joint.sum(axis=0)[None, :]
+
+    nonzero = joint > 0
+    information = np.sum(joint[nonzero] * np.log(joint[nonzero] /
+        (marginal_reference * marginal_moving)[nonzero]))
+    return float(-information) + 0.0
+
+
+def mean_squares(reference, moving):
+    """
+    The mean squared difference of the images.
+
+    >>> mean_squares(np.array([1.0, 2.0]), np.array([3.0, 2.0]))
+    2.0
+    """
+    difference = reference.astype(np.float64) - moving.astype(np.float64)
+    return float(np.mean(difference ** 2))
+
+
+# The metrics available for the engine.
+METRICS = {'ncor': normalized_correlation,
+           'mmi': mutual_information,
+           'msq': mean_squares}
+
+
+def _measure_batch(args):
+    """
+    Measure the similarity of a batch of pairs. Every image is read once per
+    batch. Executed by the workers.
+    """
+    pairs, metric, bins, reader = args
+    images = {}
+
+    def read(filename):
+        if filename not in images:
+            image = reader(filename)
+            images[filename] = isinstance(image, tuple) and image or \
+                (image, {})
+        return images[filename]
+
+    results = []
+    for key, reference_filename, moving_filename, transformation in pairs:
+        reference, reference_header = read(reference_filename)
+        moving, moving_header = read(moving_filename)
+
+        matrix, offset = None, None
+        if transformation:
+            affine = pos_affine.read_transformations([transformation])
+            matrix, offset = affine.matrices[0, :-1, :-1], \
+                affine.matrices[0, :-1, -1]
+        resampled = resample(moving, moving_header, reference.shape,
+                             reference_header, matrix, offset)
+
+        if metric == 'mmi':
+            value = mutual_information(reference, resampled, bins)
+        else:
+            value = METRICS[metric](reference, resampled)
+        results.append((key, value))
+    return results
+
+
+class similarity_engine(object):
+    """
+    Measures the similarity of pairs of images in `processes` worker
+    processes.
+
+    :param processes: Number of the worker processes. The number of the CPUs
+        by default. With a single process, the similarity is computed within
+        the calling process.
+    :type processes: int
+
+    :param metric: The similarity metric, one of the :py:data:`METRICS`.
+    :type metric: str
+
+    :param bins: Number of the histogram bins of the mutual information.
+    :type bins: int
+
+    :param reader: Reads the images (see
+        :py:class:`possum.pos_slice_index.slice_index`).
+    :type reader: callable
+
+    >>> a = np.zeros((6, 6))
+    >>> a[1:4, 1:3] = [[1, 2], [3, 4], [5, 6]]
+    >>> np.save('/tmp/pos_similarity_0.npy', a)
+    >>> np.save('/tmp/pos_similarity_1.npy', np.roll(a, 2, axis=1))
+    >>> open('/tmp/pos_similarity_shift.txt', 'w').write(
+    ...     "#Insight Transform File V1.0\\n#Transform 0\\n"
+    ...     "Transform: MatrixOffsetTransformBase_double_2_2\\n"
+    ...     "Parameters: 1 0 0 1 2 0\\n"
+    ...     "FixedParameters: 0 0\\n")
+
+    >>> engine = similarity_engine(2, reader=np.load)
+    >>> pairs = [((0, 1), '/tmp/pos_similarity_0.npy',
+    ...           '/tmp/pos_similarity_1.npy', None),
+    ...          ((0, 2), '/tmp/pos_similarity_0.npy',
+    ...           '/tmp/pos_similarity_1.npy', '/tmp/pos_similarity_shift.txt')]
+    >>> similarity = engine.compute(pairs)
+    >>> similarity[(0, 1)], similarity[(0, 2)]
+    (0.0, -1.0)
+
+    >>> similarity_engine(1, 'msq', reader=np.load).compute(pairs)[(0, 2)]
+    0.0
+    """
+
+    def __init__(self, processes=None, metric='ncor', bins=32,
+                 reader=pos_slice_index.read_image):
+        if metric not in METRICS:
+            raise ValueError("Unknown similarity metric: %s" % metric)
+
+        self.processes = processes or multiprocessing.cpu_count()
+        self.metric = metric
+        self.bins = bins
+        self.reader = reader
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def compute(self, pairs):
+        """
+        Measure the similarity of the pairs of images.
+
+        :param pairs: The (key, reference image, moving image, affine
+            transformation file) tuples. The transformation maps the reference
+            image onto the moving image (as the ANTS transformations do).
+            `None` stands for the identity transformation.
+        :type pairs: list of tuples
+
+        :return: The similarity of every pair, by the key of the pair.
+        :rtype: dict
+        """
+        pairs = list(pairs)
+        self._logger.info("Measuring the similarity (%s) of %d pairs.",
+                          self.metric, len(pairs))
+
+        workers = min(self.processes, len(pairs))
+        batches_no = max(1, workers * _BATCHES_PER_WORKER)
+        size = -(-len(pairs) // batches_no)
+        tasks = [(pairs[i:i + size], self.metric, self.bins, self.reader)
+                 for i in range(0, len(pairs), size or 1)]
+
+        if workers <= 1:
+            results = map(_measure_batch, tasks)
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(_measure_batch, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return dict(itertools.chain(*results))
+
+
+if __name__ == 'possum.pos_similarity':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+The graph of the slices used by the sequential alignment to find the chains
+of the partial transformations.
+
+In the sequential alignment every slice is registered only to the slices at
+most `epsilon` slices away. Thus, the edges of the graph form a band along
+the diagonal of the adjacency matrix, and the graph is stored as a dense
+array of `2 * epsilon + 1` weights per slice (:py:class:`banded_graph`)
+instead of the dictionaries of dictionaries of networkx.
+
+Only the paths from the reference slice are ever needed, so a single
+Dijkstra search from the reference slice computes the tree of the shortest
+paths (:py:class:`shortest_path_tree`), and the chain of every slice is read
+from the tree.
+"""
+
+import heapq
+
+import pos_common
+
+np = pos_common.lazy_module('numpy')
+
+
+class banded_graph(object):
+    """
+    A directed graph of the slices `first` to `last` (inclusive) with edges
+    connecting the slices at most `bandwidth` slices away. The weights of the
+    edges have to be non-negative.
+
+    :param first: Index of the first slice.
+    :type first: int
+
+    :param last: Index of the last slice.
+    :type last: int
+
+    :param bandwidth: The maximum distance of the slices connected by an edge.
+    :type bandwidth: int
+
+    >>> g = banded_graph(10, 14, 2)
+    >>> g.add_weighted_edges_from([(12, 11, 1.0), (11, 10, 1.0),
+    ...     (12, 10, 3.0), (12, 13, 0.5), (13, 14, 0.5), (12, 14, 0.5),
+    ...     (12, 12, 0.0)])
+    >>> len(g), g.number_of_edges()
+    (5, 7)
+    >>> g.get_weight(12, 10), g.get_weight(10, 12), g.get_weight(12, 12)
+    (3.0, None, 0.0)
+    >>> list(g.edges())[:2]
+    [(11, 10, 1.0), (12, 10, 3.0)]
+
+    >>> g.add_edge(10, 13, 1.0)
+    Traceback (most recent call last):
+    ...
+    ValueError: Edge (10, 13) exceeds the bandwidth of the graph.
+    >>> g.add_edge(10, 11, -1.0)
+    Traceback (most recent call last):
+    ...
+    ValueError: Negative weight of the edge (10, 11).
+
+    >>> g.write_weighted_edgelist('/tmp/pos_slice_graph_test.txt')
+    >>> print open('/tmp/pos_slice_graph_test.txt').read().splitlines()[0]
+    11 10 1.0
+    """
+
+    def __init__(self, first, last, bandwidth):
+        self.first = first
+        self.last = last
+        self.bandwidth = bandwidth
+
+        # The weight of the (u, v) edge is stored in the row of the `u` slice,
+        # in the `v - u + bandwidth` column. Missing edges are infinite.
+        self.weights = np.empty((last - first + 1, 2 * bandwidth + 1))
+        self.weights.fill(np.inf)
+
+    def __len__(self):
+        return self.weights.shape[0]
+
+    def __contains__(self, node):
+        return self.first <= node <= self.last
+
+    def add_edge(self, u, v, weight):
+        """
+        Add the (u, v) edge or change its weight.
+        """
+        if u not in self or v not in self:
+            raise ValueError("Edge (%d, %d) connects slices outside the "
+                             "graph." % (u, v))
+        if abs(v - u) > self.bandwidth:
+            raise ValueError("Edge (%d, %d) exceeds the bandwidth of the "
+                             "graph." % (u, v))
+        if weight < 0:
+            raise ValueError("Negative weight of the edge (%d, %d)." % (u, v))
+        self.weights[u - self.first, v - u + self.bandwidth] = weight
+
+    def add_weighted_edges_from(self, edges):
+        """
+        Add the (u, v, weight) edges.
+        """
+        for u, v, weight in edges:
+            self.add_edge(u, v, weight)
+
+    def get_weight(self, u, v):
+        """
+        :return: The weight of the (u, v) edge, `None` if there is no such
+            edge.
+        """
+        if u not in self or abs(v - u) > self.bandwidth:
+            return None
+        weight = self.weights[u - self.first, v - u + self.bandwidth]
+        if not np.isfinite(weight):
+            return None
+        return float(weight)
+
+    def edges(self):
+        """
+        Iterate over the (u, v, weight) edges, ordered by the `u` and the `v`
+        slices.
+        """
+        rows, columns = np.nonzero(np.isfinite(self.weights))
+        for row, column in zip(rows, columns):
+            u = int(row) + self.first
+            yield u, u + int(column) - self.bandwidth, \
+                float(self.weights[row, column])
+
+    def number_of_edges(self):
+        return int(np.isfinite(self.weights).sum())
+
+    def write_weighted_edgelist(self, filename):
+        """
+        Write the edges into a file, one `u v weight` line per edge (as
+        `networkx.write_weighted_edgelist` does).
+        """
+        edges_file = open(filename, 'w')
+        for edge in self.edges():
+            edges_file.write("%d %d %s\n" % edge)
+        edges_file.close()
+
+    def shortest_path_tree(self, source):
+        """
+        Find the shortest paths from the `source` slice to all the other
+        slices with the Dijkstra's algorithm.
+
+        :rtype: :py:class:`shortest_path_tree`
+        """
+        nodes_no = len(self)
+        distances = np.empty(nodes_no)
+        distances.fill(np.inf)
+        predecessors = -np.ones(nodes_no, dtype=np.int64)
+        done = np.zeros(nodes_no, dtype=bool)
+
+        # Offsets of the neighbours within the band. Only the existing (finite)
+        # edges are followed.
+        offsets = np.arange(-self.bandwidth, self.bandwidth + 1)
+        finite = np.isfinite(self.weights)
+
+        source = source - self.first
+        distances[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            distance, u = heapq.heappop(heap)
+            if done[u]:
+                continue
+            done[u] = True
+
+            row = finite[u]
+            for v, weight in zip((u + offsets[row]).tolist(),
+                                 self.weights[u, row].tolist()):
+                if distance + weight < distances[v]:
+                    distances[v] = distance + weight
+                    predecessors[v] = u
+                    heapq.heappush(heap, (distance + weight, v))
+
+        return shortest_path_tree(source + self.first, self.first,
+                                  predecessors, distances)
+
+
+class shortest_path_tree(object):
+    """
+    The shortest paths from the `source` slice to all the other slices,
+    represented by the predecessor of every slice on its path.
+
+    >>> g = banded_graph(0, 5, 2)
+    >>> g.add_weighted_edges_from([(2, 1, 1.0), (1, 0, 1.0), (2, 0, 3.0),
+    ...     (2, 3, 1.0), (3, 4, 1.0), (2, 4, 1.5), (4, 5, 1.0), (3, 5, 1.0)])
+    >>> tree = g.shortest_path_tree(2)
+    >>> tree.path(0), tree.path(2), tree.path(4), tree.path(5)
+    ([2, 1, 0], [2], [2, 4], [2, 3, 5])
+    >>> tree.distance(0), tree.distance(5)
+    (2.0, 2.0)
+
+    >>> g.add_edge(3, 3, 0.0)
+    >>> g.shortest_path_tree(3).path(0)
+    Traceback (most recent call last):
+    ...
+    KeyError: 'Slice 0 is not reachable from slice 3.'
+    """
+
+    def __init__(self, source, first, predecessors, distances):
+        self.source = source
+        self.first = first
+        self.predecessors = predecessors
+        self.distances = distances
+
+    def distance(self, node):
+        """
+        :return: The length of the shortest path to the `node` slice.
+        :rtype: float
+        """
+        return float(self.distances[node - self.first])
+
+    def path(self, node):
+        """
+        :return: The slices of the shortest path from the source slice to the
+            `node` slice.
+        :rtype: list of ints
+        """
+        if not np.isfinite(self.distances[node - self.first]):
+            raise KeyError("Slice %d is not reachable from slice %d." %
+                           (node, self.source))
+
+        path = [node]
+        index = node - self.first
+        while self.predecessors[index] >= 0:
+            index = int(self.predecessors[index])
+            path.append(index + self.first)
+        return path[::-1]
+
+    def edges(self):
+        """
+        :return: The (slice, predecessor) edges of the tree.
+        :rtype: list of tuples
+
+        >>> g = banded_graph(0, 3, 1)
+        >>> g.add_weighted_edges_from([(1, 0, 1.0), (1, 2, 1.0), (2, 3, 1.0)])
+        >>> g.shortest_path_tree(1).edges()
+        [(0, 1), (2, 1), (3, 2)]
+        """
+        nodes = np.flatnonzero(self.predecessors >= 0)
+        return zip((nodes + self.first).tolist(),
+                   (self.predecessors[nodes] + self.first).tolist())
+
+    def accumulate(self, edge_value, combine, initial):
+        """
+        Accumulate the values of the edges along the paths from the source
+        slice, e.g. compose the transformations of the edges. Every edge of the
+        tree is visited once and the accumulated value of every slice is
+        calculated from the value of its predecessor.
+
+        :param edge_value: Returns the value of the (slice, predecessor) edge.
+        :type edge_value: callable
+
+        :param combine: Combines the value of the edge with the accumulated
+            value of the predecessor.
+        :type combine: callable
+
+        :param initial: The value of the source slice.
+
+        :return: The accumulated values of the reachable slices.
+        :rtype: dict
+
+        >>> g = banded_graph(0, 4, 2)
+        >>> g.add_weighted_edges_from([(2, 1, 1.0), (1, 0, 1.0), (2, 3, 1.0),
+        ...     (2, 4, 3.0), (3, 4, 1.0)])
+        >>> tree = g.shortest_path_tree(2)
+        >>> tree.accumulate(lambda u, v: "%d%d" % (u, v),
+        ...                 lambda edge, path: path + "," + edge, "")
+        {0: ',12,01', 1: ',12', 2: '', 3: ',32', 4: ',32,43'}
+        """
+        results = {self.source: initial}
+        for index in np.flatnonzero(np.isfinite(self.distances)):
+            node = int(index) + self.first
+            stack = []
+            while node not in results:
+                stack.append(node)
+                node = int(self.predecessors[node - self.first]) + self.first
+
+            while stack:
+                child = stack.pop()
+                results[child] = combine(edge_value(child, node), results[node])
+                node = child
+        return results
+
+
+if __name__ == 'possum.pos_slice_graph':
+    import doctest
+    doctest.testmod()
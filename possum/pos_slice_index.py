@@ -0,0 +1,401 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A persistent index of the statistics of the slices.
+
+Several stages of the workflows need a few simple numbers describing every
+slice of the stack: whether the slice is blank, where its content is located,
+where its centre of gravity lies. Computing them with a separate `c2d`
+process per slice takes minutes for stacks of thousands of slices. The
+:py:class:`slice_index` reads every slice once, in a pool of worker processes,
+and computes all the statistics at once with numpy:
+
+    1. the header of the slice: the `size` (in voxels, in the image index
+       order), the `spacing`, the `origin`, the `direction` matrix, the
+       number of `components` and the pixel type (`dtype`),
+    2. the `voxel_count` -- the number of voxels different than the
+       background,
+    3. the `bounding_box` of these voxels -- the first and the last index
+       along every axis, `None` for blank slices,
+    4. the first order moments: the `total_intensity` and the
+       `center_of_gravity` (in the physical coordinates),
+    5. the intensity `histogram` of the slice (`bins` bins spanning the
+       intensity `range` of the slice).
+
+The statistics are stored in the index file (:py:data:`INDEX_FILENAME`)
+located in the directory of the slices, along with the size and the
+modification time of every slice. A slice is read again only when it has
+changed, so the index is shared by all the workflows processing the same
+stack.
+"""
+
+import os
+import json
+import logging
+import multiprocessing
+
+import pos_common
+import pos_itk_core
+
+np = pos_common.lazy_module('numpy')
+itk = pos_common.lazy_module('itk')
+
+# Name of the index file, stored in the directory of the indexed slices.
+INDEX_FILENAME = '.pos_slice_index.json'
+
+# Version of the statistics. The entries of an index created by another
+# version are computed again.
+INDEX_VERSION = 2
+
+# Number of slices sent to a worker at once.
+_CHUNK_SIZE = 8
+
+
+def read_image(filename):
+    """
+    Read the image with the itk.
+
+    :param filename: The image file.
+    :type filename: str
+
+    :return: The image as a numpy array (in the C order, the components of
+        the multichannel images along the last axis) and the header of the
+        image (a dictionary with the `spacing`, the `origin` and the
+        `direction` matrix, as a list of rows).
+    :rtype: tuple
+    """
+    image_type = pos_itk_core.autodetect_file_type(filename)
+    reader = itk.ImageFileReader[image_type].New(FileName=filename)
+    reader.Update()
+    image = reader.GetOutput()
+
+    if hasattr(itk, 'GetArrayFromImage'):
+        array = itk.GetArrayFromImage(image)
+    else:
+        array = itk.PyBuffer[image_type].GetArrayFromImage(image)
+
+    dimension = len(image.GetSpacing())
+    direction = image.GetDirection().GetVnlMatrix()
+    header = {'spacing': list(image.GetSpacing()),
+              'origin': list(image.GetOrigin()),
+              'direction': [[direction.get(row, column)
+                             for column in range(dimension)]
+                            for row in range(dimension)]}
+    # The array is a view of the buffer of the image.
+    return np.array(array), header
+
+
+def compute_statistics(array, background=0, bins=32, spacing=None,
+                       origin=None, direction=None):
+    """
+    Compute the statistics of the image.
+
+    :param array: The image, in the C order (i.e. the last axis is the `x`
+        axis). Arrays with more axes than the `spacing` holds are multichannel
+        images with the components along the last axis.
+    :type array: `numpy.ndarray`
+
+    :param background: Intensity of the background. In the multichannel
+        images, a voxel belongs to the background when all its components
+        equal the background.
+    :type background: float
+
+    :param bins: Number of bins of the histogram.
+    :type bins: int
+
+    :param spacing: Spacing of the image. Unit spacing by default.
+    :type spacing: list of floats
+
+    :param origin: Origin of the image. Zero origin by default.
+    :type origin: list of floats
+
+    :param direction: Direction matrix of the image (a list of rows). The
+        identity by default.
+    :type direction: list of lists of floats
+
+    :rtype: dict
+
+    >>> a = np.zeros((4, 6), dtype=np.uint8)
+    >>> a[1:3, 2] = 10
+    >>> a[2, 4] = 20
+    >>> s = compute_statistics(a, bins=2)
+    >>> s['size'], s['components'], s['dtype']
+    ([6, 4], 1, 'uint8')
+    >>> s['voxel_count'], s['bounding_box']
+    (3, [[2, 1], [4, 2]])
+    >>> s['total_intensity'], s['center_of_gravity']
+    (40.0, [3.0, 1.75])
+    >>> s['histogram'], s['range']
+    ([21, 3], [0.0, 20.0])
+
+    >>> s = compute_statistics(a, spacing=[0.5, 2.0], origin=[1.0, 0.0])
+    >>> s['center_of_gravity']
+    [2.5, 3.5]
+    >>> s = compute_statistics(a, spacing=[0.5, 2.0], origin=[1.0, 0.0],
+    ...                        direction=[[-1, 0], [0, -1]])
+    >>> s['center_of_gravity'], s['direction']
+    ([-0.5, -3.5], [[-1.0, 0.0], [0.0, -1.0]])
+
+    >>> s = compute_statistics(a, background=10)
+    >>> s['voxel_count'], s['bounding_box']
+    (22, [[0, 0], [5, 3]])
+
+    >>> s = compute_statistics(np.zeros((3, 3, 3)), spacing=[1, 1])
+    >>> s['size'], s['components'], s['voxel_count'], s['bounding_box']
+    ([3, 3], 3, 0, None)
+    >>> s['center_of_gravity'], s['histogram'][:2]
+    (None, [9, 0])
+    """
+    array = np.asarray(array)
+    dimension = spacing and len(spacing) or array.ndim
+
+    # The intensity of the multichannel images is the mean of the components.
+    if array.ndim > dimension:
+        components = array.shape[-1]
+        foreground = np.any(array != background, axis=-1)
+        intensity = array.mean(axis=-1, dtype=np.float64)
+    else:
+        components = 1
+        foreground = array != background
+        intensity = array.astype(np.float64)
+
+    spacing = np.asarray(spacing or [1.0] * dimension, dtype=np.float64)
+    origin = np.asarray(origin or [0.0] * dimension, dtype=np.float64)
+    if direction is None:
+        direction = np.eye(dimension)
+    direction = np.asarray(direction, dtype=np.float64)
+
+    # The statistics are reported in the image index order (x, y, ...), the
+    # reverse of the order of the array axes.
+    statistics = {
+        'size': list(foreground.shape[::-1]),
+        'spacing': spacing.tolist(),
+        'origin': origin.tolist(),
+        'direction': direction.tolist(),
+        'components': components,
+        'dtype': str(array.dtype),
+        'voxel_count': int(foreground.sum()),
+        'bounding_box': None,
+        'total_intensity': float(intensity.sum()),
+        'center_of_gravity': None}
+
+    if statistics['voxel_count']:
+        first, last = [], []
+        for axis in reversed(range(dimension)):
+            other_axes = tuple(a for a in range(dimension) if a != axis)
+            nonzero = np.flatnonzero(foreground.any(axis=other_axes))
+            first.append(int(nonzero[0]))
+            last.append(int(nonzero[-1]))
+        statistics['bounding_box'] = [first, last]
+
+    if statistics['total_intensity']:
+        center = []
+        for axis in reversed(range(dimension)):
+            other_axes = tuple(a for a in range(dimension) if a != axis)
+            profile = intensity.sum(axis=other_axes)
+            center.append(np.dot(profile, np.arange(len(profile))) /
+                          statistics['total_intensity'])
+        statistics['center_of_gravity'] = \
+            (origin + np.dot(direction, spacing * np.array(center))).tolist()
+
+    low, high = float(intensity.min()), float(intensity.max())
+    histogram, edges = np.histogram(intensity, bins=bins,
+                                    range=(low, high > low and high or low + 1))
+    statistics['histogram'] = histogram.tolist()
+    statistics['range'] = [low, high]
+    return statistics
+
+
+def _get_file_key(filename):
+    """
+    The size and the modification time of the file, identifying the version of
+    the file.
+    """
+    status = os.stat(filename)
+    return [status.st_size, status.st_mtime]
+
+
+def _index_slice(args):
+    """
+    Read the slice and compute its statistics. Executed by the workers.
+    """
+    filename, reader, background, bins = args
+    image = reader(filename)
+    array, header = isinstance(image, tuple) and image or (image, {})
+    return compute_statistics(array, background, bins,
+                              header.get('spacing'), header.get('origin'),
+                              header.get('direction'))
+
+
+class slice_index(object):
+    """
+    The statistics of the slices, computed by `processes` worker processes and
+    stored in the index files (:py:data:`INDEX_FILENAME`) in the directories
+    of the slices.
+
+    :param background: Intensity of the background.
+    :type background: float
+
+    :param bins: Number of bins of the histograms.
+    :type bins: int
+
+    :param processes: Number of the worker processes. The number of the CPUs
+        by default. With a single process, the slices are read within the
+        calling process.
+    :type processes: int
+
+    :param reader: Reads the slice. Returns either the image (a numpy array)
+        or the (image, header) tuple, as :py:func:`read_image` does.
+    :type reader: callable
+
+    >>> import shutil
+    >>> shutil.rmtree('/tmp/pos_slice_index_test', ignore_errors=True)
+    >>> os.mkdir('/tmp/pos_slice_index_test')
+    >>> filenames = ['/tmp/pos_slice_index_test/%d.npy' % i for i in range(3)]
+    >>> for i, filename in enumerate(filenames):
+    ...     a = np.zeros((5, 5))
+    ...     a[i:i + 2, 1:3] = i
+    ...     np.save(filename, a)
+
+    >>> index = slice_index(processes=2, reader=np.load)
+    >>> index.voxel_counts(filenames)
+    [0, 4, 4]
+    >>> [s['bounding_box'] for s in index.get(filenames)]
+    [None, [[1, 1], [2, 2]], [[1, 2], [2, 3]]]
+    >>> os.path.isfile('/tmp/pos_slice_index_test/' + INDEX_FILENAME)
+    True
+
+    The statistics of the unchanged slices are read from the index:
+
+    >>> def reader(filename):
+    ...     print "Reading", os.path.basename(filename)
+    ...     return np.load(filename)
+    >>> np.save(filenames[0], np.ones((5, 5)))
+    >>> slice_index(processes=1, reader=reader).voxel_counts(filenames)
+    Reading 0.npy
+    [25, 4, 4]
+
+    The statistics depend on the background:
+
+    >>> slice_index(1, reader=reader, background=1).voxel_counts(filenames[:1])
+    Reading 0.npy
+    [0]
+    """
+
+    def __init__(self, processes=None, background=0, bins=32,
+                 reader=read_image):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.background = background or 0
+        self.bins = bins
+        self.reader = reader
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def get(self, filenames):
+        """
+        Get the statistics of the slices, computing the statistics of the
+        slices which are not found in the index.
+
+        :param filenames: The slices.
+        :type filenames: list of strings
+
+        :return: The statistics (see :py:func:`compute_statistics`) of the
+            slices, in the order of the `filenames`.
+        :rtype: list of dicts
+        """
+        filenames = map(os.path.abspath, filenames)
+        keys = map(_get_file_key, filenames)
+
+        indexes = {}
+        for filename in filenames:
+            directory = os.path.dirname(filename)
+            if directory not in indexes:
+                indexes[directory] = self._load(directory)
+
+        statistics = []
+        missing = []
+        for i, (filename, key) in enumerate(zip(filenames, keys)):
+            entry = indexes[os.path.dirname(filename)].get(
+                os.path.basename(filename))
+            if entry and self._is_current(entry, key):
+                statistics.append(entry['statistics'])
+            else:
+                statistics.append(None)
+                missing.append(i)
+
+        if not missing:
+            return statistics
+
+        self._logger.info("Indexing %d of %d slices.",
+                          len(missing), len(filenames))
+        for i, result in zip(missing, self._compute(
+                [filenames[i] for i in missing])):
+            statistics[i] = result
+
+        updated = {}
+        for i in missing:
+            directory, basename = os.path.split(filenames[i])
+            updated.setdefault(directory, {})[basename] = {
+                'key': keys[i], 'background': self.background,
+                'bins': self.bins, 'version': INDEX_VERSION,
+                'statistics': statistics[i]}
+        for directory, entries in updated.items():
+            self._save(directory, entries)
+        return statistics
+
+    def voxel_counts(self, filenames):
+        """
+        Get the number of the non-background voxels of the slices.
+
+        :rtype: list of ints
+        """
+        return [s['voxel_count'] for s in self.get(filenames)]
+
+    def _is_current(self, entry, key):
+        return entry.get('key') == key and \
+            entry.get('background') == self.background and \
+            entry.get('bins') == self.bins and \
+            entry.get('version') == INDEX_VERSION
+
+    def _compute(self, filenames):
+        tasks = [(filename, self.reader, self.background, self.bins)
+                 for filename in filenames]
+        if self.processes == 1 or len(tasks) == 1:
+            return map(_index_slice, tasks)
+
+        pool = multiprocessing.Pool(min(self.processes, len(tasks)))
+        try:
+            return pool.map(_index_slice, tasks, _CHUNK_SIZE)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _load(self, directory):
+        filename = os.path.join(directory, INDEX_FILENAME)
+        if not os.path.isfile(filename):
+            return {}
+        try:
+            return json.load(open(filename))
+        except ValueError:
+            self._logger.warning("Discarding a corrupted index: %s", filename)
+            return {}
+
+    def _save(self, directory, entries):
+        """
+        Add the entries to the index. The index is read again, so the entries
+        added meanwhile by other workflows are preserved.
+        """
+        filename = os.path.join(directory, INDEX_FILENAME)
+        temp_filename = filename + '.%d.tmp' % os.getpid()
+        index = self._load(directory)
+        index.update(entries)
+        try:
+            json.dump(index, open(temp_filename, 'w'))
+            os.rename(temp_filename, filename)
+        except (IOError, OSError), e:
+            self._logger.warning("Cannot store the index %s: %s", filename, e)
+
+
+if __name__ == 'possum.pos_slice_index':
+    import doctest
+    doctest.testmod()
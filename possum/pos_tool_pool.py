@@ -0,0 +1,349 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A pool of pre-warmed worker processes executing possum's own python tools.
+
+Several stages of the workflows execute one of possum's python scripts (e.g.
+`pos_slice_preprocess` or `pos_align_by_moments`) for every slice of the
+stack. Every such call starts a new python interpreter which spends a few
+seconds importing the itk only to do a few milliseconds of work. The workers
+of the pool import the itk and the possum modules once, when the pool is
+started, and then execute the scripts on request, each in a child process
+forked from the worker (which has all the modules imported already). The
+scripts are executed exactly as if they were invoked from the command line:
+with the same command line arguments, capturing their stdout and stderr and
+reporting their exit code. A script crashing (e.g. with a segmentation fault
+within the itk) takes down only its own child process. The crash is reported
+with a negative exit code, just as for the commands executed in a separate
+process, so the command can be retried (see
+:py:func:`possum.pos_executors.is_transient_failure`).
+
+Only the commands invoking one of the :py:data:`TOOLS` directly (no pipes,
+redirections, etc.) are executed by the pool. The workflows use the pool only
+when started with the `--toolPool` option.
+"""
+
+import os
+import re
+import sys
+import time
+import errno
+import shlex
+import signal
+import logging
+import tempfile
+import traceback
+import multiprocessing
+
+import pos_common
+import pos_executors
+
+# The scripts executed by the pool.
+TOOLS = ('pos_slice_preprocess', 'pos_align_by_moments',
+         'pos_stack_reorient', 'pos_slice_volume')
+
+# Commands which use these characters need the shell to be executed.
+_SHELL_CHARACTERS = re.compile(r'[;&|<>`$\n]')
+
+# Size of the chunks of the captured output processed at once.
+_CHUNK_SIZE = 64 * 1024
+
+# The compiled scripts, cached in every worker.
+_compiled_tools = {}
+
+
+def _initialize_worker():
+    """
+    Import the heavy modules once per worker. Keyboard interrupts are handled
+    by the workflow, not by the workers.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        import itk
+        import pos_itk_core
+        import pos_itk_transforms
+    except ImportError:
+        # The tools will report the missing itk themselves.
+        pass
+
+
+def _set_threads(threads):
+    """
+    Set the number of threads used by the itk within the worker.
+    """
+    if not threads:
+        return
+
+    os.environ[pos_executors.THREADS_VARIABLE] = str(threads)
+    itk = sys.modules.get('itk')
+    if itk is not None:
+        try:
+            itk.MultiThreader.SetGlobalDefaultNumberOfThreads(threads)
+        except AttributeError:
+            pass
+
+
+def _run_tool(command_str, script, threads=None, capture=None):
+    """
+    Execute the python `script` in a child process forked from the worker,
+    with the command line arguments from the `command_str`. Everything
+    written to the stdout and the stderr (also by the itk itself) is captured
+    according to the `capture` policy (see
+    :py:class:`possum.pos_executors.output_capture`). A child killed by a
+    signal is reported with the negative number of the signal as the exit
+    code.
+
+    :rtype: :py:class:`possum.pos_executors.command_result`
+    """
+    # The scripts are compiled by the worker, so every script is compiled
+    # once per worker, not once per command.
+    if script not in _compiled_tools:
+        _compiled_tools[script] = compile(open(script).read(), script, 'exec')
+
+    stdout_file = tempfile.TemporaryFile()
+    stderr_file = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    start_time = time.time()
+    pid = os.fork()
+    if pid == 0:
+        returncode = 1
+        try:
+            returncode = _execute_tool(command_str, script, threads,
+                                       stdout_file, stderr_file)
+        finally:
+            os._exit(returncode & 0xff)
+
+    while True:
+        try:
+            status, usage = os.wait4(pid, 0)[1:]
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    end_time = time.time()
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+
+    stdout, stderr = _read_output(command_str, stdout_file, stderr_file,
+                                  capture)
+
+    # The peak memory (`max_rss`) is not reported: the child inherits the
+    # resident memory of the worker, so its peak does not describe the
+    # command alone (see :py:mod:`possum.pos_memory`).
+    resources = {
+        'user_time': usage.ru_utime,
+        'system_time': usage.ru_stime,
+        'read_bytes': usage.ru_inblock * 512,
+        'write_bytes': usage.ru_oublock * 512}
+
+    return pos_executors.command_result(command_str, returncode,
+        stdout, stderr, start_time, end_time, resources=resources)
+
+
+def _execute_tool(command_str, script, threads, stdout_file, stderr_file):
+    """
+    Execute the compiled `script` within the child process and return its
+    exit code.
+    """
+    _set_threads(threads)
+
+    # The logging is initialized by every script anew.
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    # Both the python level streams and the file descriptors (used by the
+    # itk) are redirected.
+    os.dup2(stdout_file.fileno(), 1)
+    os.dup2(stderr_file.fileno(), 2)
+    sys.stdout, sys.stderr = stdout_file, stderr_file
+
+    returncode = 0
+    try:
+        sys.argv = shlex.split(command_str)
+        exec _compiled_tools[script] in {'__name__': '__main__',
+                                         '__file__': script}
+    except SystemExit, e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print >>sys.stderr, e.code
+            returncode = 1
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return returncode
+
+
+def _read_output(command_str, stdout_file, stderr_file, capture=None):
+    """
+    Read the captured output of the tool from the temporary files.
+    """
+    stdout_file.seek(0)
+    stderr_file.seek(0)
+    if capture is None:
+        return stdout_file.read(), stderr_file.read()
+
+    output = capture.open(command_str)
+    for stream, output_file in [('stdout', stdout_file),
+                                ('stderr', stderr_file)]:
+        for chunk in iter(lambda: output_file.read(_CHUNK_SIZE), ''):
+            output.write(stream, chunk)
+    return output.close()
+
+
+class tool_pool(object):
+    """
+    A pool of `processes` workers executing the python `tools` in-process.
+    The workers are started on the first call of the :py:meth:`start` method.
+
+    :param processes: Number of the workers.
+    :type processes: int
+
+    :param tools: Names of the scripts the pool executes.
+    :type tools: tuple of strings
+
+    >>> open('/tmp/pos_tool_pool_test', 'w').write(
+    ...     "import os, sys, signal\\n"
+    ...     "print ' '.join(sys.argv[1:])\\n"
+    ...     "if sys.argv[1] == 'fail': raise ValueError('failed')\\n"
+    ...     "if sys.argv[1] == 'crash': os.kill(os.getpid(), signal.SIGSEGV)\\n"
+    ...     "sys.exit(int(sys.argv[1]))\\n")
+    >>> os.chmod('/tmp/pos_tool_pool_test', 0755)
+
+    >>> pool = tool_pool(2, tools=('pos_tool_pool_test',))
+    >>> pool.accepts('/tmp/pos_tool_pool_test 0'), pool.accepts('echo 0')
+    (True, False)
+    >>> pool.accepts('/tmp/pos_tool_pool_test 0 > /dev/null')
+    False
+
+    >>> pool.start()
+    >>> r = pool.run('/tmp/pos_tool_pool_test 0 "a b"')
+    >>> r.returncode, r.stdout, r.stderr
+    (0, '0 a b\\n', '')
+    >>> pool.run('/tmp/pos_tool_pool_test 3').returncode
+    3
+    >>> capture = pos_executors.output_capture(tail_size=2)
+    >>> pool.run('/tmp/pos_tool_pool_test 0 abc', capture=capture).stdout
+    'c\\n'
+    >>> r = pool.run('/tmp/pos_tool_pool_test fail')
+    >>> r.returncode, r.stderr.splitlines()[-1]
+    (1, 'ValueError: failed')
+
+    A crashing tool does not take the worker down:
+
+    >>> pool.run('/tmp/pos_tool_pool_test crash').returncode
+    -11
+    >>> pool.run('/tmp/pos_tool_pool_test 0').returncode
+    0
+
+    The commands the pool does not accept are executed as usual:
+
+    >>> pool.run('echo 1; exit 2').returncode
+    2
+    >>> pool.close()
+    """
+
+    def __init__(self, processes=1, tools=TOOLS):
+        self.processes = processes
+        self.tools = tools
+        self._pool = None
+        self._scripts = {}
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _get_script(self, executable):
+        """
+        Find the script of the tool. Returns `None` if the executable is not
+        one of the tools.
+        """
+        if executable not in self._scripts:
+            script = None
+            if os.path.basename(executable) in self.tools:
+                script = pos_common.which(executable)
+            self._scripts[executable] = script
+        return self._scripts[executable]
+
+    def accepts(self, command):
+        """
+        Check if the command can be executed by the pool.
+
+        :param command: The command.
+        :type command: str or :py:class:`possum.pos_wrappers.generic_wrapper`
+
+        :rtype: bool
+        """
+        command_str = str(command).strip()
+        if not command_str or _SHELL_CHARACTERS.search(command_str):
+            return False
+        return self._get_script(command_str.split()[0]) is not None
+
+    def start(self):
+        """
+        Start the workers (if they are not running yet). The workers import
+        the itk in the background, while the workflow goes on.
+        """
+        if self._pool is not None:
+            return
+
+        self._logger.info("Starting %d tool workers.", self.processes)
+        # The workers are never restarted (every script runs in a child
+        # process of its own, so no state piles up in the workers). Thus, no
+        # worker is forked while the threads of the executors are running.
+        self._pool = multiprocessing.Pool(max(1, self.processes),
+            initializer=_initialize_worker)
+
+    def run(self, command_str, threads=None, capture=None, control=None):
+        """
+        Execute the command within one of the workers or, if the pool does
+        not accept the command, in a separate process (see
+        :py:func:`possum.pos_executors.run_command`).
+
+        :param command_str: Command to execute.
+        :type command_str: str
+
+        :param threads: Number of threads the command may use.
+        :type threads: int
+
+        :param capture: The policy of capturing the output of the command.
+        :type capture: :py:class:`possum.pos_executors.output_capture`
+
+        :param control: Allows to terminate the command. Only the commands
+            executed in a separate process can be terminated.
+        :type control: :py:class:`possum.pos_executors.command_control`
+
+        :rtype: :py:class:`possum.pos_executors.command_result`
+        """
+        if self._pool is None or not self.accepts(command_str):
+            return pos_executors.run_command(command_str, threads=threads,
+                                             capture=capture, control=control)
+
+        script = self._get_script(command_str.split()[0])
+        return self._pool.apply(_run_tool,
+                                (command_str, script, threads, capture))
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+        if self._pool is None:
+            return
+
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+
+if __name__ == 'possum.pos_tool_pool':
+    import doctest
+    doctest.testmod()
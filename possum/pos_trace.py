@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+A timeline of the commands executed by a workflow.
+
+The results of the executed commands (their timing and the resources they
+used) are collected and saved as a JSON trace in the Chrome trace event
+format which can be viewed with chrome://tracing or Perfetto
+(https://ui.perfetto.dev). The commands are grouped by the stage of the
+workflow (shown as processes) and by the slice index (shown as threads).
+"""
+
+import os
+import json
+import threading
+
+
+class trace_recorder(object):
+    """
+    Collects the results of the commands and writes them into the trace file.
+
+    :param filename: The trace file.
+    :type filename: str
+
+    >>> import pos_executors
+    >>> t = trace_recorder('/tmp/pos_trace_test.json')
+    >>> t.add(pos_executors.command_result('ANTS 2 -m x', 0, '', '', 10.0, 12.5,
+    ...       resources={'user_time': 2.0, 'system_time': 0.1, 'max_rss': 1024,
+    ...                  'read_bytes': 0, 'write_bytes': 512}),
+    ...       stage='_calculate_transforms', key=12)
+    >>> t.add(pos_executors.command_result('c2d a.nii.gz b.nii.gz', 1, '', '',
+    ...       11.0, 11.5), stage='_reslice')
+    >>> t.add(pos_executors.command_result('c2d a.nii.gz c.nii.gz', 0, '', '',
+    ...       11.5, 11.6, cached=True), stage='_reslice')
+    >>> t.write()
+
+    >>> trace = json.load(open('/tmp/pos_trace_test.json'))
+    >>> events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    >>> [(e['name'], e['pid'], e['tid'], e['ts'], e['dur']) for e in events]
+    [(u'ANTS', 1, 12, 0.0, 2500000.0), (u'c2d', 2, 0, 1000000.0, 500000.0), (u'c2d (cached)', 2, 1, 1500000.0, 100000.0)]
+
+    >>> events[0]['args']['max_rss'], events[0]['args']['slice']
+    (1024, 12)
+
+    >>> names = [(e['pid'], e['args']['name']) for e in trace['traceEvents']
+    ...          if e['name'] == 'process_name']
+    >>> names
+    [(1, u'_calculate_transforms'), (2, u'_reslice')]
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._events = []
+        self._stages = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def add(self, result, stage=None, key=None):
+        """
+        Add the result of a command to the trace.
+
+        :param result: The result of the command.
+        :type result: :py:class:`possum.pos_executors.command_result`
+
+        :param stage: Name of the workflow stage the command belongs to.
+        :type stage: str
+
+        :param key: The slice index (or any other index) of the command
+            within the stage. When not provided, the subsequent commands of
+            the stage are numbered automatically.
+        :type key: int
+        """
+        if result.start_time is None or result.end_time is None:
+            return
+
+        with self._lock:
+            stage = stage or 'commands'
+            if stage not in self._stages:
+                self._stages[stage] = len(self._stages) + 1
+                self._keys[stage] = 0
+            if key is None:
+                key = self._keys[stage]
+            self._keys[stage] = max(self._keys[stage], int(key) + 1)
+
+            name = os.path.basename(result.command.split(" ", 1)[0])
+            if result.cached:
+                name += ' (cached)'
+
+            args = {'command': result.command,
+                    'returncode': result.returncode,
+                    'slice': key}
+            args.update(result.resources or {})
+
+            self._events.append({
+                'name': name,
+                'cat': stage,
+                'ph': 'X',
+                'ts': result.start_time,
+                'dur': round(result.wall_time * 1e6, 3),
+                'pid': self._stages[stage],
+                'tid': key,
+                'args': args})
+
+    def write(self):
+        """
+        Write the trace file. The whole trace is rewritten each time so the
+        file can be inspected while the workflow is still running.
+        """
+        with self._lock:
+            # The timestamps (in microseconds) are relative to the start of
+            # the first command.
+            origin = min([e['ts'] for e in self._events] or [0])
+            events = [dict(e, ts=round((e['ts'] - origin) * 1e6, 3))
+                      for e in self._events]
+
+            metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                         'args': {'name': stage}}
+                        for stage, pid in sorted(self._stages.items(),
+                                                 key=lambda x: x[1])]
+            trace = {'traceEvents': metadata + events,
+                     'displayTimeUnit': 'ms'}
+
+            temp_filename = self.filename + '.tmp'
+            json.dump(trace, open(temp_filename, 'w'))
+            os.rename(temp_filename, self.filename)
+
+
+if __name__ == 'possum.pos_trace':
+    import doctest
+    doctest.testmod()
@@ -3,16 +3,47 @@
 
 
 import sys, os
-import subprocess as sub
 import multiprocessing
 
-import time
 import datetime
+import itertools
 import logging
 from optparse import OptionParser, OptionGroup
 
 import pos_common
 import pos_wrappers
+import pos_executors
+import pos_scheduler
+import pos_result_cache
+import pos_journal
+import pos_trace
+import pos_memory
+import pos_cost
+import pos_tool_pool
+import pos_broker
+import pos_plan
+
+
+class _result_store_chain(object):
+    """
+    Several result stores acting as a single one (see
+    :py:meth:`possum.pos_wrappers.generic_wrapper.__call__`): the result is
+    restored from the first store holding it and recorded in all of them.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+
+    def fetch(self, command):
+        for store in self.stores:
+            result = store.fetch(command)
+            if result is not None:
+                return result
+        return None
+
+    def store(self, command, result):
+        for store in self.stores:
+            store.store(command, result)
 
 
 class generic_workflow(object):
@@ -65,6 +96,22 @@ class generic_workflow(object):
     False
     None
 
+    # The commands can be recorded into an execution plan as well.
+    >>> w._plan = pos_plan.execution_plan()
+    >>> w.options.planFile = '/tmp/pos_skel_plan_test.json'
+    >>> w.execute(["echo 1"], stage='test', keys=[4])
+    echo 1
+    >>> [(c.command, c.stage, c.key) for c in
+    ...  pos_plan.execution_plan.load('/tmp/pos_skel_plan_test.json').commands]
+    [('echo 1', u'test', 4)]
+
+    # Unless the workflow computes some of its stages in-process.
+    >>> w._IN_PROCESS_STAGES = ('_measure_similarity',)
+    >>> w._initializePlan()
+    Traceback (most recent call last):
+    ...
+    SystemExit: 1
+    >>> del w._IN_PROCESS_STAGES
 
     # Now let's test the ability of the workflow to compress its own
     # workflow directory.
@@ -100,6 +147,54 @@ class generic_workflow(object):
     >>> w.execute(["sleep 1"]) ==  ('', '')
     True
 
+    # Apart from the concatenated output of the whole batch, the outcome of
+    # each command is available as well.
+    >>> results = w.execute_batch(["echo 1", "exit 2"])
+    >>> [(r.returncode, r.stdout) for r in results]
+    [(0, '1\\n'), (2, '')]
+
+    # Several stages of the workflow can be executed at once. A command waits
+    # only for the commands producing its input files.
+    >>> touch = pos_wrappers.touch_wrapper(files=['/tmp/pos_skel_test'])
+    >>> results = w.execute_pipeline([touch], ["echo 1", "echo 2"])
+    >>> [[r.returncode for r in batch] for batch in results]
+    [[0], [0, 0]]
+
+    # Identical commands are executed once. So are the commands completed
+    # earlier in the run, as long as their files have not changed since.
+    >>> results = w.execute_batch(["echo 3", "echo 3", touch])
+    >>> results[0] is results[1], results[0].stdout, results[2].cached
+    (True, '3\\n', True)
+
+    # Failed commands are reported per slice index. Commands crashing with a
+    # signal (e.g. a segmentation fault) are retried before being reported.
+    >>> w.options.retryDelay = 0.01
+    >>> results = w.execute_batch(["exit 3", "echo 1", "kill -SEGV $$"],
+    ...     stage='test', keys=[7, 8, 9])
+    >>> [(r.returncode, r.attempts) for r in results]
+    [(3, 1), (0, 1), (-11, 3)]
+    >>> w._failures['test']
+    [7, 9]
+
+    # The timing and the resources used by the commands can be recorded in
+    # the execution trace.
+    >>> import json
+    >>> w._trace = pos_trace.trace_recorder('/tmp/pos_skel_trace_test.json')
+    >>> results = w.execute_batch(["echo 1", "echo 2"], stage='test', keys=[7, 9])
+    >>> trace = json.load(open('/tmp/pos_skel_trace_test.json'))
+    >>> [(e['cat'], e['tid']) for e in trace['traceEvents'] if e['ph'] == 'X']
+    [(u'test', 7), (u'test', 9)]
+
+    # So are the wrappers executed directly, outside of the batches.
+    >>> execution = w.execute_command(
+    ...     pos_wrappers.touch_wrapper(files=['/tmp/pos_skel_touch_test']))
+    Executing: touch /tmp/pos_skel_touch_test
+    <BLANKLINE>
+    <BLANKLINE>
+    >>> trace = json.load(open('/tmp/pos_skel_trace_test.json'))
+    >>> [e['cat'] for e in trace['traceEvents'] if e['ph'] == 'X'][-1]
+    u'touch_wrapper'
+
     # Now we test archiving and cleanup routines by manually executing a pre
     # and postlaunch methods. In the meanwhile we want to test the archiving
     # feature as well
@@ -114,9 +209,6 @@ class generic_workflow(object):
 
     """
 
-    # Define the name for GNU parallel executeble name.
-    __PARALLEL_EXECUTABLE_NAME="parallel"
-
     # _f is a dictionary holding definitions of files beeing a part of the
     # workflow. The purpose of this dictionary is to be able to easily access
     # and utilize filenames (from each stage of the workflow). You're gonna like
@@ -129,6 +221,28 @@ class generic_workflow(object):
     # Just to avoid hadcoded strings further
     _DO_NOT_CREATE_WORKDIR = 'skip'
 
+    # Name of the journal of the executed commands (stored in the workdir).
+    _JOURNAL_FILENAME = '.pos_journal'
+
+    # Directory (within the working directory) holding the logs of the
+    # executed commands.
+    _LOG_DIRECTORY = 'logs'
+
+    # Number of the trailing characters of the stderr of a failed command
+    # included in the failure report.
+    _FAILURE_STDERR_SIZE = 2048
+
+    # Methods executing the commands. Skipped when looking for the name of
+    # the workflow stage requesting the execution.
+    _EXECUTION_METHODS = ('execute', 'execute_batch', 'execute_pipeline',
+                          '_get_default_stage')
+
+    # Stages of the workflow computed within the workflow's process instead
+    # of by the commands. Such stages cannot be recorded in the execution
+    # plan, thus these workflows refuse to record the plan at all. Override
+    # this attribute in the inherited classes.
+    _IN_PROCESS_STAGES = ()
+
     def __init__(self, options, args):
         """
         :param optionsDict: Command line options
@@ -145,6 +259,10 @@ class generic_workflow(object):
         # changed in the future.
         self.f = dict(self._f)
 
+        # The slice indexes (or positions within the batch) of the failed
+        # commands, by the stage of the workflow.
+        self._failures = {}
+
         # Get number of cpus for parallel processing.
         # Multiprocessing modlue is used to determine the number of cpus. This
         # behavior can be overriden with --cpuNo switch.
@@ -155,6 +273,13 @@ class generic_workflow(object):
         self._initializeOptions()
         self._validate_options()
         self._initializeDirectories()
+        self._initializeResultStores()
+        self._initializeTrace()
+        self._initializeMemoryModel()
+        self._initializeCostModel()
+        self._initializePlan()
+        self._initializeToolPool()
+        self._initializeOutputCapture()
         self._overrideDefaults()
 
     def _initializeLogging(self):
@@ -190,11 +315,23 @@ class generic_workflow(object):
         # specimen. Thus, it is hardcoded to not allow any computations without
         # this ID. Simple as it is.
 
+        # Select the backend executing the batches of commands. Unless stated
+        # otherwise, the commands are executed by the built-in pool of
+        # workers. GNU parallel is used only for distributing the computations
+        # over the computer cluster (the `~/.pos_cluster` file).
+        if self.options.executor == 'auto':
+            cluster_file = os.path.join(os.getenv("HOME", ""), '.pos_cluster')
+            if os.path.isfile(cluster_file) and \
+               pos_executors.parallel_executor.is_available():
+                self.options.executor = 'parallel'
+            else:
+                self.options.executor = 'pool'
+
         # We need to check if the GNU parallel of availeble. If it's not, we
-        # cannot perform parallel computations.
-        if not pos_common.which(self.__PARALLEL_EXECUTABLE_NAME) and\
-           self.options.cpuNo > 1:
-            self._logger.error("Parallel execution was selected but GNU parallel is not available!")
+        # cannot use it to execute the commands.
+        if self.options.executor == 'parallel' and \
+           not pos_executors.parallel_executor.is_available():
+            self._logger.error("GNU parallel executor was selected but GNU parallel is not available!")
             sys.exit(1)
 
         # Job ID is another value for accointing and managing. Oppoosite to the
@@ -263,6 +400,159 @@ class generic_workflow(object):
         dirs_to_create = list(set(map(lambda v: v.base_dir, self.f.itervalues())))
         map(self._ensureDir, dirs_to_create)
 
+    def _initializeResultStores(self):
+        """
+        Set up the places the results of the commands are recorded in and
+        restored from instead of executing the commands again:
+
+            1. the commands completed during the current run (so the
+               commands requested by several stages are executed once),
+            2. the journal of the commands executed in the working directory
+               (allows resuming a workflow restarted with the same job id),
+            3. the cache of the commands' results. The cache is used only when
+               the cache directory is provided.
+        """
+        self._result_stores = [pos_journal.completed_commands()]
+
+        if not self.options.disableJournal and not self.options.dryRun and \
+           self.options.workdir != self._DO_NOT_CREATE_WORKDIR:
+            self._result_stores.append(pos_journal.command_journal(
+                os.path.join(self.options.workdir, self._JOURNAL_FILENAME)))
+
+        if self.options.cacheDir:
+            self._result_stores.append(pos_result_cache.result_cache(
+                self.options.cacheDir,
+                max_size=self.options.cacheSize * 1024 ** 2,
+                workdir=self.options.workdir))
+
+    def _initializeTrace(self):
+        """
+        Set up recording of the execution trace. The trace is recorded only
+        when the trace file is provided.
+        """
+        self._trace = None
+        if self.options.traceFile:
+            self._trace = pos_trace.trace_recorder(self.options.traceFile)
+
+    def _initializeMemoryModel(self):
+        """
+        Set up the prediction of the memory usage of the commands. The memory
+        limit defaults to the amount of the physical memory of the machine.
+        The predictions are learned from the executed commands and, if the
+        memory model file is provided, saved for the subsequent runs.
+        """
+        self._memory_model = pos_memory.memory_model(self.options.memoryModel)
+
+        self._memory_limit = None
+        if self.options.memoryLimit:
+            self._memory_limit = self.options.memoryLimit * 1024 ** 2
+        elif self.options.memoryLimit is None:
+            self._memory_limit = pos_memory.get_total_memory()
+
+    def _initializeCostModel(self):
+        """
+        Set up the prediction of the execution time of the commands, used to
+        start the most expensive commands of each batch first. The
+        predictions are learned from the executed commands and, if the cost
+        model file is provided, saved for the subsequent runs.
+        """
+        self._cost_model = pos_cost.cost_model(self.options.costModel)
+
+    def _initializePlan(self):
+        """
+        Set up the recording of the execution plan (see
+        :py:mod:`possum.pos_plan`). The plan is recorded only in the dry run
+        mode and when the plan file is provided.
+
+        The workflows computing some of their stages in-process cannot be
+        replayed from the plan (which holds only the commands), so they
+        exit instead of recording an incomplete plan.
+        """
+        self._plan = None
+        if self.options.planFile and self._IN_PROCESS_STAGES:
+            self._logger.error("The execution plan cannot be recorded: the %s stages of the workflow are computed in-process.",
+                ", ".join(self._IN_PROCESS_STAGES))
+            sys.exit(1)
+
+        if self.options.dryRun and self.options.planFile:
+            self._plan = pos_plan.execution_plan(self.__class__.__name__)
+
+    def _initializeToolPool(self):
+        """
+        Set up the pool of workers executing possum's python tools (e.g.
+        `pos_slice_preprocess`) without starting a new python interpreter for
+        every slice. The pool is used only when requested. The workers are
+        started right away, before the executors start any threads, so the
+        workers are never forked while another thread holds a lock.
+        """
+        self._tool_pool = None
+        if self.options.toolPool and not self.options.dryRun:
+            self._tool_pool = pos_tool_pool.tool_pool(self.options.cpuNo)
+            self._tool_pool.start()
+
+    def _initializeOutputCapture(self):
+        """
+        Set up the capturing of the output of the executed commands. Only the
+        tail of the output of each command is kept in memory. The complete
+        output is stored in the log files in the working directory, if
+        requested, or discarded.
+        """
+        log_dir = None
+        if self.options.commandLogs and \
+           self.options.workdir != self._DO_NOT_CREATE_WORKDIR:
+            log_dir = os.path.join(self.options.workdir, self._LOG_DIRECTORY)
+
+        tail_size = self.options.outputTailSize * 1024 or None
+        self._capture = None
+        if tail_size or log_dir:
+            self._capture = pos_executors.output_capture(tail_size, log_dir)
+
+    def _record_usage(self, commands, results):
+        """
+        Update the memory and the cost models with the memory used by the
+        commands and their execution times.
+        """
+        for command, result in zip(commands, results):
+            self._memory_model.record(command, result)
+            self._cost_model.record(command, result)
+        self._memory_model.save()
+        self._cost_model.save()
+
+    def _fetch_result(self, command):
+        """
+        Look up the result of the command in the journal and in the cache.
+
+        :return: The result or `None` if the command has to be executed.
+        :rtype: :py:class:`pos_executors.command_result`
+        """
+        return _result_store_chain(self._result_stores).fetch(command)
+
+    def _store_result(self, command, result):
+        """
+        Record the result of the command in the journal and in the cache.
+        """
+        _result_store_chain(self._result_stores).store(command, result)
+
+    def execute_command(self, command):
+        """
+        Execute a single wrapper directly, outside of the batches (e.g. when
+        preparing the input volumes). The result of the command is restored
+        from and recorded in the journal and in the cache, and put into the
+        execution trace, just as the results of the batches are.
+
+        :param command: The command to execute.
+        :type command: :py:class:`pos_wrappers.generic_wrapper`
+
+        :return: The execution of the wrapper (see
+            :py:meth:`pos_wrappers.generic_wrapper.__call__`).
+        :rtype: dict
+        """
+        execution = command(cache=_result_store_chain(self._result_stores),
+                            trace=self._trace)
+        if self._trace is not None:
+            self._trace.write()
+        return execution
+
     def _ensureDir(self, path):
         """
         Makes sure that the given directory exists and is avalilable.
@@ -287,7 +577,7 @@ class generic_workflow(object):
     def _basename(path, withExtension=False):
         return pos_common.get_basename(path, withExtension)
 
-    def execute(self, commands, parallel=True):
+    def execute(self, commands, parallel=True, stage=None, keys=None):
         """
         One of the most important methods in the whole class. Executes the
         workflow. The execution can be launched in parallel mode, and / or in
@@ -301,6 +591,50 @@ class generic_workflow(object):
 
         :param parallel: Enables execution in parallel mode
         :type parallel: bool
+
+        :param stage: Name of the workflow stage the commands belong to (used
+                      in the execution trace). If not provided, the name of
+                      the workflow's method executing the commands is used.
+        :type stage: str
+
+        :param keys: Slice indexes of the individual commands (used in the
+                     execution trace).
+        :type keys: list of ints
+
+        :return: stdout and stderr of all the commands, concatenated in the
+                 order of the commands. `None` in the 'dry run' mode.
+        :rtype: tuple
+        """
+
+        results = self.execute_batch(commands, parallel,
+            stage or self._get_default_stage(), keys)
+
+        if not self.options.dryRun:
+            stdout = "".join(map(lambda r: r.stdout, results))
+            stderr = "".join(map(lambda r: r.stderr, results))
+            return stdout, stderr
+
+    def execute_batch(self, commands, parallel=True, stage=None, keys=None):
+        """
+        Executes the commands just as the :py:meth:`execute` method does but
+        returns the outcome of each command separately.
+
+        :param commands: The commands to be executed
+        :type commands: An interable (in case of multiple commands - the usual
+                        case), a string in case of a singe command.
+
+        :param parallel: Enables execution in parallel mode
+        :type parallel: bool
+
+        :param stage: Name of the workflow stage the commands belong to.
+        :type stage: str
+
+        :param keys: Slice indexes of the individual commands.
+        :type keys: list of ints
+
+        :return: The results of the individual commands in the order of the
+                 commands. Empty list in the 'dry run' mode.
+        :rtype: list of :py:class:`pos_executors.command_result`
         """
 
         # (https://docs.loni.org/wiki/PBS_Job_Chains_and_Dependencies)
@@ -312,41 +646,268 @@ class generic_workflow(object):
         if not hasattr(commands, "__getitem__"):
             commands = [commands]
 
+        # In the 'dry run' mode the commands are only printed and, if
+        # requested, recorded in the execution plan.
+        if self.options.dryRun:
+            print "\n".join(map(str, commands))
+            if self._plan is not None:
+                self._plan.add_batch(commands,
+                    stage or self._get_default_stage(), keys,
+                    self._cost_model)
+                self._plan.save(self.options.planFile)
+            return []
+
+        stage = stage or self._get_default_stage()
+        keys = keys or [None] * len(commands)
+
+        # Identical commands are executed only once (they would only race
+        # for the same output files anyway). Distinct commands writing the
+        # same files are reported.
+        originals = self._find_duplicates(commands)
+        unique = [i for i, original in enumerate(originals) if original == i]
+        if len(unique) < len(commands):
+            self._logger.info("%d duplicated commands skipped.",
+                              len(commands) - len(unique))
+        self._report_output_conflicts([commands[i] for i in unique])
+
+        # The commands which results are available (e.g. in the journal or in
+        # the cache) are not executed.
+        results = [None] * len(commands)
+        for index in unique:
+            results[index] = self._fetch_result(commands[index])
+        if any(results):
+            self._logger.info("%d of %d commands already completed or "
+                "restored from the journal or the cache.",
+                len(filter(None, results)), len(unique))
+        pending = [i for i in unique if results[i] is None]
+
         # In the regular execution mode (no dry-run) the commands can be
-        # executed serially or parallelly. In the latter case, all the commands
-        # are dumped into a file and executed with the GNU parallel.
-        if not self.options.dryRun:
+        # executed serially or parallelly. In the latter case the selected
+        # execution backend is used.
+        executor = self._get_executor(parallel)
+        self._logger.debug("Executing %d commands with %s.",
+                           len(pending), executor.__class__.__name__)
+
+        # The results are processed as soon as they are streamed back from
+        # the executor.
+        executed = executor.imap([commands[i] for i in pending])
+        for index, result in itertools.izip(pending, executed):
+            self._log_result(result)
+            self._store_result(commands[index], result)
+            results[index] = result
+
+        results = [results[original] for original in originals]
+        self._record_usage([commands[i] for i in unique],
+                           [results[i] for i in unique])
+        self._trace_results(results, stage, keys)
+        self._report_failures(results, stage, keys)
+        return results
+
+    def execute_pipeline(self, *batches, **kwargs):
+        """
+        Executes several batches of commands (the stages of the workflow)
+        without waiting for the whole batch to finish before starting the next
+        one. Instead, a command starts as soon as the commands producing its
+        input files are finished (see :py:mod:`possum.pos_scheduler`).
+        Commands which do not declare their input and output files are
+        executed after all the preceding commands.
+
+        The pipelined execution is available only with the local pool
+        executor and without the speculative execution of the commands
+        (`--speculationMultiple`). Otherwise the batches are executed one after
+        another with the :py:meth:`execute_batch` method.
+
+        :param batches: The batches of commands to execute, in the order of
+                        the workflow's stages.
+        :type batches: iterables of commands
+
+        :param stages: Names of the stages, one per batch (keyword argument).
+        :type stages: list of strings
+
+        :param keys: Slice indexes of the commands, one list per batch
+                     (keyword argument).
+        :type keys: list of lists of ints
+
+        :return: The results of the individual commands, grouped into lists
+                 corresponding to the provided batches. Empty lists in the
+                 'dry run' mode.
+        :rtype: list of lists of :py:class:`pos_executors.command_result`
+        """
+        batches = map(list, batches)
+
+        stages = kwargs.get('stages')
+        if stages is None:
+            caller = self._get_default_stage()
+            stages = ["%s:%d" % (caller, i) for i in range(len(batches))]
+        keys = kwargs.get('keys') or [None] * len(batches)
+
+        if self.options.dryRun or self.options.executor != 'pool' or \
+                self.options.speculationMultiple:
+            return map(lambda (b, s, k): self.execute_batch(b, True, s, k),
+                       zip(batches, stages, keys))
+
+        graph = pos_scheduler.task_graph()
+        indexes = map(graph.add_batch, batches)
+        self._logger.debug("Executing %d commands in %d stages with %d "
+                           "dependencies.", len(graph), len(batches),
+                           sum(map(len, graph.dependencies)))
+
+        scheduler = pos_scheduler.dag_scheduler(self.options.cpuNo,
+            self._result_stores, memory_limit=self._memory_limit,
+            memory_model=self._memory_model,
+            threads_per_job=self.options.threadsPerJob,
+            tool_pool=self._tool_pool, capture=self._capture,
+            cost_model=self._cost_model, retries=self.options.retries,
+            retry_delay=self.options.retryDelay)
+        results = scheduler.run(graph)
+        map(self._log_result, results)
+        self._record_usage(graph.commands, results)
+
+        batch_results = [[results[i] for i in batch_indexes]
+                         for batch_indexes in indexes]
+        for batch, stage, batch_keys in zip(batch_results, stages, keys):
+            batch_keys = batch_keys or [None] * len(batch)
+            self._trace_results(batch, stage, batch_keys)
+            self._report_failures(batch, stage, batch_keys)
+        return batch_results
 
-            command_filename = \
-                os.path.join(self.options.workdir, str(time.time()))
-            open(command_filename, 'w').write("\n".join(map(str, commands)))
-            self._logger.info("Saving command file: %s", command_filename)
-
-            if parallel:
-                cluster_file = os.path.join(os.getenv("HOME"), '.pos_cluster')
-                if os.path.isfile(cluster_file):
-                    command_str = 'parallel --sshloginfile %s -a %s -k -j %d --env PATH --env PYTHONPATH --env LD_LIBRARY_PATH --workdir %s' %\
-                        (cluster_file, command_filename, self.options.cpuNo, os.getcwd())
-                else:
-                    command_str = 'parallel -a %s -k -j %d' %\
-                        (command_filename, self.options.cpuNo)
-            else:
-                command_str = 'bash -x %s' % command_filename
+    @staticmethod
+    def _find_duplicates(commands):
+        """
+        Find the identical commands.
 
-            self._logger.debug("Executing: %s", command_str)
+        :return: For every command, the index of its first occurrence.
+        :rtype: list of ints
 
-            # Tested against execution of multiple commands
-            stdout, stderr =  sub.Popen(command_str,
-                                stdout=sub.PIPE, stderr=sub.PIPE,
-                                shell=True, close_fds=True).communicate()
+        >>> generic_workflow._find_duplicates(["echo 1", "echo 2", "echo 1"])
+        [0, 1, 0]
+        """
+        first = {}
+        return [first.setdefault(str(command), index)
+                for index, command in enumerate(commands)]
 
-            self._logger.debug("Last commands stdout: %s", stdout)
-            self._logger.debug("Last commands stderr: %s", stderr)
+    def _report_output_conflicts(self, commands):
+        """
+        Warn about the distinct commands of a batch writing the same files.
+        Such commands would overwrite each other's results in an
+        unpredictable order.
 
-            return stdout, stderr
+        :return: The files written by more than one command.
+        :rtype: list of strings
+        """
+        writers = {}
+        for command in commands:
+            get_output_files = getattr(command, 'get_output_files', None)
+            outputs = get_output_files and get_output_files() or []
+            for filename in set(map(os.path.normpath, outputs)):
+                writers.setdefault(filename, []).append(command)
+
+        conflicts = sorted(filename for filename, filename_writers
+                           in writers.iteritems() if len(filename_writers) > 1)
+        for filename in conflicts:
+            self._logger.warning("%d different commands write the same "
+                "file: %s (%s)", len(writers[filename]), filename,
+                "; ".join(map(str, writers[filename])))
+        return conflicts
+
+    def _report_failures(self, results, stage, keys):
+        """
+        Report the failed commands of the batch along with their slice
+        indexes (or positions within the batch when the slice indexes are not
+        provided), so the failed slices can be tracked down without digging
+        through the output of the whole batch.
 
-        else:
-            print "\n".join(map(str, commands))
+        :return: The slice indexes of the failed commands.
+        :rtype: list
+        """
+        failed = []
+        for position, (result, key) in enumerate(zip(results, keys)):
+            if result.success:
+                continue
+
+            if key is None:
+                key = '#%d' % position
+            failed.append(key)
+            self._logger.error("Stage %s, slice %s: failed with exit code %s "
+                "after %d attempt(s): %s", stage, key, result.returncode,
+                result.attempts, result.command)
+            if result.stderr:
+                self._logger.error("Stage %s, slice %s: stderr: %s", stage,
+                    key, result.stderr[-self._FAILURE_STDERR_SIZE:])
+
+        if failed:
+            self._logger.error("Stage %s: %d of %d commands failed, slices: "
+                "%s", stage, len(failed), len(results),
+                ", ".join(map(str, failed)))
+            self._failures.setdefault(stage, []).extend(failed)
+        return failed
+
+    def _get_default_stage(self):
+        """
+        Get the name of the workflow's method which requested the execution
+        of the commands.
+        """
+        frame = sys._getframe(1)
+        while frame is not None and \
+              frame.f_code.co_name in self._EXECUTION_METHODS:
+            frame = frame.f_back
+        return frame and frame.f_code.co_name
+
+    def _log_result(self, result):
+        self._logger.debug("Finished with exit code %s in %s s: %s",
+            result.returncode, result.wall_time, result.command)
+        self._logger.debug("Command resources: %s", result.resources)
+        self._logger.debug("Command stdout: %s", result.stdout)
+        self._logger.debug("Command stderr: %s", result.stderr)
+
+    def _trace_results(self, results, stage, keys):
+        """
+        Put the results of the commands into the execution trace (if the trace
+        is recorded at all).
+        """
+        if self._trace is None:
+            return
+
+        for result, key in zip(results, keys):
+            self._trace.add(result, stage, key)
+        self._trace.write()
+
+    def _get_executor(self, parallel=True):
+        """
+        Creates the executor for running a batch of commands.
+
+        :param parallel: Enables execution in parallel mode. Otherwise the
+                         commands are executed serially.
+        :type parallel: bool
+
+        :rtype: :py:class:`pos_executors.generic_executor`
+        """
+        if not parallel:
+            return pos_executors.serial_executor(
+                cpu_no=self.options.cpuNo, workdir=self.options.workdir,
+                threads_per_job=self.options.threadsPerJob,
+                capture=self._capture)
+
+        # The work queue may be shared by several workflows, so it may be
+        # located outside of the working directory.
+        kwargs = {}
+        if self.options.executor == 'queue':
+            kwargs['queue_filename'] = self.options.queueFile
+
+        executor_class = pos_executors.executors[self.options.executor]
+        return executor_class(cpu_no=self.options.cpuNo,
+                              workdir=self.options.workdir,
+                              memory_limit=self._memory_limit,
+                              memory_model=self._memory_model,
+                              threads_per_job=self.options.threadsPerJob,
+                              tool_pool=self._tool_pool,
+                              capture=self._capture,
+                              cost_model=self._cost_model,
+                              retries=self.options.retries,
+                              retry_delay=self.options.retryDelay,
+                              chunk_duration=self.options.chunkDuration,
+                              speculation=self.options.speculationMultiple,
+                              **kwargs)
 
     def launch(self):
         """
@@ -371,6 +932,16 @@ class generic_workflow(object):
         the job directory. If you want you can customize it so it will send you
         a notification email!
         """
+        if self._tool_pool is not None:
+            self._tool_pool.close()
+
+        for stage, keys in sorted(self._failures.iteritems()):
+            self._logger.error("Failed commands of stage %s, slices: %s",
+                stage, ", ".join(map(str, keys)))
+        if self._failures and not self.options.disableJournal:
+            self._logger.error("Restart the workflow with the same --jobId "
+                "to execute only the failed commands again.")
+
         if self.options.archiveWorkDir:
             self._archive_workflow()
 
@@ -439,9 +1010,64 @@ class generic_workflow(object):
         workflowSettings.add_option('--dryRun', default=False,
                 action='store_const', const=True, dest='dryRun',
                 help='Prints the commands to stdout instead of executing them')
+        workflowSettings.add_option('--planFile', default=None,
+                type='str', dest='planFile',
+                help='In the dry run mode, save the execution plan of the workflow (the stages, the commands with their slice indexes, input and output files, predicted costs and dependencies) into the given JSON file. The plan can be executed or resumed later with the pos_run_plan script, also on another machine. Not available for the workflows computing some of their stages in-process.')
         workflowSettings.add_option('--cpuNo', '-n', default=None,
                 type='int', dest='cpuNo',
                 help='Set a number of CPUs for parallel processing. If skipped, the number of CPUs will be automatically detected.')
+        workflowSettings.add_option('--threadsPerJob', default=None,
+                type='int', dest='threadsPerJob',
+                help='Number of threads used by each of the executed commands (sets ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS for ANTS, c2d and the other ITK based programs). If skipped, the CPUs are split between the commands executed in parallel: large batches (e.g. registering the individual slices) are executed with single-threaded commands, while a single command (e.g. stacking the slices into a volume) gets all the CPUs.')
+        workflowSettings.add_option('--outputTailSize', default=1024,
+                type='int', dest='outputTailSize',
+                help='Amount of the stdout and of the stderr of each executed command (in kilobytes) kept in memory for reporting the errors. The rest of the output is discarded or stored in the log files (see --commandLogs). Set to 0 to keep the complete output in memory. Default: 1024.')
+        workflowSettings.add_option('--commandLogs', default=False,
+                dest='commandLogs', action='store_const', const=True,
+                help='Stream the complete output of each executed command into a separate log file in the "logs" subdirectory of the working directory. The log files are rotated when they exceed 100 MB.')
+        workflowSettings.add_option('--toolPool', default=False,
+                dest='toolPool', action='store_const', const=True,
+                help='Execute possum\'s python tools (e.g. pos_slice_preprocess, pos_align_by_moments) by a pool of workers which import the itk only once, instead of once per slice. The pool adds cpuNo processes to the workflow, each one holding a full import of the itk, for the whole run of the workflow. By default, the tools are executed as separate processes.')
+        workflowSettings.add_option('--memoryLimit', default=None,
+                type='int', dest='memoryLimit',
+                help='Maximum amount of memory (in megabytes) the commands executed in parallel are expected to use. A command is not started until its predicted memory usage fits the limit, so memory hungry commands (e.g. deformable registrations) run fewer at a time than the cheap ones. Set to 0 to disable the limit. If skipped, the amount of the physical memory is used.')
+        workflowSettings.add_option('--memoryModel', default=None,
+                type='str', dest='memoryModel',
+                help='File storing the memory usage of the commands learned from the previous runs. The memory usage of the commands not executed before is predicted from the sizes of their input images. If skipped, the memory usage is learned only during the current run.')
+        workflowSettings.add_option('--costModel', default=None,
+                type='str', dest='costModel',
+                help='File storing the execution times of the commands learned from the previous runs. The most expensive commands of each batch are started first so the long commands do not end up running alone at the end of the batch. The cost of the commands not executed before is predicted from the sizes of their input images and the number of the registration iterations. If skipped, the execution times are learned only during the current run.')
+        workflowSettings.add_option('--retries', default=2,
+                type='int', dest='retries',
+                help='Number of times a command failing transiently (killed by a signal, e.g. crashing with a segmentation fault or killed by the out-of-memory killer) is executed again. Commands exiting with an error code are not retried. Default: 2.')
+        workflowSettings.add_option('--retryDelay', default=10.0,
+                type='float', dest='retryDelay',
+                help='Delay (in seconds) before executing a failed command again. The delay doubles with every subsequent attempt. Default: 10.')
+        workflowSettings.add_option('--chunkDuration', default=0,
+                type='float', dest='chunkDuration',
+                help='Bundle the short commands (voxel counts, similarity measurements, composing the affine transforms and blank deformation fields) into chunks executed by a single shell, as long as the expected duration of the chunk, based on the durations of the commands of the same type executed so far, does not exceed the given number of seconds. The results are still reported for every command, but the resources used by the chunk are split between its commands. Supported by the pool executor only. Disabled (0) by default.')
+        workflowSettings.add_option('--speculationMultiple', default=None,
+                type='float', dest='speculationMultiple',
+                help='Enables the speculative execution of the straggling commands. When a command (e.g. an ANTS registration stuck in the affine stage) runs longer than the given multiple of the median execution time of the commands of the same type and there are free CPUs, a differently configured copy of the command (e.g. fewer affine iterations, smaller optimizer steps) is started. The copy which finishes first wins and the other one is terminated. Supported by the pool executor only. Disabled by default.')
+        workflowSettings.add_option('--executor', default='auto',
+                type='choice', dest='executor',
+                choices=['auto', 'pool', 'parallel', 'queue'],
+                help='Backend executing the batches of commands: pool (the built-in pool of workers), parallel (GNU parallel), queue (a work queue served by any number of pos_worker processes, started on the same machine or on other nodes) or auto (GNU parallel when the ~/.pos_cluster file is present, the pool otherwise). Default: auto.')
+        workflowSettings.add_option('--queueFile', default=None,
+                type='str', dest='queueFile',
+                help='The work queue file used by the queue executor. The pos_worker processes have to be started with the same file. When the workers run on other nodes, the file has to be located on a shared filesystem. By default, the queue is created in the working directory.')
+        workflowSettings.add_option('--disableJournal', default=False,
+                dest='disableJournal', action='store_const', const=True,
+                help='Do not record the executed commands in the journal stored in the working directory. By default, when the workflow is restarted with the same --jobId, the commands which have already finished are not executed again.')
+        workflowSettings.add_option('--cacheDir', default=None,
+                type='str', dest='cacheDir',
+                help='Enables the cache of the commands results and sets the cache directory. The results of the commands already executed on the same input files are restored from the cache instead of executing the commands again. Disabled by default.')
+        workflowSettings.add_option('--cacheSize', default=10240,
+                type='int', dest='cacheSize',
+                help='Maximum size of the results cache in megabytes. The least recently used results are removed when the limit is exceeded. Default: 10240.')
+        workflowSettings.add_option('--traceFile', default=None,
+                type='str', dest='traceFile',
+                help='Records the timeline of the executed commands, including the CPU time, peak memory and I/O of each command, grouped by workflow stage and slice index. The trace is saved in the Chrome trace format (view with chrome://tracing or Perfetto).')
         workflowSettings.add_option('--archiveWorkDir',default=None,
                 type='str', dest='archiveWorkDir',
                 help='Compresses (.tgz) and moves workdir to a given directory')
@@ -580,6 +1206,7 @@ class enclosed_workflow(generic_workflow):
         self.options.dryRun = False
         self.options.cleanup = False
         self.options.cpuNo = 1
+        self.options.toolPool = False
 
 if __name__ == 'possum.pos_wrapper_skel':
     import doctest
@@ -1,10 +1,281 @@
+import re
 import copy
-import subprocess as sub
+import types
 
 from pos_parameters import string_parameter, value_parameter, filename_parameter, \
                 ants_transformation_parameter, vector_parameter, list_parameter, \
                 switch_parameter, ants_regularization_parameter, boolean_parameter
 import pos_parameters
+import pos_executors
+
+
+# The parameter values of these types are immutable and may be shared between
+# the wrappers.
+_IMMUTABLE_TYPES = frozenset([str, unicode, int, long, float, bool,
+                              types.NoneType])
+
+
+# The memoized serialization of a parameter is stored in the parameter's
+# attribute of this name, see :py:meth:`_parameters_dict.render`.
+_SERIALIZED = '_serialized'
+
+# The compiled serialization templates of the wrappers, see
+# :py:func:`_compile_template`.
+_compiled_templates = {}
+
+# Splits the replacement field (e.g. `{name.attribute}`) into the name of the
+# parameter and the rest of the field.
+_FIELD_NAME = re.compile(r'^([^.\[]*)(.*)$', re.S)
+
+
+def _compile_template(template):
+    """
+    Compile the serialization template of a wrapper (see
+    :py:attr:`generic_wrapper._template`). The named replacement fields are
+    turned into positional ones, so the template can be rendered with the
+    serialized parameters it actually uses, in the order they appear. The
+    compiled templates are memoized.
+
+    :return: The names of the parameters used by the template and the
+        positional template.
+    :rtype: (tuple of strings, str)
+
+    >>> _compile_template("ANTS {dimension} {verbose} -o {output!s} {dimension:>3}")
+    (('dimension', 'verbose', 'output'), 'ANTS {0} {1} -o {2!s} {0:>3}')
+    >>> _compile_template("awk '{{print $1}}' {input_file}")
+    (('input_file',), "awk '{{print $1}}' {0}")
+    """
+    compiled = _compiled_templates.get(template)
+    if compiled is not None:
+        return compiled
+
+    # Templates which are not strings fail in the same way `str.format`
+    # would.
+    template.format
+    fields = []
+    positional = []
+    for literal, field, format_spec, conversion in template._formatter_parser():
+        positional.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+
+        name, rest = _FIELD_NAME.match(field).groups()
+        if name not in fields:
+            fields.append(name)
+        positional.append('{%d%s' % (fields.index(name), rest))
+        if conversion:
+            positional.append('!' + conversion)
+        if format_spec:
+            positional.append(':' + format_spec)
+        positional.append('}')
+
+    compiled = tuple(fields), ''.join(positional)
+    _compiled_templates[template] = compiled
+    return compiled
+
+
+def _is_immutable(value):
+    """
+    Check if the value of a parameter cannot change without the parameter
+    being replaced.
+    """
+    if type(value) in _IMMUTABLE_TYPES:
+        return True
+    return type(value) is tuple and all(map(_is_immutable, value))
+
+
+def _copy_value(value):
+    """
+    Copy the value of a parameter. Immutable values are shared, containers are
+    rebuilt and nested wrappers (e.g. the ANTS image metrics) are copied
+    lazily (see :py:meth:`generic_wrapper.__deepcopy__`).
+    """
+    if type(value) in _IMMUTABLE_TYPES:
+        return value
+    elif isinstance(value, list):
+        return map(_copy_value, value)
+    elif isinstance(value, tuple):
+        return tuple(map(_copy_value, value))
+    return copy.deepcopy(value)
+
+
+def _copy_parameter(parameter, copy_value=True):
+    """
+    Make a private copy of the parameter. The copy of the value is skipped
+    when the value is about to be replaced anyway.
+    """
+    clone = object.__new__(parameter.__class__)
+    clone.__dict__ = parameter.__dict__.copy()
+    if copy_value:
+        clone._value = _copy_value(parameter._value)
+    else:
+        clone.__dict__.pop(_SERIALIZED, None)
+    return clone
+
+
+class _parameters_dict(dict):
+    """
+    The parameters of a wrapper. The parameter objects are shared (between
+    the wrapper class defaults and the instances or between a wrapper and its
+    copies) and copied only when they are accessed for the first time (copy
+    on write). That way building a wrapper or copying one costs as much as
+    copying a small dictionary, no matter how complex the wrapper is, while
+    the wrappers remain independent of each other: a parameter accessed with
+    `p[name]` (or `p.get(name)`) is always a private one and may be freely
+    modified.
+
+    Iterating over the parameters (`iteritems`, `values`, etc.) gives the
+    possibly shared parameters which may be read (e.g. serialized) but not
+    modified.
+
+    The serialized parameters and the rendered commands are memoized (see
+    :py:meth:`render`) unless the parameters were handed out with `p[name]`
+    (and thus may be modified at any time) or their values are mutable (e.g.
+    lists). The serializations are kept by the parameter objects, so they
+    are shared as well, e.g. the default parameters of a wrapper are
+    serialized only once.
+
+    >>> defaults = {'a': value_parameter('a', 1), 'b': vector_parameter('b', [1, 2])}
+    >>> p = _parameters_dict(defaults)
+    >>> p.peek('a') is defaults['a']
+    True
+    >>> p['b'].value.append(3)
+    >>> p['b'] is defaults['b'], defaults['b'].value, p['b'].value
+    (False, [1, 2], [1, 2, 3])
+
+    >>> q = copy.deepcopy(p)
+    >>> q['b'].value.append(4)
+    >>> p['b'].value, q['b'].value
+    ([1, 2, 3], [1, 2, 3, 4])
+    >>> q.set_value('a', 2)
+    >>> p['a'].value, q['a'].value, defaults['a'].value
+    (1, 2, 1)
+    """
+    __slots__ = ('_owned', '_exposed', '_rendered')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # Names of the parameters which are private to this dictionary.
+        self._owned = set()
+        # Names of the parameters which were handed out with `p[name]`.
+        self._exposed = set()
+        # The memoized rendered templates.
+        self._rendered = {}
+
+    def _expose(self, name):
+        self._exposed.add(name)
+        self._rendered = {}
+
+    def _own(self, name, copy_value=True):
+        parameter = dict.__getitem__(self, name)
+        if name not in self._owned:
+            parameter = _copy_parameter(parameter, copy_value)
+            dict.__setitem__(self, name, parameter)
+            self._owned.add(name)
+        return parameter
+
+    def __getitem__(self, name):
+        parameter = self._own(name)
+        self._expose(name)
+        return parameter
+
+    def __setitem__(self, name, parameter):
+        dict.__setitem__(self, name, parameter)
+        self._owned.add(name)
+        self._expose(name)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def update(self, *args, **kwargs):
+        for name, parameter in dict(*args, **kwargs).iteritems():
+            self[name] = parameter
+
+    def peek(self, name):
+        """
+        Get the parameter without making a private copy of it. The parameter
+        may be read but must not be modified.
+        """
+        return dict.__getitem__(self, name)
+
+    def set_value(self, name, value):
+        """
+        Set the value of the parameter. The current value of a shared
+        parameter is not copied as it is replaced anyway.
+        """
+        parameter = self._own(name, copy_value=False)
+        parameter.value = value
+        parameter.__dict__.pop(_SERIALIZED, None)
+        self._rendered = {}
+
+    def share(self):
+        """
+        Get a copy of the parameters which shares all the parameter objects
+        (and the memoized serializations) with this dictionary. Both
+        dictionaries copy the parameters when they are accessed next time.
+        """
+        self._owned.clear()
+        clone = _parameters_dict(self)
+        clone._exposed = set(self._exposed)
+        clone._rendered = dict(self._rendered)
+        return clone
+
+    def render(self, template):
+        """
+        Render the serialization template (see
+        :py:attr:`generic_wrapper._template`) with the parameters. The
+        whitespace of the rendered command is normalized.
+
+        >>> p = _parameters_dict({'a': value_parameter('a', 1),
+        ...     'b': vector_parameter('b', [1, 2], '-b {_list}')})
+        >>> p.render("cmd {a}   {b}")
+        'cmd 1 -b 1x2'
+
+        Only the commands using immutable values only are memoized:
+
+        >>> p.set_value('b', (3, 4))
+        >>> p.render("cmd {a}   {b}"), p._rendered
+        ('cmd 1 -b 3x4', {'cmd {a}   {b}': 'cmd 1 -b 3x4'})
+        >>> p['a'].value = 5
+        >>> p.render("cmd {a}   {b}"), p._rendered
+        ('cmd 5 -b 3x4', {})
+        """
+        rendered = self._rendered.get(template)
+        if rendered is not None:
+            return rendered
+
+        fields, positional_template = _compile_template(template)
+        exposed = self._exposed
+        values = []
+        memoize = True
+        for name in fields:
+            parameter = dict.__getitem__(self, name)
+            if name in exposed:
+                value = str(parameter)
+                memoize = False
+            else:
+                memo = parameter.__dict__
+                value = memo.get(_SERIALIZED)
+                if value is None:
+                    value = str(parameter)
+                    if _is_immutable(parameter.value):
+                        memo[_SERIALIZED] = value
+                    else:
+                        memoize = False
+            values.append(value)
+
+        rendered = " ".join(positional_template.format(*values).split())
+        if memoize:
+            self._rendered[template] = rendered
+        return rendered
+
+    def __deepcopy__(self, memo):
+        return self.share()
+
+    def __reduce__(self):
+        return (self.__class__, (), None, None, self.iteritems())
 
 
 class generic_wrapper(object):
@@ -30,31 +301,94 @@ class generic_wrapper(object):
     >>> w._parameters
     {}
 
+    >>> w.get_input_files(), w.get_output_files()
+    (None, None)
+
     """
     _template = None
 
     _parameters = {}
 
+    # Names of the parameters holding the files read (`_input_files`) and
+    # written (`_output_files`) by the command. The declarations allow to
+    # figure out the dependencies between the commands. `None` means that
+    # nothing is known about the files the command touches while an empty list
+    # means that the command does not read (or write) any files.
+    _input_files = None
+    _output_files = None
+
     def __init__(self, **kwargs):
-        # Hardcopy the parameters to split instance parameters
-        # from default class parameters
-        self.p = copy.deepcopy(self._parameters)
+        # Split instance parameters from default class parameters. The
+        # default parameters are copied only when they are accessed (see
+        # :py:class:`_parameters_dict`).
+        self.p = _parameters_dict(self._parameters)
 
         self.updateParameters(kwargs)
 
+    def __deepcopy__(self, memo):
+        """
+        Copy the wrapper. The parameters are shared with the original wrapper
+        until they are accessed, so copying a preconfigured wrapper for every
+        slice is cheap.
+
+        >>> w = touch_wrapper(files=['a'])
+        >>> c = copy.deepcopy(w)
+        >>> c.p['files'].value.append('b')
+        >>> print w.updateParameters({'files': ['x']}), '|', c
+        touch x | touch a b
+        """
+        clone = object.__new__(self.__class__)
+        memo[id(self)] = clone
+        for name, value in self.__dict__.iteritems():
+            if name == 'p':
+                value = value.share()
+            else:
+                value = copy.deepcopy(value, memo)
+            clone.__dict__[name] = value
+        return clone
+
     def __str__(self):
-        replacement = dict(map(lambda (k, v): (k, str(v)), self.p.iteritems()))
-        return " ".join(self._template.format(**replacement).strip().split())
-        #return self._template.format(**replacement).strip()
+        # The templates are compiled once and the rendered commands are
+        # memoized as the commands are serialized many times (for logging,
+        # for the batch files, for the results cache, etc.).
+        return self.p.render(self._get_template())
+
+    def _get_template(self):
+        """
+        :return: The serialization template of the command. Reimplement when
+            the template depends on the parameters.
+        :rtype: str
+        """
+        return self._template
 
     def __call__(self, *args, **kwargs):
-        print "Executing: %s" % str(self)
+        # The results may be restored from the cache, if one is provided
+        # (see :py:mod:`possum.pos_result_cache`).
+        cache = kwargs.get('cache')
+        cached_result = None
+        if cache is not None:
+            cached_result = cache.fetch(self)
+
+        if cached_result is not None:
+            print "Restored from cache: %s" % str(self)
+            result = cached_result
+        else:
+            print "Executing: %s" % str(self)
+
+            # Tested against execution of multiple commands
+            # http://stackoverflow.com/questions/359347/execute-commands-sequentially-in-python
+            result = pos_executors.run_command(str(self))
+
+            if cache is not None:
+                cache.store(self, result)
+
+        # The timing and the resources used by the command may be recorded
+        # in the execution trace (see :py:mod:`possum.pos_trace`).
+        trace = kwargs.get('trace')
+        if trace is not None:
+            trace.add(result, stage=self.__class__.__name__)
 
-        # Tested against execution of multiple commands
-        # http://stackoverflow.com/questions/359347/execute-commands-sequentially-in-python
-        stdout, stderr = sub.Popen(str(self), stdout=sub.PIPE,
-                            stderr=sub.PIPE, shell=True,
-                            close_fds=True).communicate()
+        stdout, stderr = result.stdout, result.stderr
         print stdout.strip()
         print stderr.strip()
 
@@ -62,14 +396,72 @@ class generic_wrapper(object):
 
         if hasattr(self, '_io_pass'):
             for k, v in self._io_pass.iteritems():
-                execution['port'][v] = str(self.p[k])
+                execution['port'][v] = str(self.p.peek(k))
         return execution
 
     def updateParameters(self, parameters):
         for (name, value) in parameters.items():
-            self.p[name].value = value
+            self.p.set_value(name, value)
         return self
 
+    def get_input_files(self):
+        """
+        :return: Files read by the command or `None` if the wrapper does not
+            declare its input files.
+        :rtype: list of strings
+        """
+        return self._collect_files(self._input_files, 'get_input_files')
+
+    def get_output_files(self):
+        """
+        :return: Files written by the command or `None` if the wrapper does
+            not declare its output files.
+        :rtype: list of strings
+        """
+        return self._collect_files(self._output_files, 'get_output_files')
+
+    def get_speculative_variant(self):
+        """
+        Get a differently configured copy of the command, which the executors
+        may run next to the command when the command takes much longer than
+        the similar ones (see :py:class:`possum.pos_executors.pool_executor`).
+        The copy writes to other files than the command itself, listed by its
+        :py:meth:`get_output_files` in the same order as the outputs of the
+        command.
+
+        :return: The copy or `None` if there is no alternative configuration
+            of the command.
+        :rtype: :py:class:`generic_wrapper`
+
+        >>> print touch_wrapper(files=['x']).get_speculative_variant()
+        None
+        """
+        return None
+
+    def _collect_files(self, parameter_names, nested_method):
+        """
+        Gather the filenames stored in the provided parameters. Parameters
+        may hold a single filename, a list of filenames or other wrappers (like
+        the ANTS image metrics) which are asked for their files with the
+        `nested_method`. Unset parameters are skipped.
+        """
+        if parameter_names is None:
+            return None
+
+        files = []
+        values = [self.p.peek(name).value for name in parameter_names]
+        while values:
+            value = values.pop(0)
+            if value is None or value is False:
+                continue
+            elif isinstance(value, (list, tuple)):
+                values = list(value) + values
+            elif isinstance(value, generic_wrapper):
+                files.extend(getattr(value, nested_method)() or [])
+            else:
+                files.append(str(value))
+        return files
+
 
 class touch_wrapper(generic_wrapper):
     """
@@ -126,6 +518,9 @@ class touch_wrapper(generic_wrapper):
         'files': list_parameter('files', [], str_template='{_list}'),
     }
 
+    _input_files = []
+    _output_files = ['files']
+
 
 class mkdir_wrapper(generic_wrapper):
     """
@@ -467,10 +862,80 @@ class ants_registration(generic_wrapper):
         'affineMetricType': value_parameter('affine-metric-type', None, str_template='--{_name} {_value}')
     }
 
+    _input_files = ['imageMetrics', 'initialAffine', 'fixedImageInitialAffine', 'maskImage']
+
     _io_pass = {
         'dimension': 'dimension'
     }
 
+    def get_output_files(self):
+        """
+        ANTS does not take the output filenames directly but derives them from
+        the output naming prefix. Without the prefix, ANTS writes to its
+        default outputs, so the outputs are not declared (`None`) and the
+        command acts as a barrier in the scheduler.
+
+        >>> metric = ants_intensity_meric(fixed_image='f.nii.gz', moving_image='m.nii.gz')
+        >>> wrapper = ants_registration(imageMetrics=[metric],
+        ... outputNaming="test_", initialAffine="init.txt")
+        >>> wrapper.get_input_files()
+        ['f.nii.gz', 'm.nii.gz', 'init.txt']
+
+        >>> wrapper.get_output_files()
+        ['test_Affine.txt', 'test_Warp.nii.gz', 'test_InverseWarp.nii.gz']
+
+        >>> print ants_registration().get_output_files()
+        None
+        """
+        naming = self.p.peek('outputNaming').value
+        if naming is None:
+            return None
+        return [str(naming) + suffix for suffix in
+                ['Affine.txt', 'Warp.nii.gz', 'InverseWarp.nii.gz']]
+
+    def get_speculative_variant(self):
+        """
+        A registration stuck in the affine stage usually oscillates around the
+        optimum. The speculative copy of the registration performs half of the
+        affine iterations and, unless the affine optimizer is configured
+        explicitly, uses smaller optimizer steps. The outputs of the copy are
+        prefixed with `speculative_`.
+
+        >>> metric = ants_intensity_meric(fixed_image='f.nii.gz', moving_image='m.nii.gz')
+        >>> wrapper = ants_registration(imageMetrics=[metric],
+        ... outputNaming="test_", affineIterations=[100, 25, 0])
+        >>> variant = wrapper.get_speculative_variant()
+        >>> variant.get_output_files() #doctest: +NORMALIZE_WHITESPACE
+        ['test_speculative_Affine.txt', 'test_speculative_Warp.nii.gz',
+         'test_speculative_InverseWarp.nii.gz']
+        >>> print variant.p['affineIterations']
+        --number-of-affine-iterations 50x12x0
+        >>> print variant.p['affineGradientDescent']
+        --affine-gradient-descent-option 0.05x0.5x0.0001x0.0001
+
+        The original registration is left intact:
+
+        >>> print wrapper.p['affineIterations']
+        --number-of-affine-iterations 100x25x0
+        >>> print wrapper.p['affineGradientDescent'].value
+        None
+
+        >>> print ants_registration().get_speculative_variant()
+        None
+        """
+        naming = self.p.peek('outputNaming').value
+        if naming is None:
+            return None
+
+        affine_iterations = self.p.peek('affineIterations').value or []
+        parameters = {
+            'outputNaming': str(naming) + 'speculative_',
+            'affineIterations':
+                [int(n) and max(1, int(n) // 2) for n in affine_iterations]}
+        if self.p.peek('affineGradientDescent').value is None:
+            parameters['affineGradientDescent'] = [0.05, 0.5, 1.e-4, 1.e-4]
+        return copy.deepcopy(self).updateParameters(parameters)
+
     def __call__(self, *args, **kwargs):
         execution = super(self.__class__, self).__call__(*args, **kwargs)
         execution['port']['deformable_list'] = [str(self.p['outputNaming'].value) + 'Warp.nii.gz']
@@ -512,6 +977,9 @@ class ants_reslice(generic_wrapper):
         'affine_list': list_parameter('affine_list', [], str_template='{_list}')
     }
 
+    _input_files = ['moving_image', 'reference_image', 'deformable_list', 'affine_list']
+    _output_files = ['output_image']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_image': 'input_image'
@@ -609,6 +1077,9 @@ class ants_intensity_meric(generic_wrapper):
         'parameter': value_parameter('parameter', 4)
     }
 
+    _input_files = ['fixed_image', 'moving_image']
+    _output_files = []
+
     def _get_value(self):
         return str(self)
 
@@ -724,6 +1195,9 @@ class ants_point_set_estimation_metric(generic_wrapper):
         'boundary_points_only': boolean_parameter('boundary_points_only', False, str_template=',{_value}'),
     }
 
+    _input_files = ['fixed_image', 'moving_image', 'fixed_points', 'moving_points']
+    _output_files = []
+
     def _get_value(self):
         return str(self)
 
@@ -794,6 +1268,9 @@ class ants_average_affine_transform(generic_wrapper):
         'affine_list': list_parameter('affine_list', [], str_template='{_list}')
     }
 
+    _input_files = ['reference_affine_transform', 'affine_list']
+    _output_files = ['output_affine_transform']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_affine_transform': 'input_affine_transform'
@@ -867,6 +1344,9 @@ class ants_compose_multi_transform(generic_wrapper):
         'affine_list': list_parameter('affine_list', [], str_template='{_list}')
     }
 
+    _input_files = ['reference_image', 'deformable_list', 'affine_list']
+    _output_files = ['output_image']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_image': 'input_image'
@@ -907,6 +1387,9 @@ class ants_average_images(generic_wrapper):
         'output_image': filename_parameter('output_image'),
     }
 
+    _input_files = ['input_images']
+    _output_files = ['output_image']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_image': 'input_image'
@@ -926,6 +1409,9 @@ class images_weighted_average(generic_wrapper):
         'output_type': string_parameter('output_type', 'uchar', str_template='-type {_value}')
     }
 
+    _input_files = ['input_images']
+    _output_files = ['output_image']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_image': 'input_image'
@@ -944,6 +1430,9 @@ class average_images(images_weighted_average):
         'output_type': string_parameter('output_type', 'uchar', str_template='-type {_value}')
     }
 
+    _input_files = ['input_images']
+    _output_files = ['output_image']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_image': 'input_image'
@@ -985,6 +1474,9 @@ class chain_affine_transforms(generic_wrapper):
         'output_transform': filename_parameter('output_transform')
     }
 
+    _input_files = ['input_transforms']
+    _output_files = ['output_transform']
+
     _io_pass = {
         'dimension': 'dimension',
         'output_transform': 'output_transform'
@@ -1111,6 +1603,49 @@ class stack_and_reorient_wrapper(generic_wrapper):
         'resample': list_parameter('resample', [], str_template='--{_name} {_list}')
     }
 
+    _output_files = ['output_volume_fn']
+
+    def get_input_files(self):
+        """
+        The input slices are derived from the naming scheme and the stacking
+        options. Just as the ITK's numeric series file names generator does,
+        the last slice index is included.
+
+        >>> p = stack_and_reorient_wrapper(stack_mask='%04d.nii.gz',
+        ... slice_start=1, slice_end=5, slice_step=2)
+        >>> p.get_input_files()
+        ['0001.nii.gz', '0003.nii.gz', '0005.nii.gz']
+
+        >>> p.get_output_files()
+        []
+
+        >>> stack_and_reorient_wrapper(stack_mask='volume.nii.gz').get_input_files()
+        ['volume.nii.gz']
+
+        >>> stack_and_reorient_wrapper(stack_mask='%04d.nii.gz',
+        ... slice_start=1).get_input_files()
+
+        Listing the files does not make a private copy of the parameters
+        shared with the template wrapper:
+
+        >>> c = copy.deepcopy(p)
+        >>> c.get_input_files()
+        ['0001.nii.gz', '0003.nii.gz', '0005.nii.gz']
+        >>> c.p.peek('stack_mask') is p.p.peek('stack_mask')
+        True
+        """
+        mask = self.p.peek('stack_mask').value
+        stacking = [self.p.peek(name).value for name in
+                    ['slice_start', 'slice_end', 'slice_step']]
+
+        if all(value is None for value in stacking):
+            return self._collect_files(['stack_mask'], 'get_input_files')
+        if mask is None or None in stacking:
+            return None
+
+        start, stop, step = map(int, stacking)
+        return [str(mask) % i for i in range(start, stop + 1, step)]
+
 
 class alignment_preprocessor_wrapper(generic_wrapper):
     """
@@ -1232,6 +1767,9 @@ class alignment_preprocessor_wrapper(generic_wrapper):
         'invert_grayscale': switch_parameter('invertSourceImage', False, str_template="--{_name}"),
         'invert_multichannel': switch_parameter('invertMultichannelImage', False, str_template="--{_name}")}
 
+    _input_files = ['input_image']
+    _output_files = ['grayscale_output_image', 'color_output_image']
+
 
 class command_warp_rgb_slice(generic_wrapper):
     """
@@ -1350,6 +1888,9 @@ class command_warp_rgb_slice(generic_wrapper):
         'inversion_flag': pos_parameters.boolean_parameter('inversion_flag', None, str_template=' -scale -1 -shift 255 -type uchar'),
     }
 
+    _input_files = ['reference_image', 'moving_image', 'transformation']
+    _output_files = ['output_image']
+
 
 class command_warp_grayscale_image(generic_wrapper):
     """
@@ -1448,6 +1989,9 @@ class command_warp_grayscale_image(generic_wrapper):
         'output_image': pos_parameters.filename_parameter('output_image', None),
     }
 
+    _input_files = ['reference_image', 'moving_image', 'transformation']
+    _output_files = ['output_image']
+
 
 class image_similarity_wrapper(generic_wrapper):
     """
@@ -1527,12 +2071,10 @@ class image_similarity_wrapper(generic_wrapper):
     _template_no_affine = """c{dimension}d {reference_image} {moving_image} \
         {metric} | cut -f3 -d' '"""
 
-    def __str__(self):
-        if self.p['affine_transformation'].value is not None:
-            self._template = self._template_affine
-        else:
-            self._template = self._template_no_affine
-        return super(self.__class__, self).__str__()
+    def _get_template(self):
+        if self.p.peek('affine_transformation').value is not None:
+            return self._template_affine
+        return self._template_no_affine
 
     _parameters = {
         'dimension': pos_parameters.value_parameter('dimension', 2),
@@ -1541,6 +2083,9 @@ class image_similarity_wrapper(generic_wrapper):
         'metric': string_parameter('metric', 'ncor', str_template='-{_value}'),
         'affine_transformation': filename_parameter('affine_transformation', None)}
 
+    _input_files = ['reference_image', 'moving_image', 'affine_transformation']
+    _output_files = []
+
 
 class split_multichannel_image(generic_wrapper):
     """
@@ -1600,6 +2145,9 @@ class split_multichannel_image(generic_wrapper):
         'output_components': pos_parameters.list_parameter('output_components', [], str_template='{_list}')
         }
 
+    _input_files = ['input_image']
+    _output_files = ['output_components']
+
 
 class merge_components(generic_wrapper):
     """
@@ -1696,6 +2244,9 @@ class merge_components(generic_wrapper):
         'other_files_remove': pos_parameters.list_parameter('other_files_remove', [], str_template='{_list}')
         }
 
+    _input_files = ['input_images', 'other_files_remove']
+    _output_files = ['output_image', 'other_files_remove']
+
 class image_voxel_count_wrapper(generic_wrapper):
     """
     Determines the amount (sum or integral) of non-background pixels in the
@@ -1779,6 +2330,9 @@ class image_voxel_count_wrapper(generic_wrapper):
         'voxel_integral' : pos_parameters.boolean_parameter('voxel-integral', None, str_template='-{_name}')
     }
 
+    _input_files = ['image']
+    _output_files = []
+
 class align_by_center_of_gravity(generic_wrapper):
     """
     Calculated a transformation between two images so that the images' centres
@@ -1816,6 +2370,9 @@ class align_by_center_of_gravity(generic_wrapper):
         'output_transformation': pos_parameters.filename_parameter('output_transformation', None, str_template="--transformationFileName {_value}"),
     }
 
+    _input_files = ['fixed_image', 'moving_image']
+    _output_files = ['output_transformation']
+
 
 if __name__ == 'possum.pos_wrappers':
     import doctest
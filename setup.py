@@ -33,6 +33,20 @@ class run_tests(TestCommand):
         print doctest.testmod(possum.pos_wrappers, verbose=verbose_flag)
         print doctest.testmod(possum.pos_parameters, verbose=verbose_flag)
         print doctest.testmod(possum.pos_wrapper_skel, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_executors, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_scheduler, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_result_cache, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_journal, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_trace, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_memory, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_cost, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_tool_pool, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_broker, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_plan, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_slice_index, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_similarity, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_slice_graph, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_affine, verbose=verbose_flag)
         print doctest.testmod(possum.pos_common, verbose=verbose_flag)
         print doctest.testmod(possum.pos_color, verbose=verbose_flag)
         print doctest.testmod(possum.pos_segmentation_parser, verbose=verbose_flag)
@@ -49,7 +63,7 @@ setup(
     description='three dimensional image reconstruction from serial sections.',
     long_description=long_description,
     packages=['possum','bin'],
-    scripts=['bin/pos_align_by_moments', 'bin/pos_coarse_fine', 'bin/pos_deformable_histology_reconstruction', 'bin/pos_pairwise_registration', 'bin/pos_reorder_volume', 'bin/pos_sequential_alignment', 'bin/pos_slice_preprocess', 'bin/pos_slice_volume', 'bin/pos_stack_reorient', 'bin/pos_stack_warp_image_multi_transform'],
+    scripts=['bin/pos_align_by_moments', 'bin/pos_coarse_fine', 'bin/pos_deformable_histology_reconstruction', 'bin/pos_pairwise_registration', 'bin/pos_reorder_volume', 'bin/pos_run_plan', 'bin/pos_sequential_alignment', 'bin/pos_slice_preprocess', 'bin/pos_slice_volume', 'bin/pos_stack_reorient', 'bin/pos_stack_warp_image_multi_transform', 'bin/pos_worker'],
     include_package_data=True,
     platforms='Linux',
     test_suite='possum.test.test_possum',
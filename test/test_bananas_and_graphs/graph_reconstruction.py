@@ -28,7 +28,8 @@ def createGraph(numberOfSlices, epsilon, similarityData = None):
 
 def getShortestPath(node1, node2, Graph, shortest_paths = None ):
     if not shortest_paths:
-        shortest_paths = nx.all_pairs_dijkstra_path(G)
+        shortest_paths = nx.single_source_dijkstra_path(Graph, node1)
+    return shortest_paths[node2]
 
 def convertDataFromStrings(row):
     return int(row[0]), int(row[1]), float(row[2])
@@ -65,9 +66,9 @@ def createGraphsFromSimilarities(similarities_data, lambdas):
     return graphs
 
 def nodesOmitted(Graph, referenceNode):
-    shortest_paths = nx.all_pairs_dijkstra_path(Graph)
-    front_path = shortest_paths[referenceNode][0]
-    back_path = shortest_paths[referenceNode][len(Graph.nodes()) - 1]
+    shortest_paths = nx.single_source_dijkstra_path(Graph, referenceNode)
+    front_path = shortest_paths[0]
+    back_path = shortest_paths[len(Graph.nodes()) - 1]
     path = concatenate([front_path, back_path])
     omitted = ones(len(Graph.nodes()))
     for node in path:
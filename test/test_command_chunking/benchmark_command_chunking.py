@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Benchmark of executing many short commands (like the voxel counts or the
+chaining of the affine transforms of every slice) by the pool executor, one
+shell per command and bundled into chunks. Both runs have to give the same
+results. Only the short types of the commands are bundled, so the commands
+of the benchmark pose as the voxel counts.
+
+Usage: python benchmark_command_chunking.py [--commands N] [--cpuNo N]
+"""
+
+import time
+from optparse import OptionParser
+
+from possum import pos_executors
+
+
+class image_voxel_count_wrapper(object):
+    """
+    Stands for the voxel count of a slice (see
+    :py:func:`possum.pos_executors.is_short_command`).
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return "echo %d | cat" % self.index
+
+
+def measure(name, executor, commands):
+    start_time = time.time()
+    results = executor.run(commands)
+    elapsed = time.time() - start_time
+    print "%-12s %6.3f s  (%.2f ms per command)" % \
+        (name, elapsed, 1000.0 * elapsed / len(commands))
+    return [(r.returncode, r.stdout) for r in results]
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--commands', dest='commands', type='int',
+        default=5000, help='Number of commands. Default: 5000.')
+    parser.add_option('--cpuNo', dest='cpuNo', type='int',
+        default=4, help='Number of workers. Default: 4.')
+    options, args = parser.parse_args()
+
+    commands = map(image_voxel_count_wrapper, range(options.commands))
+    single = measure('one by one',
+        pos_executors.pool_executor(cpu_no=options.cpuNo), commands)
+    chunked = measure('chunks', pos_executors.pool_executor(
+        cpu_no=options.cpuNo, chunk_duration=1.0), commands)
+    assert single == chunked, "The results differ"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Benchmark of building and rendering the command line wrappers.
+
+The workflows build their per-slice commands either by instantiating the
+wrappers or by copying a preconfigured wrapper (`copy.deepcopy`) and updating
+its parameters. Both ways are measured for the ANTS registration (the most
+complex wrapper, with nested image metrics) and for the reslicing of the
+multichannel slices.
+
+Usage: python benchmark_command_construction.py [--commands N]
+"""
+
+import copy
+import time
+from optparse import OptionParser
+
+from possum import pos_wrappers
+
+
+def build_registration(i):
+    return pos_wrappers.ants_registration(
+        dimension=2,
+        outputNaming='/tmp/transforms/tr_%04d_' % i,
+        iterations=[0],
+        transformation=('Rigid', [0.05]),
+        affineIterations=[10000] * 5,
+        continueAffine=None,
+        rigidAffine=True,
+        imageMetrics=[pos_wrappers.ants_intensity_meric(
+            fixed_image='/tmp/slices/%04d.nii.gz' % (i + 1),
+            moving_image='/tmp/slices/%04d.nii.gz' % i,
+            metric='MI', weight=1.0, parameter=32)],
+        histogramMatching=True,
+        miOption=[32, 16000])
+
+
+def build_reslice(i):
+    return pos_wrappers.command_warp_rgb_slice(
+        reference_image='/tmp/reference.nii.gz',
+        moving_image='/tmp/slices/%04d.nii.gz' % i,
+        transformation='/tmp/transforms/tr_%04d_Affine.txt' % i,
+        output_image='/tmp/resliced/%04d.nii.gz' % i,
+        background=255, inversion_flag=False)
+
+
+def copy_registration(template, i):
+    command = copy.deepcopy(template)
+    command.updateParameters({
+        'outputNaming': '/tmp/transforms/tr_%04d_' % i})
+    metric = command.p['imageMetrics'].value[0]
+    metric.updateParameters({
+        'fixed_image': '/tmp/slices/%04d.nii.gz' % (i + 1),
+        'moving_image': '/tmp/slices/%04d.nii.gz' % i})
+    return command
+
+
+def copy_reslice(template, i):
+    command = copy.deepcopy(template)
+    return command.updateParameters({
+        'moving_image': '/tmp/slices/%04d.nii.gz' % i,
+        'output_image': '/tmp/resliced/%04d.nii.gz' % i})
+
+
+def measure(name, build, commands_no):
+    start_time = time.time()
+    commands = [build(i) for i in range(commands_no)]
+    built_time = time.time()
+    rendered = map(str, commands)
+    end_time = time.time()
+    print "%-28s build: %7.3f s  render: %7.3f s  (%d commands)" % \
+        (name, built_time - start_time, end_time - built_time, len(rendered))
+    return rendered
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--commands', dest='commands', type='int',
+        default=100000, help='Number of commands of each kind. Default: 100000.')
+    options, args = parser.parse_args()
+
+    registration = build_registration(0)
+    reslice = build_reslice(0)
+
+    measure('ants_registration', build_registration, options.commands)
+    measure('ants_registration (copy)',
+            lambda i: copy_registration(registration, i), options.commands)
+    measure('command_warp_rgb_slice', build_reslice, options.commands)
+    measure('command_warp_rgb_slice (copy)',
+            lambda i: copy_reslice(reslice, i), options.commands)
+
+    # The copies have to be independent of the template.
+    assert str(registration) == str(build_registration(0))
+    assert str(reslice) == str(build_reslice(0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Benchmark of rendering the command line wrappers into the command strings.
+
+Every command is rendered a few times during the workflow: when it is
+logged, when the batch file is written, when the results cache is queried,
+etc. The first rendering of every command and the repeated ones are measured
+separately and compared with the straightforward rendering (serializing all
+the parameters and formatting the template by name). The renderings have to
+be identical.
+
+Usage: python benchmark_command_rendering.py [--renders N]
+"""
+
+import time
+from optparse import OptionParser
+
+from possum import pos_wrappers
+from benchmark_command_construction import build_registration, build_reslice
+
+
+def reference_render(command):
+    """
+    Render the command the way the wrappers used to.
+    """
+    replacement = dict(map(lambda (k, v): (k, str(v)), command.p.iteritems()))
+    return " ".join(command._get_template().format(**replacement).split())
+
+
+def measure(name, build, renders_no):
+    commands = [build(i) for i in range(renders_no)]
+
+    start_time = time.time()
+    expected = map(reference_render, commands)
+    reference_time = time.time() - start_time
+
+    start_time = time.time()
+    first = map(str, commands)
+    first_time = time.time() - start_time
+
+    start_time = time.time()
+    repeated = map(str, commands)
+    repeated_time = time.time() - start_time
+
+    print "%-24s reference: %6.3f s  first: %6.3f s  repeated: %6.3f s" % \
+        (name, reference_time, first_time, repeated_time)
+    assert first == expected and repeated == expected, \
+        "%s renders differently" % name
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--renders', dest='renders', type='int',
+        default=50000, help='Number of renders of each kind. Default: 50000.')
+    options, args = parser.parse_args()
+
+    measure('ants_registration', build_registration, options.renders)
+    measure('command_warp_rgb_slice', build_reslice, options.renders)
+
+
+if __name__ == '__main__':
+    main()
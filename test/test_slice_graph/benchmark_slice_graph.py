@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Benchmark of finding the chains of the partial transformations of the
+sequential alignment: the shortest paths from the reference slice to every
+slice of the stack. The banded graph with a single Dijkstra search from the
+reference slice is compared with the all pairs shortest paths of networkx
+(computed once, while the workflow used to compute them once per slice).
+Both have to give paths of the same length.
+
+Usage: python benchmark_slice_graph.py [--slices N,N,...] [--epsilon N]
+                                       [--maxAllPairs N]
+"""
+
+import time
+import random
+from optparse import OptionParser
+
+import networkx as nx
+
+from possum import pos_slice_graph
+
+
+def get_edges(slices_no, epsilon, reference, l=0.0):
+    """
+    The edges of the graph of the sequential alignment, with random
+    similarities.
+    """
+    edges = []
+    for i in range(slices_no):
+        if i > reference:
+            fixed = range(max(reference, i - epsilon), i)
+        elif i < reference:
+            fixed = range(i + 1, min(reference, i + epsilon) + 1)
+        else:
+            fixed = [i]
+        for j in fixed:
+            s = random.uniform(-1.0, -0.5)
+            w = (1.0 + s) * abs(i - j) * (1.0 + l) ** (abs(i - j))
+            edges.append((j, i, w))
+    return edges
+
+
+def measure_banded(slices_no, epsilon, reference, edges):
+    start_time = time.time()
+    graph = pos_slice_graph.banded_graph(0, slices_no - 1, epsilon)
+    graph.add_weighted_edges_from(edges)
+    tree = graph.shortest_path_tree(reference)
+    lengths = [tree.distance(i) for i in range(slices_no)]
+    return time.time() - start_time, lengths
+
+
+def measure_networkx(slices_no, reference, edges):
+    start_time = time.time()
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from(edges)
+    paths = nx.all_pairs_dijkstra_path(graph)
+    paths = dict(paths)[reference]
+    lengths = [sum(graph[u][v]['weight'] for u, v in zip(p[:-1], p[1:]))
+               for p in (paths[i] for i in range(slices_no))]
+    return time.time() - start_time, lengths
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--slices', dest='slices', type='str',
+        default='500,5000,20000',
+        help='Comma separated numbers of slices. Default: 500,5000,20000.')
+    parser.add_option('--epsilon', dest='epsilon', type='int',
+        default=5, help='The graph edge epsilon. Default: 5.')
+    parser.add_option('--maxAllPairs', dest='maxAllPairs', type='int',
+        default=1000, help='The largest stack for which the all pairs '
+        'shortest paths are computed. Default: 1000.')
+    options, args = parser.parse_args()
+
+    random.seed(0)
+    for slices_no in map(int, options.slices.split(',')):
+        reference = slices_no // 2
+        edges = get_edges(slices_no, options.epsilon, reference)
+
+        elapsed, lengths = measure_banded(slices_no, options.epsilon,
+                                          reference, edges)
+        print "%6d slices  banded graph %8.3f s" % (slices_no, elapsed)
+
+        if slices_no <= options.maxAllPairs:
+            elapsed, nx_lengths = measure_networkx(slices_no, reference,
+                                                   edges)
+            print "%6d slices  all pairs    %8.3f s  (x %d slices: %.1f s)" % \
+                (slices_no, elapsed, slices_no, elapsed * slices_no)
+            assert all(abs(a - b) < 1e-9 for a, b in zip(lengths, nx_lengths)), \
+                "The paths differ"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""
+Start-up time benchmark of the possum's command line tools.
+
+Every tool is started with the `--help` switch in a fresh interpreter a few
+times. The best wall time of each tool has to fit the time budget and none of
+the heavy modules (itk, numpy, scipy, networkx) may be imported just to print
+the help message. The tools are invoked tens of thousands of times per
+reconstruction so their start-up latency adds up quickly.
+
+Usage: python test_startup_time.py [--budget SECONDS] [--repeats N]
+"""
+
+import os
+import sys
+import time
+import subprocess as sub
+from optparse import OptionParser
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, os.pardir, 'bin')
+
+ENTRY_POINTS = ['pos_align_by_moments',
+                'pos_coarse_fine',
+                'pos_deformable_histology_reconstruction',
+                'pos_pairwise_registration',
+                'pos_reorder_volume',
+                'pos_sequential_alignment',
+                'pos_slice_preprocess',
+                'pos_slice_volume',
+                'pos_stack_reorient',
+                'pos_stack_warp_image_multi_transform']
+
+HEAVY_MODULES = ['itk', 'numpy', 'scipy', 'networkx']
+
+# Runs the script as the __main__ module and reports the heavy modules which
+# got imported on the way.
+DRIVER = """
+import sys, atexit, runpy
+def report():
+    heavy = [m for m in %r if m in sys.modules]
+    sys.__stderr__.write('HEAVY_MODULES:' + ','.join(heavy) + '\\n')
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+""" % HEAVY_MODULES
+
+
+def measure(script, repeats):
+    """
+    Start the script `repeats` times. Returns the best wall time and the heavy
+    modules imported by the script.
+    """
+    times = []
+    heavy = []
+    for i in range(repeats):
+        start_time = time.time()
+        process = sub.Popen([sys.executable, '-c', DRIVER, script, '--help'],
+                            stdout=sub.PIPE, stderr=sub.PIPE)
+        stdout, stderr = process.communicate()
+        times.append(time.time() - start_time)
+
+        for line in stderr.splitlines():
+            if line.startswith('HEAVY_MODULES:'):
+                heavy = filter(None, line.split(':', 1)[1].split(','))
+    return min(times), heavy
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--budget', dest='budget', type='float', default=1.0,
+        help='Maximum start-up time of a single tool in seconds. Default: 1.0')
+    parser.add_option('--repeats', dest='repeats', type='int', default=5,
+        help='Number of starts of every tool. The best time counts. Default: 5')
+    options, args = parser.parse_args()
+
+    failed = []
+    for entry_point in ENTRY_POINTS:
+        script = os.path.join(BIN_DIR, entry_point)
+        best_time, heavy = measure(script, options.repeats)
+        status = 'ok'
+        if best_time > options.budget or heavy:
+            status = 'FAILED'
+            failed.append(entry_point)
+        print "%-42s %6.3f s  %-8s %s" % \
+            (entry_point, best_time, status, ' '.join(heavy))
+
+    if failed:
+        print "Start-up budget of %.2f s exceeded or heavy modules imported " \
+              "by: %s" % (options.budget, ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()